@@ -0,0 +1,196 @@
+import asyncio
+import logging
+import signal
+from aiogram import Bot, Dispatcher, BaseMiddleware, F
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, CallbackQuery
+from aiogram.client.session.aiohttp import AiohttpSession # <-- ИМПОРТ ДЛЯ ПРОКСИ
+
+from apscheduler.triggers.interval import IntervalTrigger
+
+from config import TELEGRAM_TOKEN, PROXY_URL, RECEIPTS_SYNC_INTERVAL, RECEIPTS_FULL_SYNC_INTERVAL, BALANCE_RECONCILE_INTERVAL, DEFERRED_POLL_INTERVAL # <-- ИМПОРТ PROXY_URL
+from sheets import load_receipts_mirror, sync_receipts_tail, refresh_receipts_mirror, rebuild_fiscal_index, start_sheets_backend, close_sheets_backend, reconcile_balance, load_allowed_users
+from proverkacheka import proverkacheka_client
+from qr_decoder import start_qr_decoder, shutdown_qr_decoder
+from recognition import recognition_queue
+from deferred import poll_deferred_checks
+from utils import start_cache_invalidation, stop_cache_invalidation, migrate_legacy_keys
+from fsm_storage import fsm_storage
+from handlers.commands import router as commands_router
+from handlers.add import add_router
+from handlers.return_ import return_router
+from handlers.expenses import expenses_router
+from handlers.notifications import start_notifications, scheduler
+
+# ---------------------------------------------------------
+# Логирование
+# ---------------------------------------------------------
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+logger = logging.getLogger("AccountingBot")
+
+# ---------------------------------------------------------
+# Глобальная переменная для username бота (кэш)
+# ---------------------------------------------------------
+BOT_USERNAME: str | None = None
+
+# ---------------------------------------------------------
+# Middleware для ошибок (оставляем как у тебя было)
+# ---------------------------------------------------------
+class ErrorMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            logger.error(f"Error in handler {getattr(handler, '__name__', repr(handler))}: {e}", exc_info=True)
+            # Попробуем уведомить пользователя (если есть message)
+            try:
+                if hasattr(event, "message") and event.message:
+                    await event.message.answer("Произошла ошибка. Попробуйте /start или позже.")
+            except TelegramBadRequest:
+                pass
+
+# ---------------------------------------------------------
+# Middleware: блокируем всё в группах, кроме /balance (и /balance@botname).
+# Также блокируем callback_query из групп.
+# ---------------------------------------------------------
+class GroupFilterMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        try:
+            # --- Message ---
+            if isinstance(event, Message):
+                msg: Message = event
+                # Только для групп/супергрупп действуем
+                if msg.chat and msg.chat.type in ("group", "supergroup"):
+                    text = (msg.text or msg.caption or "").strip().lower()
+                    # Получаем username бота (кэшируем в BOT_USERNAME на старте)
+                    bot_username = BOT_USERNAME
+                    if not bot_username:
+                        # fallback — один раз получить от API
+                        try:
+                            bot_info = await msg.bot.get_me()
+                            bot_username = (bot_info.username or "").lower()
+                        except Exception:
+                            bot_username = ""
+                    allowed_prefixes = ("/balance", f"/balance@{bot_username}" if bot_username else "/balance")
+                    # Если сообщение не начинается с разрешённой команды — просто НЕ вызываем handler
+                    if not any(text.startswith(p) for p in allowed_prefixes):
+                        logger.debug(f"🔇 Ignored group message from chat {msg.chat.id}: {text[:80]}")
+                        return  # не вызываем handler — обработка прекращена
+
+            # --- CallbackQuery ---
+            if isinstance(event, CallbackQuery):
+                # Игнорируем все callback_query из групп (чтобы кнопки в группах не тригерили)
+                if event.message and event.message.chat and event.message.chat.type in ("group", "supergroup"):
+                    logger.debug(f"🔇 Ignored callback_query in group {event.message.chat.id}")
+                    return
+
+        except Exception as e:
+            # Если что-то упало в мидлваре, логируем и даём обработке пройти (чтобы бот не молчал из-за ошибки мидлвари)
+            logger.exception(f"Exception in GroupFilterMiddleware: {e}")
+            return await handler(event, data)
+
+        # Всё ок — продолжаем цепочку
+        return await handler(event, data)
+
+
+# ---------------------------------------------------------
+# Инициализация бота и диспетчера (БЕЗОПАСНАЯ ИНТЕГРАЦИЯ ПРОКСИ)
+# ---------------------------------------------------------
+if PROXY_URL:
+    logger.info("Инициализация бота с использованием прокси.")
+    session = AiohttpSession(proxy=PROXY_URL)
+    bot = Bot(token=TELEGRAM_TOKEN, session=session)
+else:
+    logger.info("Инициализация бота без прокси (напрямую).")
+    bot = Bot(token=TELEGRAM_TOKEN)
+
+# Состояния сценариев — в Redis с TTL (fsm_storage): переживают рестарт, общие для нескольких процессов
+dp = Dispatcher(storage=fsm_storage)
+
+# Регистрируем мидлвари — сначала фильтр групп (чтобы он прерывал обработку при необходимости),
+# затем мидлварь ошибок (чтобы ловить исключения в хендлерах)
+dp.message.middleware(GroupFilterMiddleware())
+dp.callback_query.middleware(GroupFilterMiddleware())
+
+dp.message.middleware(ErrorMiddleware())
+dp.callback_query.middleware(ErrorMiddleware())
+
+# ---------------------------------------------------------
+# Подключаем роутеры
+# ---------------------------------------------------------
+dp.include_router(commands_router)
+dp.include_router(add_router)
+dp.include_router(return_router)
+dp.include_router(expenses_router)
+
+# ---------------------------------------------------------
+# Startup / Shutdown
+# ---------------------------------------------------------
+async def on_startup():
+    global BOT_USERNAME
+    try:
+        me = await bot.get_me()
+        BOT_USERNAME = (me.username or "").lower()
+        logger.info(f"Bot username cached: {BOT_USERNAME}")
+    except Exception as e:
+        logger.warning(f"Не удалось получить username бота на старте: {e}")
+        BOT_USERNAME = None
+
+    # Данные со старых имён ключей (до REDIS_KEY_PREFIX) — до первого чтения очередей и журнала
+    await migrate_legacy_keys()
+    start_cache_invalidation()
+    await start_sheets_backend()
+    await proverkacheka_client.start()
+    start_qr_decoder()
+    recognition_queue.start()
+
+    # Справочник пользователей: лист AllowedUsers → память + Redis-хэш (если лист недоступен — из хэша при первой проверке)
+    await load_allowed_users(from_sheet=True)
+
+    # Зеркало Чеки!A:Q: полная загрузка один раз, дальше — дочитка хвоста
+    try:
+        await load_receipts_mirror()
+        await rebuild_fiscal_index()
+    except Exception as e:
+        logger.warning(f"Не удалось загрузить зеркало Чеки на старте (загрузится при первом чтении): {e}")
+    scheduler.add_job(sync_receipts_tail, IntervalTrigger(seconds=RECEIPTS_SYNC_INTERVAL), max_instances=1)
+    scheduler.add_job(refresh_receipts_mirror, IntervalTrigger(seconds=RECEIPTS_FULL_SYNC_INTERVAL), max_instances=1)
+    # Сверка оптимистичного баланса с I1/L1/O1 (читает лист, только если были операции)
+    scheduler.add_job(reconcile_balance, IntervalTrigger(seconds=BALANCE_RECONCILE_INTERVAL), max_instances=1)
+    # Чеки с code=2 («ещё не готовы»): опрос отложенных проверок, продолжение /add_manual в чате
+    scheduler.add_job(poll_deferred_checks, IntervalTrigger(seconds=DEFERRED_POLL_INTERVAL), args=[bot, dp.storage], max_instances=1)
+
+    logger.info("Бот запущен, уведомления стартуют")
+    start_notifications(bot)
+
+async def on_shutdown():
+    logger.info("Shutdown: stopping scheduler and closing bot session")
+    scheduler.shutdown(wait=True)
+    await recognition_queue.stop()
+    await close_sheets_backend()
+    await proverkacheka_client.close()
+    shutdown_qr_decoder()
+    await stop_cache_invalidation()
+    await bot.session.close()
+
+def signal_handler(signum, frame):
+    logger.info("Received signal, shutting down...")
+    asyncio.create_task(on_shutdown())
+
+# ---------------------------------------------------------
+# Запуск (точка входа — main.py)
+# ---------------------------------------------------------
+def run() -> None:
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+
+    # Обработка сигналов
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
+    try:
+        asyncio.run(dp.start_polling(bot))
+    except KeyboardInterrupt:
+        logger.info("KeyboardInterrupt, shutting down")
+    except Exception as e:
+        logger.error(f"Ошибка при запуске бота: {str(e)}")
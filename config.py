@@ -55,4 +55,105 @@ required = [
 for var, name in required:
     if not var:
         logger.error(f"{name} not set in .env")
-        raise SystemExit(f"{name} not set in .env")
\ No newline at end of file
+        raise SystemExit(f"{name} not set in .env")
+# Зеркало листа Чеки: дочитка хвоста и полная перезагрузка (секунды)
+RECEIPTS_SYNC_INTERVAL = int(os.getenv("RECEIPTS_SYNC_INTERVAL", 60))
+RECEIPTS_FULL_SYNC_INTERVAL = int(os.getenv("RECEIPTS_FULL_SYNC_INTERVAL", 3600))
+
+# Индекс фискальных номеров: Bloom-фильтр в памяти перед Redis set (по умолчанию выключен).
+# Фильтр видит чеки других процессов бота только после дочитки хвоста, поэтому
+# включать (FISCAL_BLOOM_ENABLED=1) можно лишь при единственном процессе.
+FISCAL_BLOOM_ENABLED = os.getenv("FISCAL_BLOOM_ENABLED", "0").strip() not in ("0", "false", "no")
+FISCAL_BLOOM_CAPACITY = int(os.getenv("FISCAL_BLOOM_CAPACITY", 200000))
+FISCAL_BLOOM_ERROR_RATE = float(os.getenv("FISCAL_BLOOM_ERROR_RATE", 0.001))
+
+# Окно склейки append'ов в Google Sheets (мс): строки от одновременных подтверждений
+# уходят одним запросом на диапазон
+SHEETS_APPEND_WINDOW_MS = int(os.getenv("SHEETS_APPEND_WINDOW_MS", 150))
+
+# Пул потоков для запросов к Google Sheets (у каждого потока свой HTTP-клиент)
+SHEETS_POOL_SIZE = int(os.getenv("SHEETS_POOL_SIZE", 8))
+SHEETS_HTTP_TIMEOUT = int(os.getenv("SHEETS_HTTP_TIMEOUT", 60))
+
+# Backend Google Sheets: "threads" (googleapiclient в пуле потоков) или
+# "aiohttp" (прямые REST-запросы через одну keep-alive сессию)
+SHEETS_BACKEND = os.getenv("SHEETS_BACKEND", "threads").strip().lower()
+SHEETS_AIO_POOL_SIZE = int(os.getenv("SHEETS_AIO_POOL_SIZE", 10))
+if SHEETS_BACKEND not in ("threads", "aiohttp"):
+    logger.warning(f"Unknown SHEETS_BACKEND={SHEETS_BACKEND}, using threads")
+    SHEETS_BACKEND = "threads"
+
+# Квоты Google Sheets на service account (запросов в минуту) и повторы на 429
+SHEETS_READ_PER_MINUTE = int(os.getenv("SHEETS_READ_PER_MINUTE", 60))
+SHEETS_WRITE_PER_MINUTE = int(os.getenv("SHEETS_WRITE_PER_MINUTE", 60))
+SHEETS_RATE_BURST = int(os.getenv("SHEETS_RATE_BURST", 10))
+SHEETS_MAX_RETRIES = int(os.getenv("SHEETS_MAX_RETRIES", 4))
+SHEETS_BACKOFF_BASE = float(os.getenv("SHEETS_BACKOFF_BASE", 2))
+SHEETS_BACKOFF_MAX = float(os.getenv("SHEETS_BACKOFF_MAX", 60))
+
+# Сверка оптимистичного баланса (журнал операций) с формулами Сводки, сек
+BALANCE_RECONCILE_INTERVAL = int(os.getenv("BALANCE_RECONCILE_INTERVAL", 30))
+BALANCE_RECONCILE_DELAY = int(os.getenv("BALANCE_RECONCILE_DELAY", 5))
+
+# proverkacheka.com: адрес API (для нагрузочных тестов — локальная заглушка tools/proverkacheka_stub.py)
+PROVERKACHEKA_BASE_URL = os.getenv("PROVERKACHEKA_BASE_URL", "https://proverkacheka.com").strip().rstrip("/")
+
+# proverkacheka.com: общая сессия (соединений в пуле, таймауты запроса/подключения, сек)
+PROVERKACHEKA_POOL_SIZE = int(os.getenv("PROVERKACHEKA_POOL_SIZE", 10))
+PROVERKACHEKA_TIMEOUT = int(os.getenv("PROVERKACHEKA_TIMEOUT", 30))
+PROVERKACHEKA_CONNECT_TIMEOUT = int(os.getenv("PROVERKACHEKA_CONNECT_TIMEOUT", 10))
+
+# proverkacheka.com: повторы (попыток, общий дедлайн ручного ввода / QR, backoff, пауза на code=3), сек
+PROVERKACHEKA_MAX_ATTEMPTS = int(os.getenv("PROVERKACHEKA_MAX_ATTEMPTS", 4))
+PROVERKACHEKA_DEADLINE = int(os.getenv("PROVERKACHEKA_DEADLINE", 180))
+PROVERKACHEKA_QR_DEADLINE = int(os.getenv("PROVERKACHEKA_QR_DEADLINE", 60))
+PROVERKACHEKA_BACKOFF_BASE = float(os.getenv("PROVERKACHEKA_BACKOFF_BASE", 2))
+PROVERKACHEKA_BACKOFF_MAX = float(os.getenv("PROVERKACHEKA_BACKOFF_MAX", 30))
+PROVERKACHEKA_RATE_LIMIT_DELAY = float(os.getenv("PROVERKACHEKA_RATE_LIMIT_DELAY", 60))
+
+# proverkacheka.com: предохранитель — сбоев подряд до отключения, пауза до пробного запроса (сек)
+PROVERKACHEKA_BREAKER_THRESHOLD = int(os.getenv("PROVERKACHEKA_BREAKER_THRESHOLD", 5))
+PROVERKACHEKA_BREAKER_RESET = float(os.getenv("PROVERKACHEKA_BREAKER_RESET", 60))
+
+# Кэш ответов proverkacheka (по qrraw, fn-fd-fp и хэшу фото), сек
+RECEIPT_CACHE_TTL = int(os.getenv("RECEIPT_CACHE_TTL", 30 * 24 * 3600))
+
+# Локальное распознавание QR на фото (OpenCV или pyzbar, если установлены)
+QR_DECODE_ENABLED = os.getenv("QR_DECODE_ENABLED", "1").strip() not in ("0", "false", "no")
+QR_DECODE_WORKERS = int(os.getenv("QR_DECODE_WORKERS", 2))
+QR_DECODE_TIMEOUT = float(os.getenv("QR_DECODE_TIMEOUT", 10))
+
+# Очередь распознавания чеков: воркеров, мест в очереди, фото на пользователя, таймаут задачи (сек)
+RECOGNITION_WORKERS = int(os.getenv("RECOGNITION_WORKERS", 4))
+RECOGNITION_QUEUE_SIZE = int(os.getenv("RECOGNITION_QUEUE_SIZE", 100))
+RECOGNITION_PER_USER = int(os.getenv("RECOGNITION_PER_USER", 2))
+RECOGNITION_JOB_TIMEOUT = float(os.getenv("RECOGNITION_JOB_TIMEOUT", 120))
+
+# Отложенная догрузка чеков с code=2: окно ожидания, пауза между проверками (от/до),
+# повтор, если пользователь занят другим сценарием, и период опроса, сек
+DEFERRED_CHECK_WINDOW = int(os.getenv("DEFERRED_CHECK_WINDOW", 6 * 3600))
+DEFERRED_BASE_DELAY = int(os.getenv("DEFERRED_BASE_DELAY", 60))
+DEFERRED_MAX_DELAY = int(os.getenv("DEFERRED_MAX_DELAY", 1800))
+DEFERRED_BUSY_DELAY = int(os.getenv("DEFERRED_BUSY_DELAY", 300))
+DEFERRED_POLL_INTERVAL = int(os.getenv("DEFERRED_POLL_INTERVAL", 30))
+
+# Локальный уровень кэша перед Redis (в памяти процесса): ключей максимум и TTL, сек.
+# Инвалидация между процессами — через Redis pub/sub; 0 в CACHE_LOCAL_MAXSIZE отключает уровень.
+CACHE_LOCAL_MAXSIZE = int(os.getenv("CACHE_LOCAL_MAXSIZE", 1024))
+CACHE_LOCAL_TTL = float(os.getenv("CACHE_LOCAL_TTL", 60))
+# Кодек значений кэша: auto — orjson, если установлен, иначе json; json — всегда json
+CACHE_CODEC = os.getenv("CACHE_CODEC", "auto").strip().lower()
+
+# FSM в Redis: TTL незавершённого сценария по умолчанию, сек (по группам — fsm_storage.STATE_TTLS);
+# значения данных сценария длиннее порога (байт) хранятся отдельными ключами по хэшу
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 6 * 3600))
+FSM_BLOB_THRESHOLD = int(os.getenv("FSM_BLOB_THRESHOLD", 2048))
+
+# Redis: номер базы, префикс всех ключей бота (можно делить Redis с другими приложениями)
+# и размер пачки SCAN/UNLINK при очистке пространства ключей (/flush_cache)
+REDIS_DB = int(os.getenv("REDIS_DB", 0))
+# Пул соединений: сверх REDIS_MAX_CONNECTIONS команды ждут свободное соединение до REDIS_POOL_TIMEOUT сек
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 10))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "accbot").strip().strip(":") or "accbot"
+REDIS_UNLINK_BATCH = int(os.getenv("REDIS_UNLINK_BATCH", 500))
@@ -0,0 +1,151 @@
+"""
+Отложенная догрузка чеков, которые proverkacheka ещё не отдаёт (code=2).
+
+Запрос сохраняется в Redis: zset deferred_checks (score — время следующей
+проверки) + JSON в deferred_check:<id>, поэтому переживает перезапуск бота.
+poll_deferred_checks (задача планировщика) повторяет запрос с растущей паузой,
+пока не истечёт DEFERRED_CHECK_WINDOW. Когда данные появились, вызывается
+обработчик, зарегистрированный для вида запроса (register_deferred_handler), —
+он продолжает сценарий добавления в чате пользователя.
+"""
+import json
+import logging
+import time
+import uuid
+from types import SimpleNamespace
+from typing import Awaitable, Callable
+
+from aiogram import Bot
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+from config import DEFERRED_CHECK_WINDOW, DEFERRED_BASE_DELAY, DEFERRED_MAX_DELAY, DEFERRED_BUSY_DELAY
+from utils import redis_client, redis_key, confirm_manual_api, CHECK_NOT_READY_MSG
+from proverkacheka import proverkacheka_breaker, SERVICE_DEGRADED_MSG
+
+logger = logging.getLogger("AccountingBot")
+
+DEFERRED_ZSET_KEY = redis_key("deferred", "queue")
+DEFERRED_PAYLOAD_PREFIX = redis_key("deferred", "check") + ":"
+DEFERRED_BATCH = 20  # Сколько созревших проверок обрабатываем за один проход
+DEFERRED_MAX_FAILURES = 3  # Ошибок подряд (кроме code=2), после которых сдаёмся
+
+# kind -> async (bot, state, payload, parsed_data) -> bool; False — пользователь занят, повторить позже
+DeferredHandler = Callable[[Bot, FSMContext, dict, dict], Awaitable[bool]]
+_handlers: dict[str, DeferredHandler] = {}
+
+
+def register_deferred_handler(kind: str, handler: DeferredHandler) -> None:
+    _handlers[kind] = handler
+
+
+def _next_delay(attempt: int) -> float:
+    return min(DEFERRED_MAX_DELAY, DEFERRED_BASE_DELAY * 2 ** attempt)
+
+
+async def _save(payload: dict, due: float) -> None:
+    ttl = max(int(payload["deadline"] - time.time()) + 3600, 60)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.set(DEFERRED_PAYLOAD_PREFIX + payload["id"], json.dumps(payload, ensure_ascii=False), ex=ttl)
+        pipe.zadd(DEFERRED_ZSET_KEY, {payload["id"]: due})
+        await pipe.execute()
+
+
+async def _drop(check_id: str) -> None:
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(DEFERRED_PAYLOAD_PREFIX + check_id)
+        pipe.zrem(DEFERRED_ZSET_KEY, check_id)
+        await pipe.execute()
+
+
+async def schedule_deferred_check(kind: str, data: dict, chat_id: int, user_id: int, username: str = "") -> str:
+    """Ставит запрос (поля ручного ввода fn/fd/fp/s/date/time/op_type) на отложенную проверку."""
+    now = time.time()
+    payload = {
+        "id": uuid.uuid4().hex,
+        "kind": kind,
+        "data": data,
+        "chat_id": chat_id,
+        "user_id": user_id,
+        "username": username,
+        "attempt": 0,
+        "created": now,
+        "deadline": now + DEFERRED_CHECK_WINDOW,
+    }
+    await _save(payload, now + _next_delay(0))
+    logger.info(f"Отложенная проверка чека поставлена: id={payload['id']}, fd={data.get('fd')}, user_id={user_id}")
+    return payload["id"]
+
+
+async def pending_deferred_count() -> int:
+    try:
+        return await redis_client.zcard(DEFERRED_ZSET_KEY)
+    except Exception as e:
+        logger.error(f"Ошибка чтения очереди отложенных чеков: {str(e)}")
+        return 0
+
+
+async def _process(bot: Bot, storage: BaseStorage, payload: dict) -> None:
+    data = payload["data"]
+    now = time.time()
+    success, msg, parsed_data = await confirm_manual_api(data, SimpleNamespace(id=payload["user_id"]))
+
+    if success and parsed_data:
+        handler = _handlers.get(payload["kind"])
+        state = FSMContext(storage=storage, key=StorageKey(bot_id=bot.id, chat_id=payload["chat_id"], user_id=payload["user_id"]))
+        if handler is not None and not await handler(bot, state, payload, parsed_data):
+            # Пользователь в другом сценарии — данные уже в кэше чеков, спросим позже
+            if now + DEFERRED_BUSY_DELAY < payload["deadline"]:
+                await _save(payload, now + DEFERRED_BUSY_DELAY)
+                return
+            await bot.send_message(payload["chat_id"], f"✅ Чек ФД {data.get('fd')} готов. Добавьте его через /add_manual — ответ уже сохранён.")
+        await _drop(payload["id"])
+        logger.info(f"Отложенная проверка завершена: id={payload['id']}, fiscal_doc={parsed_data.get('fiscal_doc')}")
+        return
+
+    # code=2 и недоступный сервис ждём до конца окна; прочие ошибки (сеть, лимиты, отказ API) — не больше DEFERRED_MAX_FAILURES подряд
+    not_ready = msg in (CHECK_NOT_READY_MSG, SERVICE_DEGRADED_MSG)
+    payload["failures"] = 0 if not_ready else payload.get("failures", 0) + 1
+    if not_ready or payload["failures"] < DEFERRED_MAX_FAILURES:
+        payload["attempt"] += 1
+        due = now + _next_delay(payload["attempt"])
+        if due < payload["deadline"]:
+            await _save(payload, due)
+            logger.info(f"Чек id={payload['id']} не получен ({msg}), следующая проверка через {due - now:.0f}s")
+            return
+        if not_ready:
+            reason = "ФНС так и не отдала чек" if msg == CHECK_NOT_READY_MSG else "Сервис проверки чеков не отвечал, чек"
+            msg = f"⌛ {reason} ФД {data.get('fd')} за {DEFERRED_CHECK_WINDOW // 3600} ч. Попробуйте /add_manual позже."
+
+    await _drop(payload["id"])
+    await bot.send_message(payload["chat_id"], f"{msg}\nЧек: ФН {data.get('fn')}, ФД {data.get('fd')}, ФП {data.get('fp')}")
+    logger.warning(f"Отложенная проверка не удалась: id={payload['id']}, {msg}")
+
+
+async def poll_deferred_checks(bot: Bot, storage: BaseStorage) -> None:
+    """Задача планировщика: обрабатывает созревшие отложенные проверки."""
+    if proverkacheka_breaker.is_open:
+        return  # Сервис недоступен — проверки дождутся пробного запроса, попытки не тратим
+    try:
+        due_ids = await redis_client.zrangebyscore(DEFERRED_ZSET_KEY, 0, time.time(), start=0, num=DEFERRED_BATCH)
+    except Exception as e:
+        logger.error(f"Ошибка чтения очереди отложенных чеков: {str(e)}")
+        return
+
+    for check_id in due_ids:
+        # ZREM как захват: при нескольких экземплярах проверку обработает один
+        if not await redis_client.zrem(DEFERRED_ZSET_KEY, check_id):
+            continue
+        raw = await redis_client.get(DEFERRED_PAYLOAD_PREFIX + check_id)
+        if not raw:
+            continue
+        payload = json.loads(raw)
+        try:
+            await _process(bot, storage, payload)
+        except Exception as e:
+            logger.error(f"Ошибка отложенной проверки id={check_id}: {type(e).__name__}: {e}")
+            # Не теряем запрос из-за сбоя Telegram/Redis — вернём в расписание
+            if time.time() + DEFERRED_BASE_DELAY < payload["deadline"]:
+                await _save(payload, time.time() + DEFERRED_BASE_DELAY)
+            else:
+                await _drop(check_id)
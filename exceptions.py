@@ -1,119 +1,288 @@
+import asyncio
 import json
 import os
-from typing import List, Set
+import re
+import tempfile
+import time
+from typing import List
 import logging
 
 logger = logging.getLogger("AccountingBot")
 
 EXCEPTIONS_FILE = "excluded_items.json"
 DEFAULT_EXCLUDED_ITEMS = [
-    "Сервисный сбор",
-    "Обработка заказа в пункте выдачи",
-    "Доставка",
-    "Пункт выдачи"  # Added from your log
+    "token:сервисный сбор",
+    "обработка заказа в пункте выдачи",
+    "token:доставка",
+    "пункт выдачи"  # Added from your log
 ]
 
-# Global cache: ORIGINALS for display/save, LOWERED_SET for fast case-insensitive match
+# Правила в excluded_items.json:
+#   "доставка"          — точное совпадение названия (регистр и лишние пробелы не важны)
+#   "token:доставка"    — целое слово/фраза внутри названия: "Доставка до пункта выдачи"
+#   "contains:сбор"     — подстрока где угодно: "Сервисныйсбор", "Сбор5%"
+RULE_KINDS = ("token", "contains")
+RELOAD_CHECK_INTERVAL = 2.0  # Не чаще раза в 2 сек stat() файла — is_excluded зовётся на каждую позицию
+
+_SPACES_RE = re.compile(r"\s+")
+
+
+def _normalize(text: str) -> str:
+    """Lower + ё→е + схлопнутые пробелы: так сравниваются и правила, и названия."""
+    return _SPACES_RE.sub(" ", text.lower().replace("ё", "е")).strip()
+
+
+def _parse_rule(rule: str) -> tuple[str, str]:
+    """'token:Доставка' → ('token', 'доставка'); без префикса — ('exact', ...)."""
+    prefix, sep, rest = rule.partition(":")
+    kind = prefix.strip().lower()
+    if sep and kind in RULE_KINDS:
+        return kind, _normalize(rest)
+    return "exact", _normalize(rule)
+
+
+def _rule_key(rule: str) -> str:
+    """Ключ для дедупликации/удаления: вид правила + нормализованный текст."""
+    kind, pattern = _parse_rule(rule)
+    return pattern if kind == "exact" else f"{kind}:{pattern}"
+
+
+class ExclusionMatcher:
+    """
+    Скомпилированный набор правил. Точные — set, token/contains — один автомат
+    Ахо-Корасик по всем паттернам: проверка названия O(len(name)) независимо от
+    числа правил.
+    """
+
+    def __init__(self, rules: List[str]):
+        self.exact: set[str] = set()
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        # Для каждого состояния: (длина паттерна, нужна граница слова) всех паттернов, заканчивающихся здесь
+        self.out: list[list[tuple[int, bool]]] = [[]]
+
+        for rule in rules:
+            if not isinstance(rule, str):
+                continue
+            kind, pattern = _parse_rule(rule)
+            if not pattern:
+                continue
+            if kind == "exact":
+                self.exact.add(pattern)
+            else:
+                self._add_pattern(pattern, kind == "token")
+        self._build_failure_links()
+
+    def _add_pattern(self, pattern: str, whole_word: bool):
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append([])
+            state = next_state
+        self.out[state].append((len(pattern), whole_word))
+
+    def _build_failure_links(self):
+        queue = list(self.goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                self.out[next_state] = self.out[next_state] + self.out[self.fail[next_state]]
+
+    @property
+    def has_patterns(self) -> bool:
+        return len(self.goto) > 1
+
+    def matches(self, name: str) -> bool:
+        text = _normalize(name)
+        if not text:
+            return False
+        if text in self.exact:
+            return True
+        if not self.has_patterns:
+            return False
+
+        goto, fail, out = self.goto, self.fail, self.out
+        state = 0
+        last = len(text) - 1
+        for pos, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length, whole_word in out[state]:
+                if not whole_word:
+                    return True
+                start = pos - length + 1
+                if (start == 0 or not text[start - 1].isalnum()) and (pos == last or not text[pos + 1].isalnum()):
+                    return True
+        return False
+
+
+# Global cache: ORIGINALS for display/save, MATCHER for is_excluded
 ORIGINALS: List[str] | None = None
-LOWERED_SET: Set[str] | None = None
+MATCHER: ExclusionMatcher | None = None
+_loaded_mtime: float | None = None
+_last_check = 0.0
+
+
+def _file_mtime() -> float | None:
+    try:
+        return os.stat(EXCEPTIONS_FILE).st_mtime
+    except OSError:
+        return None
+
+
+def _apply(items: List[str], mtime: float | None):
+    global ORIGINALS, MATCHER, _loaded_mtime
+    ORIGINALS = items
+    MATCHER = ExclusionMatcher(items)
+    _loaded_mtime = mtime
+
+
+def _read_file() -> List[str] | None:
+    try:
+        with open(EXCEPTIONS_FILE, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, list):
+            return [item for item in data if isinstance(item, str) and item.strip()]
+        logger.warning("Invalid exclusions file, using defaults")
+    except Exception as e:
+        logger.error(f"Error loading exclusions: {e}")
+    return None
 
-def _load_excluded_items() -> tuple[List[str], Set[str]]:
-    """Internal: Load once from file, return originals + lowered set. Log only first."""
-    global ORIGINALS, LOWERED_SET
-    if ORIGINALS is not None:
-        return ORIGINALS, LOWERED_SET  # Already cached
 
-    if os.path.exists(EXCEPTIONS_FILE):
+def _write_file(items: List[str]):
+    """Пишет во временный файл рядом и подменяет os.replace: перечитка по mtime не увидит полузаписанный JSON."""
+    directory = os.path.dirname(os.path.abspath(EXCEPTIONS_FILE))
+    fd, tmp_path = tempfile.mkstemp(prefix=".excluded_items.", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(items, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
         try:
-            with open(EXCEPTIONS_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, list):
-                    ORIGINALS = data
-                    LOWERED_SET = {item.lower().strip() for item in data if item.strip()}
-                    logger.info(f"Loaded exclusions: {len(ORIGINALS)} items (sample: {ORIGINALS[:2]})")  # FIX: Once, short sample
-                    return ORIGINALS, LOWERED_SET
-                else:
-                    logger.warning("Invalid exclusions file, using defaults")
-        except Exception as e:
-            logger.error(f"Error loading exclusions: {e}")
+            os.chmod(tmp_path, os.stat(EXCEPTIONS_FILE).st_mode & 0o777)  # mkstemp создаёт 0600
+        except OSError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, EXCEPTIONS_FILE)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _load_excluded_items() -> tuple[List[str], ExclusionMatcher]:
+    """Internal: Load once from file, reload when mtime changes (checked at most every RELOAD_CHECK_INTERVAL)."""
+    global _last_check
+    now = time.monotonic()
+    if ORIGINALS is not None and now - _last_check < RELOAD_CHECK_INTERVAL:
+        return ORIGINALS, MATCHER
+    _last_check = now
+
+    mtime = _file_mtime()
+    if ORIGINALS is not None and mtime == _loaded_mtime:
+        return ORIGINALS, MATCHER
+
+    if mtime is not None:
+        items = _read_file()
+        if items is not None:
+            reloaded = ORIGINALS is not None
+            _apply(items, mtime)
+            logger.info(f"{'Reloaded' if reloaded else 'Loaded'} exclusions: {len(items)} items (sample: {items[:2]})")
+            return ORIGINALS, MATCHER
+        if ORIGINALS is not None:
+            # Файл битый (например, правят руками) — работаем на прежних правилах
+            _apply(ORIGINALS, mtime)
+            return ORIGINALS, MATCHER
     else:
         logger.debug("No exclusions file, using defaults")
 
-    # Fallback: Save defaults
-    save_excluded_items(DEFAULT_EXCLUDED_ITEMS)
-    ORIGINALS = DEFAULT_EXCLUDED_ITEMS
-    LOWERED_SET = {item.lower().strip() for item in ORIGINALS}
-    return ORIGINALS, LOWERED_SET
+    # Fallback: Save defaults (один раз при старте, синхронно)
+    items = list(DEFAULT_EXCLUDED_ITEMS)
+    try:
+        _write_file(items)
+    except Exception as e:
+        logger.error(f"Error saving exclusions: {e}")
+    _apply(items, _file_mtime())
+    return ORIGINALS, MATCHER
+
 
 def load_excluded_items() -> List[str]:
     """Public: Returns originals (for display/save). Cached."""
     originals, _ = _load_excluded_items()
     return originals
 
+
 def get_excluded_items() -> List[str]:
     """Returns originals (for UI/list). Cached."""
     return load_excluded_items()  # Now cached, no log
 
-def save_excluded_items(items: List[str]):
-    """Saves originals. Updates cache. Log always (rare)."""
-    global ORIGINALS, LOWERED_SET
+
+async def save_excluded_items(items: List[str]) -> bool:
+    """Saves originals in a worker thread, then swaps the compiled matcher. Log always (rare)."""
     try:
-        with open(EXCEPTIONS_FILE, "w", encoding="utf-8") as f:
-            json.dump(items, f, ensure_ascii=False, indent=2)
-        ORIGINALS = items
-        LOWERED_SET = {item.lower().strip() for item in items if item.strip()}
-        logger.info(f"Saved exclusions: {len(items)} items (sample: {items[:2]})")  # Short
+        await asyncio.to_thread(_write_file, items)
     except Exception as e:
         logger.error(f"Error saving exclusions: {e}")
+        return False
+    _apply(items, _file_mtime())
+    logger.info(f"Saved exclusions: {len(items)} items (sample: {items[:2]})")  # Short
+    return True
 
-def add_excluded_item(item: str) -> bool:
-    """Adds if not exists (case-insensitive). Saves originals."""
+
+async def add_excluded_item(item: str) -> bool:
+    """Adds if not exists (case-insensitive, same rule kind). Saves originals."""
     if not item or not item.strip():
         return False
     item = item.strip()  # Original case
 
-    _, lowered_set = _load_excluded_items()  # Cache safe
-    lower_item = item.lower()
-
-    if lower_item in lowered_set:
+    originals, _ = _load_excluded_items()
+    key = _rule_key(item)
+    if not key or key in {_rule_key(orig) for orig in originals}:
         logger.debug(f"Excluded item '{item}' already exists (case-insensitive)")
         return False
 
-    # Add original
-    ORIGINALS.append(item)  # Assume loaded, append to global
-    lowered_set.add(lower_item)
-    save_excluded_items(ORIGINALS)  # Save + log
+    if not await save_excluded_items(originals + [item]):
+        return False
     logger.info(f"Added excluded item: '{item}'")
     return True
 
-def remove_excluded_item(item: str) -> bool:
-    """Removes by case-insensitive match. Saves originals."""
+
+async def remove_excluded_item(item: str) -> bool:
+    """Removes by case-insensitive match of the whole rule (with token:/contains: prefix). Saves originals."""
     if not item or not item.strip():
         return False
-    lower_item = item.lower().strip()
-
-    originals, lowered_set = _load_excluded_items()  # Cache safe
-    removed = False
-    new_originals = []
-    for orig in originals:
-        if orig.lower().strip() != lower_item:
-            new_originals.append(orig)
-        else:
-            removed = True
-            logger.debug(f"Removing excluded item: '{orig}'")
-
-    if removed:
-        ORIGINALS = new_originals
-        lowered_set.discard(lower_item)
-        save_excluded_items(ORIGINALS)  # Save + log
-        logger.info(f"Removed excluded item: '{item}'")
-        return True
-    logger.debug(f"Excluded item '{item}' not found")
-    return False
+    key = _rule_key(item.strip())
+
+    originals, _ = _load_excluded_items()
+    new_originals = [orig for orig in originals if _rule_key(orig) != key]
+    if len(new_originals) == len(originals):
+        logger.debug(f"Excluded item '{item}' not found")
+        return False
+
+    if not await save_excluded_items(new_originals):
+        return False
+    logger.info(f"Removed excluded item: '{item}'")
+    return True
+
 
 def is_excluded(item_name: str) -> bool:
-    """Case-insensitive match. Cached, no log."""
+    """Exact / token / contains match via compiled matcher. Cached, no log."""
     if not item_name or not item_name.strip():
         return False
-    _, lowered_set = _load_excluded_items()  # Cache safe, no log
-    return item_name.lower().strip() in lowered_set
\ No newline at end of file
+    _, matcher = _load_excluded_items()
+    return matcher.matches(item_name)
@@ -0,0 +1,168 @@
+"""
+FSM-хранилище в Redis: состояния сценариев (/add, /add_manual, /return, /expenses)
+переживают рестарт, общие для нескольких процессов бота и истекают сами.
+
+- TTL по группе состояний (STATE_TTLS), остальным — FSM_STATE_TTL. Брошенный
+  сценарий удаляется Redis, память на пользователя ограничена.
+- set_state продлевает данные сценария под TTL нового состояния.
+- Крупные значения данных (parsed_data, receipt, pending_groups — всё, что в
+  кодированном виде длиннее FSM_BLOB_THRESHOLD) выносятся в отдельные ключи по
+  хэшу содержимого; в данных остаётся ссылка {"$blob": "<sha1>"}. Один и тот же
+  чек у разных пользователей и на разных шагах хранится один раз.
+- Кодирование — cache_codec (orjson, если установлен), как и у кэша.
+"""
+import hashlib
+import logging
+from typing import Any, Dict, Optional
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType, StorageKey
+from aiogram.fsm.storage.redis import DefaultKeyBuilder, RedisStorage
+
+from config import FSM_STATE_TTL, FSM_BLOB_THRESHOLD
+from utils import redis_client, redis_key, cache_codec
+
+logger = logging.getLogger("AccountingBot")
+
+FSM_KEY_PREFIX = redis_key("fsm")
+BLOB_REF = "$blob"
+
+# Вынесенные значения общие для всех, кто на них ссылается, поэтому TTL только
+# продлевается: SET NX EX для нового ключа, EXPIRE — лишь если текущий TTL короче.
+# Скрипт, а не EXPIRE GT: тот есть только с Redis 7. ARGV[1] — TTL, дальше — значения (необязательно).
+KEEP_BLOBS_LUA = """
+local ttl = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    local value = ARGV[i + 1]
+    if not (value and redis.call('SET', key, value, 'NX', 'EX', ttl)) then
+        local current = redis.call('TTL', key)
+        if current >= 0 and current < ttl then
+            redis.call('EXPIRE', key, ttl)
+        end
+    end
+end
+return #KEYS
+"""
+
+# TTL незавершённого сценария по группе состояний (имя StatesGroup), сек
+STATE_TTLS = {
+    "AddManualAPI": 30 * 60,       # Ввод ФН/ФД/ФП/суммы — минуты
+    "ReturnReceipt": 2 * 3600,
+    "ConfirmDelivery": 2 * 3600,
+}
+
+
+def state_ttl(state: Optional[str]) -> int:
+    """'AddManualAPI:FN' → TTL группы; без состояния и для прочих групп — FSM_STATE_TTL."""
+    if not state:
+        return FSM_STATE_TTL
+    return STATE_TTLS.get(state, STATE_TTLS.get(state.split(":", 1)[0], FSM_STATE_TTL))
+
+
+def _blob_ref(value: Any) -> Optional[str]:
+    if isinstance(value, dict) and len(value) == 1:
+        digest = value.get(BLOB_REF)
+        if isinstance(digest, str):
+            return digest
+    return None
+
+
+class BotStorage(RedisStorage):
+    """RedisStorage с TTL по состоянию и вынесенными крупными значениями."""
+
+    def __init__(self, redis, blob_threshold: int = FSM_BLOB_THRESHOLD):
+        super().__init__(
+            redis,
+            key_builder=DefaultKeyBuilder(prefix=FSM_KEY_PREFIX),
+            state_ttl=FSM_STATE_TTL,
+            data_ttl=FSM_STATE_TTL,
+            json_loads=cache_codec.loads,
+            json_dumps=cache_codec.dumps,
+        )
+        self.blob_threshold = blob_threshold
+        self._keep_blobs = redis.register_script(KEEP_BLOBS_LUA)
+
+    def _blob_key(self, digest: str) -> str:
+        return f"{FSM_KEY_PREFIX}:blob:{digest}"
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        state_key = self.key_builder.build(key, "state")
+        if state is None:
+            await self.redis.delete(state_key)
+            return
+
+        state_name = state.state if isinstance(state, State) else state
+        ttl = state_ttl(state_name)
+        data_key = self.key_builder.build(key, "data")
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.set(state_key, state_name, ex=ttl)
+            pipe.expire(data_key, ttl)
+            pipe.get(data_key)
+            _, _, raw = await pipe.execute()
+
+        # Вынесенные значения живут не меньше самих данных
+        refs = self._refs(raw)
+        if refs:
+            await self._keep_blobs(keys=[self._blob_key(digest) for digest in refs], args=[ttl])
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        data_key = self.key_builder.build(key, "data")
+        if not data:
+            # Вынесенные значения не трогаем: их может держать другой пользователь, истекут сами
+            await self.redis.delete(data_key)
+            return
+
+        ttl = state_ttl(await self.get_state(key))
+        stored: Dict[str, Any] = {}
+        blobs: Dict[str, str | bytes] = {}
+        for field, value in data.items():
+            encoded = self.json_dumps(value)
+            if len(encoded) > self.blob_threshold:
+                digest = hashlib.sha1(encoded if isinstance(encoded, bytes) else encoded.encode("utf-8")).hexdigest()
+                blobs[digest] = encoded
+                stored[field] = {BLOB_REF: digest}
+            else:
+                stored[field] = value
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            if blobs:
+                await self._keep_blobs(
+                    keys=[self._blob_key(digest) for digest in blobs], args=[ttl, *blobs.values()], client=pipe
+                )
+            pipe.set(data_key, self.json_dumps(stored), ex=ttl)
+            await pipe.execute()
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        data = await super().get_data(key)
+        refs = {field: digest for field, value in data.items() if (digest := _blob_ref(value))}
+        if not refs:
+            return data
+
+        values = await self.redis.mget([self._blob_key(digest) for digest in refs.values()])
+        for (field, digest), raw in zip(refs.items(), values):
+            if raw is None:
+                # Ключ истёк раньше данных (ручная чистка Redis) — поле считаем потерянным
+                logger.warning(f"FSM: вынесенное значение {field} ({digest[:8]}) не найдено, user_id={key.user_id}")
+                data.pop(field)
+            else:
+                data[field] = self.json_loads(raw)
+        return data
+
+    def _refs(self, raw: Optional[str | bytes]) -> list[str]:
+        if not raw:
+            return []
+        try:
+            data = self.json_loads(raw)
+        except ValueError:
+            return []
+        return [digest for value in data.values() if (digest := _blob_ref(value))]
+
+    async def close(self) -> None:
+        # Пул общий с utils.redis_client (кэш, очереди) — закрывать его здесь нельзя
+        pass
+
+
+fsm_storage = BotStorage(redis_client)
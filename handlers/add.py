@@ -13,14 +13,19 @@ from sheets import (
     get_monthly_balance,  # Для других частей, если нужно
     # NOVOYE: Импорт delta helpers из sheets.py
     compute_delta_balance,
-    update_balance_cache_with_delta
+    record_balance_event
 )
 
-from utils import parse_qr_from_photo, confirm_manual_api, safe_float, reset_keyboard, normalize_date
+from utils import parse_qr_from_photo, confirm_manual_api, safe_float, reset_keyboard, normalize_date, CHECK_NOT_READY_MSG
+from deferred import schedule_deferred_check, register_deferred_handler
+from config import DEFERRED_CHECK_WINDOW
 from handlers.notifications import send_notification
+from recognition import recognition_queue, RecognitionBusy
+from proverkacheka import proverkacheka_breaker, SERVICE_DEGRADED_MSG
 from googleapiclient.errors import HttpError
 import logging
 import asyncio
+import uuid
 from datetime import datetime
 import re
 import calendar
@@ -54,6 +59,33 @@ async def reset_action(message: Message, state: FSMContext) -> None:
     await message.answer("🔄 Действие сброшено. Вы можете начать заново.", reply_markup=ReplyKeyboardRemove())
     logger.info(f"Сброс состояний: user_id={message.from_user.id}")
 
+def _manual_entry_keyboard() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text="✍️ Ввести вручную", callback_data="goto_add_manual")]]
+    )
+
+# Фото распознаётся в очереди, а пользователь тем временем может начать /add_manual,
+# /return или прислать другое фото. Задача пишет в FSM, только если состояние то же,
+# что при постановке в очередь, и в данных всё ещё её метка recognition_job.
+async def _claim_recognition(state: FSMContext) -> tuple[str | None, str]:
+    token = uuid.uuid4().hex
+    await state.update_data(recognition_job=token)
+    return await state.get_state(), token
+
+async def _owns_state(state: FSMContext, expected_state: str | None, token: str) -> bool:
+    if await state.get_state() != expected_state:
+        return False
+    return (await state.get_data()).get("recognition_job") == token
+
+async def _start_customer_step(state: FSMContext, **data) -> None:
+    current = await state.get_data()
+    current.pop("recognition_job", None)
+    current.update(data)
+    await state.set_data(current)
+    await state.set_state(AddReceiptQR.CUSTOMER)
+
+STALE_RECOGNITION_MSG = "✅ QR-код распознан, но вы уже перешли к другому действию. Пришлите фото ещё раз, чтобы добавить этот чек."
+
 @add_router.message(StateFilter(None), F.photo)
 async def catch_qr_photo_without_command(message: Message, state: FSMContext, bot: Bot) -> None:
     if not await is_user_allowed(message.from_user.id):
@@ -61,25 +93,41 @@ async def catch_qr_photo_without_command(message: Message, state: FSMContext, bo
         logger.info(f"Доступ запрещен для авто-обработки QR: user_id={message.from_user.id}")
         return
 
-    loading = await message.answer("⌛ Обрабатываю фото чека...")
+    queued = recognition_queue.stats()["queued"]
+    loading = await message.answer(
+        "⌛ Обрабатываю фото чека..." + (f" (в очереди перед вами: {queued})" if queued else "")
+    )
+    file_id = message.photo[-1].file_id
+    expected_state, token = await _claim_recognition(state)
 
-    try:
-        parsed_data = await asyncio.wait_for(
-            parse_qr_from_photo(bot, message.photo[-1].file_id),
-            timeout=10.0
-        )
+    async def progress(text: str) -> None:
+        await loading.edit_text(text)
 
-        if not parsed_data:
-            inline_keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[[InlineKeyboardButton(text="✍️ Ввести вручную", callback_data="goto_add_manual")]]
+    async def clear_if_owned() -> None:
+        if await _owns_state(state, expected_state, token):
+            await state.clear()
+
+    # Выполняется воркером очереди распознавания; хендлер к этому моменту уже вернулся
+    async def run() -> None:
+        parsed_data = await parse_qr_from_photo(bot, file_id, progress=progress, is_unique=is_fiscal_doc_unique)
+
+        if not parsed_data and proverkacheka_breaker.is_open:
+            await loading.edit_text(
+                f"{SERVICE_DEGRADED_MSG}\nДобавьте чек вручную — данные запрошу, когда сервис заработает:",
+                reply_markup=_manual_entry_keyboard()
             )
+            logger.warning(f"Авто-QR: proverkacheka недоступен, предложен ручной ввод: user_id={message.from_user.id}")
+            await clear_if_owned()
+            return
+
+        if not parsed_data:
             await loading.edit_text(
                 "❌ QR-код не удалось распознать. Возможно, превышено количество обращений по чеку.\n"
                 "Вы можете попробовать снова или добавить чек вручную:",
-                reply_markup=inline_keyboard
+                reply_markup=_manual_entry_keyboard()
             )
             logger.error(f"Не удалось распознать QR-код: user_id={message.from_user.id}")
-            await state.clear()
+            await clear_if_owned()
             return
 
         if not await is_fiscal_doc_unique(parsed_data["fiscal_doc"]):
@@ -89,42 +137,45 @@ async def catch_qr_photo_without_command(message: Message, state: FSMContext, bo
             logger.info(
                 f"Авто-QR: дубликат фискального номера {parsed_data['fiscal_doc']}, user_id={message.from_user.id}"
             )
-            await state.clear()
+            await clear_if_owned()
+            return
+
+        if not await _owns_state(state, expected_state, token):
+            await loading.edit_text(STALE_RECOGNITION_MSG)
+            logger.info(f"Авто-QR: пользователь уже в другом сценарии, состояние не трогаем: user_id={message.from_user.id}")
             return
 
         await loading.edit_text("✅ QR-код распознан.")
         await message.answer("Введите заказчика (или /skip):", reply_markup=reset_keyboard())
-        await state.update_data(
+        await _start_customer_step(
+            state,
             username=message.from_user.username or str(message.from_user.id),
             parsed_data=parsed_data
         )
-        await state.set_state(AddReceiptQR.CUSTOMER)
         logger.info(
             f"Авто-старт /add по фото QR: fiscal_doc={parsed_data['fiscal_doc']}, "
             f"qr_string={parsed_data['qr_string']}, user_id={message.from_user.id}"
         )
 
-    except asyncio.TimeoutError:
-        inline_keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[[InlineKeyboardButton(text="✍️ Ввести вручную", callback_data="goto_add_manual")]]
-        )
-        await loading.edit_text(
-            "❌ Превышено время обработки QR-кода. Попробуйте снова или добавьте чек вручную:",
-            reply_markup=inline_keyboard
-        )
-        logger.error(f"Таймаут при обработке QR-кода: user_id={message.from_user.id}")
-        await state.clear()
-    except Exception as e:
-        inline_keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[[InlineKeyboardButton(text="✍️ Ввести вручную", callback_data="goto_add_manual")]]
-        )
-        await loading.edit_text(
-            f"⚠️ Ошибка при обработке фото: {str(e)}. Возможно, превышено количество обращений по чеку.\n"
-            "Попробуйте снова или добавьте чек вручную:",
-            reply_markup=inline_keyboard
-        )
-        logger.error(f"Ошибка обработки фото чека: {str(e)}, user_id={message.from_user.id}")
-        await state.clear()
+    async def on_error(e: BaseException) -> None:
+        if isinstance(e, asyncio.TimeoutError):
+            await loading.edit_text(
+                "❌ Превышено время обработки QR-кода. Попробуйте снова или добавьте чек вручную:",
+                reply_markup=_manual_entry_keyboard()
+            )
+        else:
+            await loading.edit_text(
+                f"⚠️ Ошибка при обработке фото: {str(e)}. Возможно, превышено количество обращений по чеку.\n"
+                "Попробуйте снова или добавьте чек вручную:",
+                reply_markup=_manual_entry_keyboard()
+            )
+        await clear_if_owned()
+
+    try:
+        recognition_queue.submit(message.from_user.id, run, on_error)
+    except RecognitionBusy as e:
+        await loading.edit_text(str(e))
+        logger.info(f"Авто-QR: очередь распознавания отклонила фото: {e}, user_id={message.from_user.id}")
 
 @add_router.callback_query(lambda c: c.data == "goto_add_manual")
 async def goto_add_manual(callback: CallbackQuery, state: FSMContext) -> None:
@@ -176,23 +227,51 @@ async def process_qr_upload(message: Message, state: FSMContext, bot: Bot) -> No
         await message.answer("Пожалуйста, отправьте фото QR-кода чека.", reply_markup=reset_keyboard())
         logger.info(f"Фото отсутствует для QR: user_id={message.from_user.id}")
         return
-    parsed_data = await parse_qr_from_photo(bot, message.photo[-1].file_id)
-    if not parsed_data:
-        await message.answer("Ошибка обработки QR-кода. Убедитесь, что QR-код четкий, или используйте /add_manual для ручного ввода.", reply_markup=reset_keyboard())
-        logger.error(f"Ошибка обработки QR-кода: user_id={message.from_user.id}")
-        await state.clear()
-        return
-    if not await is_fiscal_doc_unique(parsed_data["fiscal_doc"]):
-        await message.answer(f"Чек с фискальным номером {parsed_data['fiscal_doc']} уже существует.", reply_markup=reset_keyboard())
-        logger.info(f"Дубликат фискального номера: {parsed_data['fiscal_doc']}, user_id={message.from_user.id}")
-        await state.clear()
-        return
     loading_message = await message.answer("⌛ Обработка запроса... Пожалуйста, подождите.")
-    await state.update_data(parsed_data=parsed_data)
-    await message.answer("Введите заказчика (или /skip):", reply_markup=reset_keyboard())
-    await state.set_state(AddReceiptQR.CUSTOMER)
-    await loading_message.edit_text("QR-код обработан.")
-    logger.info(f"QR-код обработан: fiscal_doc={parsed_data['fiscal_doc']}, user_id={message.from_user.id}")
+    file_id = message.photo[-1].file_id
+    expected_state, token = await _claim_recognition(state)
+
+    async def progress(text: str) -> None:
+        await loading_message.edit_text(text)
+
+    async def clear_if_owned() -> None:
+        if await _owns_state(state, expected_state, token):
+            await state.clear()
+
+    async def run() -> None:
+        parsed_data = await parse_qr_from_photo(bot, file_id, progress=progress, is_unique=is_fiscal_doc_unique)
+        if not parsed_data and proverkacheka_breaker.is_open:
+            await loading_message.edit_text(f"{SERVICE_DEGRADED_MSG} Добавьте чек через /add_manual — данные запрошу, когда сервис заработает.")
+            logger.warning(f"QR: proverkacheka недоступен, предложен /add_manual: user_id={message.from_user.id}")
+            await clear_if_owned()
+            return
+        if not parsed_data:
+            await loading_message.edit_text("Ошибка обработки QR-кода. Убедитесь, что QR-код четкий, или используйте /add_manual для ручного ввода.")
+            logger.error(f"Ошибка обработки QR-кода: user_id={message.from_user.id}")
+            await clear_if_owned()
+            return
+        if not await is_fiscal_doc_unique(parsed_data["fiscal_doc"]):
+            await loading_message.edit_text(f"Чек с фискальным номером {parsed_data['fiscal_doc']} уже существует.")
+            logger.info(f"Дубликат фискального номера: {parsed_data['fiscal_doc']}, user_id={message.from_user.id}")
+            await clear_if_owned()
+            return
+        if not await _owns_state(state, expected_state, token):
+            await loading_message.edit_text(STALE_RECOGNITION_MSG)
+            logger.info(f"QR: пользователь уже в другом сценарии, состояние не трогаем: user_id={message.from_user.id}")
+            return
+        await _start_customer_step(state, parsed_data=parsed_data)
+        await message.answer("Введите заказчика (или /skip):", reply_markup=reset_keyboard())
+        await loading_message.edit_text("QR-код обработан.")
+        logger.info(f"QR-код обработан: fiscal_doc={parsed_data['fiscal_doc']}, user_id={message.from_user.id}")
+
+    async def on_error(e: BaseException) -> None:
+        await loading_message.edit_text("Ошибка обработки QR-кода. Попробуйте снова или используйте /add_manual для ручного ввода.")
+        await clear_if_owned()
+
+    try:
+        recognition_queue.submit(message.from_user.id, run, on_error)
+    except RecognitionBusy as e:
+        await loading_message.edit_text(str(e))
 
 @add_router.message(AddReceiptQR.CUSTOMER)
 async def process_customer(message: Message, state: FSMContext) -> None:
@@ -454,7 +533,11 @@ async def process_receipt_comment(message: Message, state: FSMContext) -> None:
     ])
     await message.answer(details, reply_markup=inline_keyboard)
     await message.answer("Или сбросьте действие:", reply_markup=reset_keyboard())
-    await state.update_data(receipt=receipt)
+    # parsed_data дальше не нужен: всё для записи уже в receipt
+    data = await state.get_data()
+    data.pop("parsed_data", None)
+    data["receipt"] = receipt
+    await state.set_data(data)
     await state.set_state(AddReceiptQR.CONFIRM_ACTION)
 
 @add_router.callback_query(AddReceiptQR.CONFIRM_ACTION, lambda c: c.data == "confirm_add")
@@ -481,7 +564,10 @@ async def confirm_add_action(callback: CallbackQuery, state: FSMContext) -> None
     saved = await save_receipt(receipt, user_name=user_name)
 
     if saved:
-        balance_data = await get_monthly_balance(force_refresh=True)
+        # Баланс — из журнала операций, без перечитывания Сводки (формулы сверит фон)
+        balance_data = await record_balance_event(
+            "spent", total_sum, ref=str(receipt.get("fiscal_doc", "")), date=receipt.get("date")
+        )
         balance = balance_data.get("balance", 0.0) if balance_data else 0.0
 
         delivery_dates = receipt.get("delivery_dates", [])
@@ -618,15 +704,33 @@ async def add_manual_type(message: Message, state: FSMContext) -> None:
 @add_router.callback_query(AddManualAPI.CONFIRM, lambda c: c.data == "confirm_manual_api")
 async def confirm_manual_api_callback(callback: CallbackQuery, state: FSMContext) -> None:
     data = await state.get_data()
+    await callback.answer()  # Сразу: запрос с повторами может занять минуты, а callback протухает
     loading = await callback.message.answer("⌛ Запрашиваю данные чека...")
 
+    async def progress(text: str) -> None:
+        await loading.edit_text(text)
+
     try:
-        success, msg, parsed_data = await confirm_manual_api(data, callback.from_user)
+        success, msg, parsed_data = await confirm_manual_api(data, callback.from_user, progress=progress)
+
+        if msg in (CHECK_NOT_READY_MSG, SERVICE_DEGRADED_MSG):
+            # ФНС ещё не отдала чек или proverkacheka лежит — проверим сами и продолжим здесь, когда данные появятся
+            manual_fields = {key: data.get(key) for key in ("fn", "fd", "fp", "s", "date", "time", "op_type")}
+            await schedule_deferred_check(
+                "add_manual", manual_fields, callback.message.chat.id, callback.from_user.id,
+                username=callback.from_user.username or str(callback.from_user.id)
+            )
+            reason = "Данные чека пока не готовы в ФНС" if msg == CHECK_NOT_READY_MSG else "Сервис проверки чеков сейчас недоступен"
+            await loading.edit_text(
+                f"⏳ {reason}. Я буду проверять чек сам "
+                f"в течение {DEFERRED_CHECK_WINDOW // 3600} ч и продолжу добавление в этом чате."
+            )
+            await state.clear()
+            return
 
         if not success or not parsed_data:
             await loading.edit_text(msg)
             await state.clear()
-            await callback.answer()
             return
 
         await loading.edit_text("✅ Чек получен.")
@@ -639,19 +743,38 @@ async def confirm_manual_api_callback(callback: CallbackQuery, state: FSMContext
         await state.set_state(AddReceiptQR.CUSTOMER)
 
         logger.info(f"Manual API success: fiscal={parsed_data.get('fiscal_doc', 'N/A')}, user={callback.from_user.id}")
-        await callback.answer()
 
     except asyncio.TimeoutError as timeout_exc:
         await loading.edit_text("❌ Таймаут API. Попробуйте позже.")
         logger.error(f"Timeout in handler: {str(timeout_exc)}")
         await state.clear()
-        await callback.answer()
     except Exception as exc:
         error_type = type(exc).__name__
         await loading.edit_text(f"⚠️ Ошибка: {error_type}: {str(exc)}.")
         logger.error(f"Handler error: {error_type}: {str(exc)}, user={callback.from_user.id}")
         await state.clear()
-        await callback.answer()
+
+async def resume_deferred_manual(bot: Bot, state: FSMContext, payload: dict, parsed_data: dict) -> bool:
+    """Чек из отложенной проверки готов: продолжаем /add_manual с шага «заказчик»."""
+    if await state.get_state() is not None:
+        return False  # Пользователь в другом сценарии — не перебиваем, deferred спросит позже
+
+    fiscal_doc = str(parsed_data.get("fiscal_doc", ""))
+    if not await is_fiscal_doc_unique(fiscal_doc):
+        await bot.send_message(payload["chat_id"], f"❌ Чек с фискальным номером {fiscal_doc} уже существует.")
+        return True
+
+    await state.update_data(username=payload.get("username") or str(payload["user_id"]), parsed_data=parsed_data)
+    await state.set_state(AddReceiptQR.CUSTOMER)
+    await bot.send_message(
+        payload["chat_id"],
+        f"✅ Чек ФД {payload['data'].get('fd')} получен из ФНС.\nВведите заказчика (или /skip):",
+        reply_markup=reset_keyboard()
+    )
+    logger.info(f"Deferred manual resumed: fiscal={fiscal_doc}, user={payload['user_id']}")
+    return True
+
+register_deferred_handler("add_manual", resume_deferred_manual)
 
 @add_router.callback_query(AddManualAPI.CONFIRM, lambda c: c.data == "cancel_manual_api")
 async def cancel_manual_api_callback(callback: CallbackQuery, state: FSMContext) -> None:
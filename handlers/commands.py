@@ -2,14 +2,16 @@ from aiogram import Router, Bot, types
 from aiogram.filters import Command, CommandStart
 from aiogram.types import Message, ReplyKeyboardRemove, ReplyKeyboardMarkup, KeyboardButton
 from aiogram.fsm.context import FSMContext
-from sheets import sheets_service, is_user_allowed, async_sheets_call, get_monthly_balance  # + get_monthly_balance
+from sheets import sheets_service, is_user_allowed, async_sheets_call, get_monthly_balance, get_receipts_rows, load_receipts_mirror, is_fiscal_doc_unique, rebuild_fiscal_index, get_sheets_pool_stats, batch_get_values, reset_balance_ledger, add_allowed_user, remove_allowed_user, load_allowed_users  # + get_monthly_balance
 from config import SHEET_NAME, PROVERKACHEKA_TOKEN, YOUR_ADMIN_ID, SPREADSHEETS_LINK
 from exceptions import (
     get_excluded_items,
     add_excluded_item,
     remove_excluded_item
 )
-from utils import redis_client
+from deferred import pending_deferred_count
+from proverkacheka import proverkacheka_breaker, API_URL
+from utils import redis_client, redis_key, safe_float, flush_namespaces, get_cache_stats, KEY_NAMESPACES, CACHE_NAMESPACES
 from googleapiclient.errors import HttpError
 import logging
 import aiohttp
@@ -18,6 +20,8 @@ from datetime import datetime
 logger = logging.getLogger("AccountingBot")
 router = Router()
 
+NOTIFIED_ITEMS_KEY = redis_key("notify", "items")  # Отключённые уведомления (/disable_notifications)
+
 @router.message(Command("start"))
 async def start_command(message: Message):
     if not await is_user_allowed(message.from_user.id):
@@ -58,7 +62,7 @@ async def test_connectivity(message: Message):
         return
     response = []
     try:
-        await async_sheets_call(sheets_service.spreadsheets().get, spreadsheetId=SHEET_NAME)
+        await async_sheets_call(sheets_service.spreadsheets().get, spreadsheetId=SHEET_NAME, fields="spreadsheetId")
         response.append("Google Sheets: Подключение успешно")
     except HttpError as e:
         response.append(f"Google Sheets: Ошибка - {e.status_code} {e.reason}")
@@ -69,12 +73,14 @@ async def test_connectivity(message: Message):
     
     async with aiohttp.ClientSession() as session:
         try:
-            async with session.get("https://proverkacheka.com/api/v1/check/get", params={"token": PROVERKACHEKA_TOKEN}) as resp:
+            async with session.get(API_URL, params={"token": PROVERKACHEKA_TOKEN}) as resp:
                 response.append(f"Proverkacheka API: HTTP {resp.status}")
                 logger.info(f"Проверка Proverkacheka API: status={resp.status}")
         except Exception as e:
             response.append(f"Proverkacheka API: Ошибка - {str(e)}")
             logger.error(f"Ошибка проверки Proverkacheka API: {str(e)}")
+    breaker = proverkacheka_breaker.stats()
+    response.append(f"Proverkacheka предохранитель: {breaker['state']} (сбоев подряд: {breaker['failures']})")
     
     await message.answer("\n".join(response))
     logger.info(f"Команда /test выполнена: user_id={message.from_user.id}")
@@ -92,7 +98,7 @@ async def disable_notifications(message: Message, state: FSMContext):
             logger.info(f"Ключ уведомления не указан: user_id={message.from_user.id}")
             return
         notification_key = args[1]
-        await redis_client.sadd("notified_items", notification_key)
+        await redis_client.sadd(NOTIFIED_ITEMS_KEY, notification_key)
         await message.answer(f"Уведомления для {notification_key} отключены.")
         logger.info(f"Уведомления отключены: notification_key={notification_key}, user_id={message.from_user.id}")
     except Exception as e:
@@ -106,16 +112,34 @@ async def debug_sheets(message: Message):
         logger.info(f"Доступ запрещен для /debug: user_id={message.from_user.id}")
         return
     try:
-        spreadsheet = await async_sheets_call(sheets_service.spreadsheets().get, spreadsheetId=SHEET_NAME)
+        spreadsheet = await async_sheets_call(sheets_service.spreadsheets().get, spreadsheetId=SHEET_NAME, fields="sheets.properties.title")
         sheet_names = [sheet["properties"]["title"] for sheet in spreadsheet.get("sheets", [])]
         response = [f"Google Sheet ID: {SHEET_NAME}", "Листы:"]
-        for sheet in sheet_names:
-            result = await async_sheets_call(
-                sheets_service.spreadsheets().values().get,
-                spreadsheetId=SHEET_NAME, range=f"{sheet}!A1:Z1"
-            )
-            headers = result.get("values", [[]])[0]
+        # Заголовки всех листов — одним batchGet вместо запроса на каждый лист
+        header_ranges = await batch_get_values(["'" + sheet.replace("'", "''") + "'!A1:Z1" for sheet in sheet_names])
+        for sheet, values in zip(sheet_names, header_ranges):
+            headers = values[0] if values else []
             response.append(f"- {sheet}: {', '.join(str(h) for h in headers) if headers else 'пусто'}")
+        pool = get_sheets_pool_stats()
+        response.append(
+            f"Sheets pool: {pool['pool_size']} потоков, в работе {pool['in_flight']}, в очереди {pool['queued']}, "
+            f"вызовов {pool['calls']} (ошибок {pool['errors']}), "
+            f"ожидание avg/max {pool['wait_avg'] * 1000:.0f}/{pool['wait_max'] * 1000:.0f} мс, "
+            f"выполнение avg/max {pool['exec_avg'] * 1000:.0f}/{pool['exec_max'] * 1000:.0f} мс"
+        )
+        response.append(
+            f"Sheets quota: чтение {pool['read_rate']:.0f}/мин, запись {pool['write_rate']:.0f}/мин, "
+            f"ожидание квоты avg/max {pool['throttle_avg'] * 1000:.0f}/{pool['throttle_max'] * 1000:.0f} мс, "
+            f"повторов после 429/5xx: {pool['retries']}, склеено чтений: {pool['coalesced']}"
+        )
+        response.append(f"Отложенных проверок чеков (code=2): {await pending_deferred_count()}")
+        cache = get_cache_stats()
+        response.append(
+            f"Кэш: локальный {'вкл' if cache['local_active'] else 'выкл'} ({cache['local_size']} ключей), "
+            f"попаданий/промахов локально {cache['local_hits']}/{cache['local_misses']}, "
+            f"в Redis {cache['redis_hits']}/{cache['redis_misses']}, "
+            f"инвалидаций отправлено/получено {cache['invalidations_sent']}/{cache['invalidations_received']}"
+        )
         await message.answer("\n".join(response))
         logger.info(f"Команда /debug выполнена: user_id={message.from_user.id}")
     except HttpError as e:
@@ -151,27 +175,11 @@ async def add_user(message: types.Message):
             return
         user_id = int(user_id_str)
 
-        result = await async_sheets_call(
-            sheets_service.spreadsheets().values().get,
-            spreadsheetId=SHEET_NAME, range="AllowedUsers!A:B"
-        )
-        allowed_users = [(int(row[0]), row[1] if len(row) > 1 else "") for row in result.get("values", [])[1:] if row and row[0].isdigit()]
-        if any(uid == user_id for uid, _ in allowed_users):
+        if not await add_allowed_user(user_id, user_name):
             await message.answer("✅ Пользователь уже в списке.")
             logger.info(f"Пользователь уже в списке: {user_id}, user_id={message.from_user.id}")
             return
 
-        await async_sheets_call(
-            sheets_service.spreadsheets().values().append,
-            spreadsheetId=SHEET_NAME,
-            range="AllowedUsers!A:B",
-            valueInputOption="RAW",
-            body={"values": [[user_id_str, user_name]]}
-        )
-
-        from utils import cache_set  # Invalidate
-        await cache_set("allowed_users_list", None)
-
         await message.answer(f"✅ Пользователь {user_id} ({user_name}) добавлен.")
         logger.info(f"Пользователь добавлен: {user_id}, name={user_name}, user_id={message.from_user.id}")
     except HttpError as e:
@@ -195,56 +203,15 @@ async def remove_user(message: types.Message):
             return
         identifier = args[1].strip()
 
-        result = await async_sheets_call(
-            sheets_service.spreadsheets().values().get,
-            spreadsheetId=SHEET_NAME, range="AllowedUsers!A:B"
-        )
-        rows = result.get("values", [])
-        
-        if len(rows) <= 1:
-            await message.answer("❌ Список пользователей пуст.")
-            logger.info(f"Список пуст при попытке удалить: {identifier}, user_id={message.from_user.id}")
-            return
-
-        header = rows[0] if rows else ["Users", "Name"]
-        data_rows = rows[1:]
-
-        is_digit = identifier.isdigit()
-        filtered_rows = []
-        removed = False
-        for row in data_rows:
-            if not row or not row[0].isdigit():
-                continue
-            row_id, row_name = row[0], row[1] if len(row) > 1 else ""
-            if (is_digit and row_id == identifier) or (not is_digit and row_name.strip() == identifier):
-                removed = True
-                continue
-            filtered_rows.append(row)
-
-        if not removed:
+        removed = await remove_allowed_user(identifier)
+        if removed is None:
             await message.answer(f"✅ Пользователь {identifier} не найден в списке.")
             logger.info(f"Пользователь не найден: {identifier}, user_id={message.from_user.id}")
             return
 
-        await async_sheets_call(
-            sheets_service.spreadsheets().values().clear,
-            spreadsheetId=SHEET_NAME,
-            range="AllowedUsers!A:B"
-        )
-        new_values = [header] + filtered_rows
-        await async_sheets_call(
-            sheets_service.spreadsheets().values().update,
-            spreadsheetId=SHEET_NAME,
-            range="AllowedUsers!A1",
-            valueInputOption="RAW",
-            body={"values": new_values}
-        )
-
-        from utils import cache_set
-        await cache_set("allowed_users_list", None)
-
-        await message.answer(f"✅ Пользователь {identifier} удален из таблицы.")
-        logger.info(f"Пользователь удален: {identifier}, user_id={message.from_user.id}")
+        removed_id, removed_name = removed
+        await message.answer(f"✅ Пользователь {removed_id} ({removed_name}) удален из таблицы.")
+        logger.info(f"Пользователь удален: {removed_id}, name={removed_name}, user_id={message.from_user.id}")
 
     except HttpError as e:
         await message.answer(f"❌ Ошибка работы с Google Sheets: {e.status_code} - {e.reason}.")
@@ -260,11 +227,7 @@ async def summary_report(message: Message):
         logger.info(f"Доступ запрещен для /summary: user_id={message.from_user.id}")
         return
     try:
-        result = await async_sheets_call(
-            sheets_service.spreadsheets().values().get,
-            spreadsheetId=SHEET_NAME, range="Чеки!A:L"
-        )
-        receipts = result.get("values", [])[1:]
+        receipts = await get_receipts_rows()
         summary = {}
         for row in receipts:
             if len(row) < 9:
@@ -337,7 +300,7 @@ async def list_exclusions_command(message: Message):
 
     items = get_excluded_items()
     if items:
-        content = "📋 *Исключённые позиции (case-insensitive):*\n" + "\n".join(f"• `{item}`" for item in items)
+        content = "📋 *Исключённые позиции (case-insensitive; token: — слово, contains: — подстрока):*\n" + "\n".join(f"• `{item}`" for item in items)
     else:
         content = "📋 *Исключённые позиции:* пусто"
 
@@ -355,7 +318,8 @@ async def add_exclusion_command(message: Message):
     if len(args) < 2:
         await message.answer(
             "❗ Укажите название товара для добавления в исключения.\n"
-            "Пример: `/addexclusion Доставка`",
+            "Пример: `/addexclusion Доставка`\n"
+            "`token:доставка` — слово в названии, `contains:сбор` — подстрока",
             parse_mode="Markdown"
         )
         logger.info(f"Не указано название для /addexclusion: user_id={message.from_user.id}")
@@ -366,7 +330,7 @@ async def add_exclusion_command(message: Message):
         await message.answer("❗ Название не может быть пустым.")
         return
 
-    if add_excluded_item(item):
+    if await add_excluded_item(item):
         await message.answer(f"✅ Добавлено в исключения: `{item}`", parse_mode="Markdown")
         logger.info(f"Добавлено исключение: '{item}', user_id={message.from_user.id}")
     else:
@@ -395,7 +359,7 @@ async def remove_exclusion_command(message: Message):
         await message.answer("❗ Название не может быть пустым.")
         return
 
-    if remove_excluded_item(item):
+    if await remove_excluded_item(item):
         await message.answer(f"✅ Удалено из исключений: `{item}`", parse_mode="Markdown")
         logger.info(f"Удалено исключение: '{item}', user_id={message.from_user.id}")
     else:
@@ -419,16 +383,8 @@ async def get_balance(message: Message):
             returned = balance_data.get("returned", 0.0)
             balance = balance_data.get("balance", 0.0)
 
-            # Дата обновления: Оставляем отдельный запрос (малозначительный, ~0.1с; можно объединить позже)
-            try:
-                date_result = await async_sheets_call(
-                    sheets_service.spreadsheets().values().get,
-                    spreadsheetId=SHEET_NAME, range="Сводка!A1"  # Только A1 для даты
-                )
-                update_date = date_result.get("values", [[datetime.now().strftime("%d.%m.%Y")]])[0][0]
-            except Exception:
-                update_date = datetime.now().strftime("%d.%m.%Y")  # Fallback текущая дата
-                logger.warning("Не удалось получить дату из A1, используем текущую")
+            # Дата обновления (A1) приходит тем же чтением Сводка!A1:Q2
+            update_date = balance_data.get("update_date") or datetime.now().strftime("%d.%m.%Y")
 
             # Формируем ответ (как раньше)
             await loading_message.edit_text(
@@ -456,13 +412,13 @@ async def clear_cache(message: Message):
         logger.info(f"Доступ запрещен для /clear_cache: user_id={message.from_user.id}")
         return
     try:
-        # Clear fiscal
-        await redis_client.delete("fiscal_docs_set")
-        # Clear allowed (optional)
-        await redis_client.delete("allowed_users_list")
+        # Rebuild fiscal index from the sheet
+        docs_count = await rebuild_fiscal_index()
+        # Справочник пользователей — заново из листа AllowedUsers
+        users_count = await load_allowed_users(from_sheet=True)
         # Clear notified (optional, large?)
-        # await redis_client.delete("notified_items")  # Uncomment if need full reset
-        await message.answer("✅ Кэш очищен: fiscal_docs_set (и allowed). Проверьте /add.")
+        # await redis_client.delete(NOTIFIED_ITEMS_KEY)  # Uncomment if need full reset
+        await message.answer(f"✅ Кэш очищен: индекс фискальных номеров перестроен ({docs_count} номеров), пользователей перечитано: {users_count}. Проверьте /add.")
         logger.info(f"Кэш очищен: user_id={message.from_user.id}")
     except Exception as e:
         await message.answer(f"❌ Ошибка очистки кэша: {str(e)}.")
@@ -476,16 +432,36 @@ async def flush_cache(message: Message):
         await message.answer("🚫 Доступ запрещен. Только администратор.")
         logger.info(f"Доступ запрещен для /flush_cache: user_id={message.from_user.id}")
         return
+    # /flush_cache — кэши (users, balance, fiscal, parse-cache); /flush_cache <пространство> или all
+    args = message.text.split()[1:]
+    if not args:
+        namespaces = list(CACHE_NAMESPACES)
+    elif args == ["all"]:
+        namespaces = list(KEY_NAMESPACES)
+    else:
+        namespaces = [arg.lower() for arg in args]
+        unknown = [ns for ns in namespaces if ns not in KEY_NAMESPACES]
+        if unknown:
+            listing = "\n".join(f"• {ns} — {title}" for ns, title in KEY_NAMESPACES.items())
+            await message.answer(
+                f"❌ Неизвестное пространство: {', '.join(unknown)}.\n"
+                f"Использование: /flush_cache [пространство ... | all]\n{listing}\n"
+                f"Без аргументов: {', '.join(CACHE_NAMESPACES)}."
+            )
+            return
     try:
-        # Nuclear: Clear all keys (or specific)
-        keys_to_del = await redis_client.keys("*")  # All keys
-        deleted = await redis_client.delete(*keys_to_del)
-        await message.answer(f"✅ Полная очистка кэша: удалено {deleted} ключей (all). Проверьте /add или /balance.")
-        logger.info(f"Full cache flush: deleted {deleted} keys, user_id={message.from_user.id}")
-        
-        # Optional: Test refresh
-        test_docs = await is_fiscal_doc_unique("test_flush")  # Force refresh, should unique
-        await message.answer(f"Тест unique 'test_flush': {test_docs} (should be True).")
+        # SCAN + UNLINK по пространствам — без KEYS * и без чужих ключей на общем Redis
+        deleted = await flush_namespaces(namespaces)
+        lines = [f"• {ns}: {count}" for ns, count in deleted.items()]
+        # Справочник и индекс нужны на каждом апдейте — восстанавливаем сразу, а не на первом запросе
+        if "users" in deleted:
+            users_count = await load_allowed_users(from_sheet=True)
+            lines.append(f"Пользователей перечитано: {users_count}")
+        if "fiscal" in deleted:
+            docs_count = await rebuild_fiscal_index()
+            lines.append(f"Индекс фискальных номеров перестроен: {docs_count}")
+        await message.answer(f"✅ Очищено ключей ({sum(deleted.values())}):\n" + "\n".join(lines))
+        logger.info(f"Cache flush: {deleted}, user_id={message.from_user.id}")
     except Exception as e:
         await message.answer(f"❌ Ошибка очистки: {str(e)}.")
         logger.error(f"Ошибка /flush_cache: {str(e)}, user_id={message.from_user.id}")
@@ -509,6 +485,9 @@ async def clear_sheet(message: Message):
             sheets_service.spreadsheets().values().clear,
             spreadsheetId=SHEET_NAME, range="Сводка!A2:E1000"
         )
+        await load_receipts_mirror(force=True)
+        await rebuild_fiscal_index(replace=True)  # Лист пуст — старые номера из индекса убираем
+        await reset_balance_ledger()
         await message.answer("✅ Листы 'Чеки' и 'Сводка' очищены (data rows deleted, headers kept). Проверьте /add или /debug.")
         logger.info(f"Sheet cleared by admin user_id={message.from_user.id}")
     except Exception as e:
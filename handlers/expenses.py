@@ -12,8 +12,14 @@ from sheets import (
     SHEET_NAME,  # Если используется
     get_monthly_balance,  # Для других частей, если нужно
     compute_delta_balance,
-    update_balance_cache_with_delta,
-    batch_update_sheets
+    batch_update_sheets,
+    get_receipts_rows,
+    find_receipt_row,
+    get_receipt_row,
+    update_receipt_cells,
+    batch_get_values,
+    refresh_receipts_mirror,
+    add_fiscal_doc
 )
 from utils import safe_float, parse_qr_from_photo, reset_keyboard
 from handlers.notifications import send_notification
@@ -60,11 +66,7 @@ async def list_pending_receipts(message: Message, state: FSMContext) -> None:
         return
 
     try:
-        res = await async_sheets_call(
-            sheets_service.spreadsheets().values().get,
-            spreadsheetId=SHEET_NAME, range="Чеки!A:P"
-        )
-        rows = res.get("values", [])[1:]
+        rows = await get_receipts_rows()
 
         groups = {}
         for i, row in enumerate(rows, start=2):
@@ -119,7 +121,10 @@ async def choose_receipt(callback: CallbackQuery, state: FSMContext) -> None:
         await callback.answer()
         return
 
-    await state.update_data(items=items, selected=set(), fd=fiscal_doc)
+    # Остальные чеки из списка больше не нужны — в состоянии только выбранный
+    data.pop("pending_groups", None)
+    data.update(items=items, selected=[], fd=fiscal_doc)
+    await state.set_data(data)
 
     def build_kb(items: list, selected_idxs: set) -> InlineKeyboardMarkup:
         rows = []
@@ -147,7 +152,7 @@ async def choose_receipt(callback: CallbackQuery, state: FSMContext) -> None:
 async def select_items_toggle(callback: CallbackQuery, state: FSMContext) -> None:
     data = await state.get_data()
     items = data.get("items", [])
-    selected = set(data.get("selected", set()))
+    selected = set(data.get("selected", []))
 
     cmd = callback.data
     if cmd == "sel:cancel":
@@ -160,7 +165,7 @@ async def select_items_toggle(callback: CallbackQuery, state: FSMContext) -> Non
         if not selected:
             await callback.answer("Ничего не выбрано.", show_alert=True)
             return
-        await state.update_data(selected=selected)
+        await state.update_data(selected=sorted(selected))  # set в JSON-хранилище FSM не ложится
         await callback.message.edit_text("Отправьте фото QR-кода ЧЕКА ПОЛНОГО РАСЧЁТА (operationType=1).")
         await state.set_state(ConfirmDelivery.UPLOAD_FULL_QR)
         await callback.answer()
@@ -175,7 +180,7 @@ async def select_items_toggle(callback: CallbackQuery, state: FSMContext) -> Non
             selected.remove(idx)
         else:
             selected.add(idx)
-        await state.update_data(selected=selected)
+        await state.update_data(selected=sorted(selected))  # set в JSON-хранилище FSM не ложится
     except Exception:
         await callback.answer("Некорректный индекс.", show_alert=True)
         return
@@ -217,7 +222,7 @@ async def upload_full_qr(message: Message, state: FSMContext, bot: Bot) -> None:
 
     data = await state.get_data()
     items = data.get("items", [])
-    selected = sorted(list(data.get("selected", set())))
+    selected = sorted(data.get("selected", []))
     sel_items = [items[i] for i in selected]
 
     qr_items = parsed.get("items", [])
@@ -238,7 +243,8 @@ async def upload_full_qr(message: Message, state: FSMContext, bot: Bot) -> None:
         )
         return
 
-    await state.update_data(qr_parsed=parsed)
+    # Весь чек в состоянии не держим — для записи нужны только номер и ссылки
+    await state.update_data(qr_parsed={key: parsed.get(key, "") for key in ("fiscal_doc", "pdf_url", "qr_string")})
     total = sum(it["sum"] for it in sel_items)
     details = [
         f"Чек (fiscal_doc): {parsed.get('fiscal_doc')}",
@@ -263,7 +269,7 @@ async def confirm_delivery_many(callback: CallbackQuery, state: FSMContext) -> N
 
     data = await state.get_data()
     items = data.get("items", [])
-    selected = sorted(list(data.get("selected", set())))
+    selected = sorted(data.get("selected", []))
     sel_items = [items[i] for i in selected]
     parsed = data.get("qr_parsed", {})
     new_fd = parsed.get("fiscal_doc", "")
@@ -279,47 +285,71 @@ async def confirm_delivery_many(callback: CallbackQuery, state: FSMContext) -> N
         fallback_link = f"https://proverkacheka.com/qrcode/generate?text={safe_qr}"
         qr_cell_value = f'=HYPERLINK("{fallback_link}"; "⏳ PDF готовится (QR)")'
 
-    updates = []
+    old_fd = data.get("fd", "")
+    changes = {}
     updated_items = []
     ok, fail, errors = 0, 0, []
 
+    targets = []
     for it in sel_items:
         row_index = it["row_index"]
-        try:
-            res = await async_sheets_call(
-                sheets_service.spreadsheets().values().get,
-                spreadsheetId=SHEET_NAME, range=f"Чеки!A{row_index}:Q{row_index}"
-            )
-            row = res.get("values", [[]])[0] if res.get("values") else []
-            while len(row) < 17:
-                row.append("")
-
-            row[8] = "Доставлено"
-            row[11] = "Полный"
-            row[12] = str(new_fd)
-            
-            # ✅ ИЗМЕНЕНО: Записываем готовую формулу в столбец N (индекс 13)
-            row[13] = qr_cell_value 
-
-            updates.append({"range": f"Чеки!A{row_index}:Q{row_index}", "values": [row]})
-
-            updated_items.append({
-                "name": it.get("name", "—"),
-                "sum": safe_float(it.get("sum", 0)),
-                "quantity": int(it.get("quantity", 1) or 1),
-                "link": (row[15] or "").strip() if len(row) > 15 else "",
-                "comment": (row[16] or "").strip() if len(row) > 16 else "",
-                "delivery_date": (row[7] or "").strip() if len(row) > 7 else ""
-            })
-            ok += 1
-        except Exception as e:
+        # Номер строки из /expenses сверяем с зеркалом (зеркало могло обновиться после выбора)
+        row = get_receipt_row(row_index)
+        if not row or str(row[12]).strip() != old_fd or str(row[10]).strip() != it["name"]:
+            row_index = await find_receipt_row(old_fd, it["name"])
+            row = get_receipt_row(row_index) if row_index else None
+        if not row:
             fail += 1
-            errors.append(f"Строка {row_index}: {str(e)}")
+            errors.append(f"Строка {it['row_index']}: позиция «{it['name']}» не найдена")
+            continue
+        targets.append((it, row_index, row))
 
-    if updates:
-        await batch_update_sheets(updates)
+    # Зеркало не видит строк, сдвинутых в листе вручную, — перед записью читаем K:M целевых строк
+    try:
+        actual = await batch_get_values([f"Чеки!K{row_index}:M{row_index}" for _, row_index, _ in targets])
+    except Exception as e:
+        logger.error(f"Ошибка проверки строк перед доставкой: {str(e)}")
+        fail += len(targets)
+        errors.append("Не удалось проверить строки в Google Sheets")
+        targets = []
+        actual = []
+
+    moved = False
+    for (it, row_index, row), values in zip(targets, actual):
+        cells = values[0] if values else []
+        sheet_name = str(cells[0]).strip() if len(cells) > 0 else ""
+        sheet_fd = str(cells[2]).strip() if len(cells) > 2 else ""
+        if sheet_fd != old_fd or sheet_name != it["name"]:
+            logger.warning(f"Доставка: строка {row_index} в листе не совпадает с зеркалом ({sheet_fd!r}, {sheet_name!r})")
+            fail += 1
+            errors.append(f"Строка {row_index}: позиция «{it['name']}» сдвинута в таблице, повторите /expenses")
+            moved = True
+            continue
+
+        # ✅ ИЗМЕНЕНО: Формула PDF — в столбец N (индекс 13); пишем только I, L:N
+        changes[row_index] = {8: "Доставлено", 11: "Полный", 12: str(new_fd), 13: qr_cell_value}
+        updated_items.append({
+            "name": it.get("name", "—"),
+            "sum": safe_float(it.get("sum", 0)),
+            "quantity": int(it.get("quantity", 1) or 1),
+            "link": str(row[15] or "").strip(),
+            "comment": str(row[16] or "").strip(),
+            "delivery_date": str(row[7] or "").strip()
+        })
+
+    if moved:
+        await refresh_receipts_mirror()  # Чтобы повторный /expenses увидел строки на новых местах
+
+    if changes:
+        if await update_receipt_cells(changes):
+            ok += len(changes)
+            await add_fiscal_doc(new_fd)  # Столбец M теперь содержит номер чека полного расчёта
+        else:
+            fail += len(changes)
+            errors.append("Ошибка записи в Google Sheets")
 
-    balance_data = await get_monthly_balance(force_refresh=True)
+    # Доставка меняет только статус — баланс не изменился, кэша/журнала достаточно
+    balance_data = await get_monthly_balance()
     balance = balance_data.get("balance", 0.0) if balance_data else 0.0
 
     user_name = await is_user_allowed(callback.from_user.id) or callback.from_user.full_name
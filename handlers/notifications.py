@@ -2,7 +2,7 @@ from aiogram import Bot
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
 from aiogram.filters import Command
 from googleapiclient.errors import HttpError
-from sheets import sheets_service, get_monthly_balance, async_sheets_call
+from sheets import get_monthly_balance, get_receipts_rows
 from config import SHEET_NAME, GROUP_CHAT_ID
 from datetime import datetime, timedelta
 import asyncio
@@ -11,6 +11,7 @@ import random
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from utils import safe_float, redis_client
+from receipt_model import Item, rub_to_kop
 
 logger = logging.getLogger("AccountingBot")
 scheduler = AsyncIOScheduler(timezone="Europe/Moscow")
@@ -37,28 +38,18 @@ async def send_notification(
     В шапке теперь указывается дата операции, а не дата доставки.
     """
     try:
-        normalized_items = [
-            {
-                "name": item.get("name", "—"),
-                "sum": safe_float(item.get("sum", 0)),
-                "quantity": int(item.get("quantity", 1) or 1),
-                "price": safe_float(item.get("price", 0)) or safe_float(item.get("sum", 0)) / max(int(item.get("quantity", 1) or 1), 1),
-                "link": item.get("link", ""),
-                "comment": item.get("comment", ""),
-                "delivery_date": item.get("delivery_date", ""),
-            }
-            for item in items
-        ]
-
-        items_total = sum(it["sum"] for it in normalized_items)
-        full_total = items_total + excluded_sum  # Полная сумма чека с учетом доставки
+        normalized_items = [Item.from_dict(item) for item in items]
+
+        # Итоги считаем в копейках, чтобы не копить ошибку float
+        items_total = sum(it.sum_kop for it in normalized_items) / 100
+        full_total = (sum(it.sum_kop for it in normalized_items) + rub_to_kop(excluded_sum)) / 100  # Полная сумма чека с учетом доставки
 
         items_text = "\n".join(
-            f"▫️ <b>{it['name']}</b>\n"
-            f"   ├ 💰 {it['quantity']} × {it['price']:.2f} ₽ = <b>{it['sum']:.2f} ₽</b>"
-            + (f"\n   ├ 📅 {it['delivery_date']}" if it['delivery_date'] else "")
-            + (f"\n   ├ 🔗 <a href=\"{it['link']}\">Ссылка</a>" if it['link'] else "")
-            + (f"\n   └ 💬 {it['comment']}" if it['comment'] else "")
+            f"▫️ <b>{it.name}</b>\n"
+            f"   ├ 💰 {it.quantity} × {it.price:.2f} ₽ = <b>{it.sum:.2f} ₽</b>"
+            + (f"\n   ├ 📅 {it.delivery_date}" if it.delivery_date else "")
+            + (f"\n   ├ 🔗 <a href=\"{it.link}\">Ссылка</a>" if it.link else "")
+            + (f"\n   └ 💬 {it.comment}" if it.comment else "")
             for it in normalized_items
         )
 
@@ -126,13 +117,8 @@ async def send_notifications(bot: Bot):
         return
 
     try:
-        result = await async_sheets_call(
-            sheets_service.spreadsheets().values().get,
-            spreadsheetId=SHEET_NAME,
-            range="Чеки!A:Q"
-        )
-        rows = result.get("values", [])[1:]
-        logger.info(f"📊 Загружено {len(rows)} строк из Google Sheets (Чеки!A:Q)")
+        rows = await get_receipts_rows()
+        logger.info(f"📊 Проверяется {len(rows)} строк из зеркала Чеки!A:Q")
 
         today_str = today.strftime("%d.%m.%Y")
         three_days_ago = (today - timedelta(days=3)).strftime("%d.%m.%Y")
@@ -13,6 +13,11 @@ from sheets import (
     sheets_service,
     SHEET_NAME,
     get_monthly_balance,
+    record_balance_event,
+    get_receipts_rows,
+    find_receipt_row,
+    get_receipt_row,
+    update_receipt_cells,
 )
 from utils import parse_qr_from_photo, safe_float, reset_keyboard
 from config import SHEET_NAME
@@ -59,12 +64,8 @@ async def process_search_term(message: Message, state: FSMContext):
         return
 
     try:
-        result = await async_sheets_call(
-            sheets_service.spreadsheets().values().get,
-            spreadsheetId=SHEET_NAME, range="Чеки!A:Q"
-        )
-        rows = result.get("values", [])[1:]  
-        logger.info(f"Поиск по '{search_term}': загружено {len(rows)} строк из Чеки!A:Q")
+        rows = await get_receipts_rows()
+        logger.info(f"Поиск по '{search_term}': {len(rows)} строк в зеркале Чеки!A:Q")
 
         matches = []
         is_fiscal_search = search_term.isdigit()  
@@ -323,7 +324,7 @@ async def process_return_qr(message: Message, state: FSMContext, bot: Bot):
     
     await state.update_data(
         new_fiscal_doc=new_fiscal_doc,
-        parsed_data=parsed_data,
+        parsed_data={"pdf_url": parsed_data.get("pdf_url", ""), "qr_string": parsed_data.get("qr_string", "")},  # Для записи нужны только ссылки
         total_return_sum=total_return_sum,
         fiscal_doc=fiscal_doc,
         item_name=item_name,
@@ -350,12 +351,6 @@ async def handle_return_confirmation(callback: CallbackQuery, state: FSMContext)
         return
 
     try:
-        result = await async_sheets_call(
-            sheets_service.spreadsheets().values().get,
-            spreadsheetId=SHEET_NAME,
-            range="Чеки!A:Q"
-        )
-        rows = result.get("values", [])[1:]
         updated_items, found = [], False
 
         # ✅ НОВОЕ: Извлекаем ссылку на PDF возврата и готовим кнопку
@@ -369,45 +364,36 @@ async def handle_return_confirmation(callback: CallbackQuery, state: FSMContext)
             fallback_link = f"https://proverkacheka.com/qrcode/generate?text={safe_qr}"
             qr_cell_value = f'=HYPERLINK("{fallback_link}"; "⏳ PDF готовится (QR)")'
 
-        for i, row in enumerate(rows, start=2):
-            if len(row) < 13:
-                continue
-            if str(row[12] or "").strip() == fiscal_doc and (row[10] or "").strip() == item_name:
-                while len(row) < 17:
-                    row.append("")
-                row[8] = "Возвращен"
-                
-                # ✅ ИЗМЕНЕНО: Записываем готовую формулу гиперссылки в столбец O (индекс 14)
-                row[14] = qr_cell_value 
-                
-                await async_sheets_call(
-                    sheets_service.spreadsheets().values().update,
-                    spreadsheetId=SHEET_NAME,
-                    range=f"Чеки!A{i}:Q{i}",
-                    valueInputOption="USER_ENTERED", # ✅ ИЗМЕНЕНО: Чтобы формула сработала
-                    body={"values": [row]}
-                )
-
-                updated_items.append({
-                    "name": item_name,
-                    "sum": safe_float(row[2]),
-                    "quantity": int(row[4] or 1),
-                    "price": safe_float(row[3]) if row[3] else safe_float(row[2]) / int(row[4] or 1),
-                    "link": (row[15] or "").strip() if len(row) > 15 else "",
-                    "comment": (row[16] or "").strip() if len(row) > 16 else "",
-                    "delivery_date": (row[7] or "").strip() if len(row) > 7 else ""
-                })
-
-                await save_receipt_summary(
-                    date_purchase,
-                    "Возврат",
-                    total_return_sum,
-                    f"{new_fiscal_doc} - {item_name}"
-                )
-                found = True
-                break
-
-        balance_data = await get_monthly_balance(force_refresh=True)
+        # Номер строки — из индекса (fiscal_doc, item_name), без чтения листа
+        row_number = await find_receipt_row(fiscal_doc, item_name)
+        # Пишем только I (статус) и O (формула PDF возврата) одним запросом
+        if row_number and await update_receipt_cells({row_number: {8: "Возвращен", 14: qr_cell_value}}):
+            row = get_receipt_row(row_number)
+            updated_items.append({
+                "name": item_name,
+                "sum": safe_float(row[2]),
+                "quantity": int(safe_float(row[4]) or 1),
+                "price": safe_float(row[3]) if row[3] else safe_float(row[2]) / int(safe_float(row[4]) or 1),
+                "link": str(row[15] or "").strip(),
+                "comment": str(row[16] or "").strip(),
+                "delivery_date": str(row[7] or "").strip()
+            })
+
+            await save_receipt_summary(
+                date_purchase,
+                "Возврат",
+                total_return_sum,
+                f"{new_fiscal_doc} - {item_name}"
+            )
+            found = True
+
+        # Возврат — операция журнала баланса; без возврата просто текущий (кэшированный) баланс
+        if found:
+            balance_data = await record_balance_event(
+                "returned", total_return_sum, ref=f"{new_fiscal_doc} - {item_name}", date=date_purchase
+            )
+        else:
+            balance_data = await get_monthly_balance()
         balance = safe_float(balance_data.get("balance", 0.0)) if balance_data else 0.0
         user_name = await is_user_allowed(callback.from_user.id) or callback.from_user.full_name
         operation_date = datetime.now().strftime("%d.%m.%Y")
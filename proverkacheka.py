@@ -0,0 +1,293 @@
+"""
+Клиент proverkacheka.com: одна долгоживущая aiohttp-сессия на весь бот.
+
+QR-фото и ручной ввод (fn/fd/fp) идут через общий пул соединений с keep-alive,
+поэтому DNS/TCP/TLS оплачиваются один раз, а не на каждый чек. Сессия
+открывается в on_startup и закрывается в on_shutdown; если запрос пришёл раньше
+старта, она откроется лениво.
+
+Повторы — через fetch_check: асинхронные паузы (event loop не блокируется),
+экспоненциальный backoff с jitter, подсказка сервера `wait` на code=4 и общий
+дедлайн на все попытки. О каждой паузе можно сообщить пользователю через progress.
+
+Предохранитель (CircuitBreaker): после PROVERKACHEKA_BREAKER_THRESHOLD сбоев подряд
+(таймауты, ошибки сети, 5xx, HTML вместо JSON) запросы не отправляются вовсе —
+fetch_check сразу отдаёт SERVICE_DEGRADED_MSG, и хендлеры предлагают ручной путь.
+Через PROVERKACHEKA_BREAKER_RESET секунд пропускается один пробный запрос.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable
+
+import aiohttp
+
+from config import PROVERKACHEKA_BASE_URL, PROVERKACHEKA_POOL_SIZE, PROVERKACHEKA_TIMEOUT, PROVERKACHEKA_CONNECT_TIMEOUT
+from config import (
+    PROVERKACHEKA_MAX_ATTEMPTS, PROVERKACHEKA_DEADLINE, PROVERKACHEKA_BACKOFF_BASE,
+    PROVERKACHEKA_BACKOFF_MAX, PROVERKACHEKA_RATE_LIMIT_DELAY, PROVERKACHEKA_QR_DEADLINE,
+)
+from config import PROVERKACHEKA_BREAKER_THRESHOLD, PROVERKACHEKA_BREAKER_RESET
+
+logger = logging.getLogger("AccountingBot")
+
+API_URL = f"{PROVERKACHEKA_BASE_URL}/api/v1/check/get"
+
+# Предохранитель разомкнут: вызывающий сравнивает сообщение с константой, чтобы увести на ручной путь
+SERVICE_DEGRADED_MSG = "⚠️ Сервис проверки чеков сейчас недоступен."
+
+
+class ProverkachekaUnavailable(Exception):
+    """Предохранитель разомкнут — запрос к proverkacheka не отправлялся."""
+
+
+class CircuitBreaker:
+    """
+    closed → (threshold сбоев подряд) → open → (reset_timeout) → half_open:
+    один пробный запрос; успех замыкает цепь, сбой снова размыкает.
+    """
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+
+    @property
+    def is_open(self) -> bool:
+        """Разомкнут и пробовать ещё рано (для сообщений пользователю, без побочных эффектов)."""
+        if self.state == "closed":
+            return False
+        if self.state == "open":
+            return time.monotonic() - self.opened_at < self.reset_timeout
+        return time.monotonic() - self.probe_started < self.reset_timeout
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        now = time.monotonic()
+        if self.state == "open" and now - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            logger.info("proverkacheka: предохранитель полуоткрыт, пробный запрос")
+        elif self.state == "half_open" and now - self.probe_started >= self.reset_timeout:
+            logger.warning("proverkacheka: пробный запрос не завершился, пробуем ещё раз")
+        else:
+            return False
+        # Пробный запрос — один на reset_timeout; остальные получают отказ сразу
+        self.probe_started = now
+        return True
+
+    def record_success(self) -> None:
+        if self.state != "closed":
+            logger.info("proverkacheka: сервис ответил, предохранитель замкнут")
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            logger.error(
+                f"proverkacheka: предохранитель разомкнут после {self.failures} сбоев подряд, "
+                f"следующая проба через {self.reset_timeout:.0f}s"
+            )
+
+    def stats(self) -> dict:
+        return {"state": self.state, "failures": self.failures}
+
+
+proverkacheka_breaker = CircuitBreaker(PROVERKACHEKA_BREAKER_THRESHOLD, PROVERKACHEKA_BREAKER_RESET)
+
+
+class ProverkachekaClient:
+    def __init__(self, pool_size: int, timeout: int, connect_timeout: int):
+        self._pool_size = pool_size
+        self._timeout = aiohttp.ClientTimeout(total=timeout, sock_connect=connect_timeout)
+        self._session: aiohttp.ClientSession | None = None
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self._pool_size,
+            limit_per_host=self._pool_size,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        logger.info(f"proverkacheka: сессия открыта (pool={self._pool_size})")
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("proverkacheka: сессия закрыта")
+        self._session = None
+
+    @asynccontextmanager
+    async def post(self, form: aiohttp.FormData, timeout: float | None = None):
+        """POST multipart-формы на /check/get; отдаёт aiohttp-ответ внутри контекста."""
+        if not proverkacheka_breaker.allow():
+            raise ProverkachekaUnavailable(SERVICE_DEGRADED_MSG)
+        await self.start()
+        # Своя ClientTimeout заменяет сессионную целиком: попытка не дольше total сессии, sock_connect сохраняем
+        request_timeout = aiohttp.ClientTimeout(
+            total=min(timeout, self._timeout.total), sock_connect=self._timeout.sock_connect
+        ) if timeout else None
+        async with self._session.post(API_URL, data=form, timeout=request_timeout) as response:
+            yield response
+
+
+proverkacheka_client = ProverkachekaClient(PROVERKACHEKA_POOL_SIZE, PROVERKACHEKA_TIMEOUT, PROVERKACHEKA_CONNECT_TIMEOUT)
+
+
+# ---------------------------------------------------------
+# Повторы запросов (RetryPolicy + fetch_check)
+# ---------------------------------------------------------
+# Коды ответа API: 0 — чек некорректен, 1 — успех, 2 — данные ещё не готовы,
+# 3 — превышен лимит запросов, 4 — ждать data.wait секунд, 5 — прочее.
+class RetryPolicy:
+    def __init__(self, max_attempts: int, deadline: float, backoff_base: float, backoff_max: float, rate_limit_delay: float):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limit_delay = rate_limit_delay
+
+    def backoff(self, attempt: int) -> float:
+        """Экспоненциальная пауза с jitter (attempt с 1)."""
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1))
+        return random.uniform(delay / 2, delay)
+
+
+DEFAULT_POLICY = RetryPolicy(
+    PROVERKACHEKA_MAX_ATTEMPTS, PROVERKACHEKA_DEADLINE, PROVERKACHEKA_BACKOFF_BASE,
+    PROVERKACHEKA_BACKOFF_MAX, PROVERKACHEKA_RATE_LIMIT_DELAY,
+)
+
+# QR-фото: пользователь ждёт на экране загрузки — дедлайн короче
+QR_POLICY = RetryPolicy(
+    PROVERKACHEKA_MAX_ATTEMPTS, PROVERKACHEKA_QR_DEADLINE, PROVERKACHEKA_BACKOFF_BASE,
+    PROVERKACHEKA_BACKOFF_MAX, PROVERKACHEKA_RATE_LIMIT_DELAY,
+)
+
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+
+async def _notify(progress: ProgressCallback | None, text: str) -> None:
+    if progress is None:
+        return
+    try:
+        await progress(text)
+    except Exception as e:  # Прогресс — косметика, запрос из-за него не роняем
+        logger.debug(f"proverkacheka: не удалось отправить прогресс: {e}")
+
+
+async def fetch_check(
+    build_form: Callable[[], aiohttp.FormData],
+    policy: RetryPolicy = DEFAULT_POLICY,
+    progress: ProgressCallback | None = None,
+    label: str = "",
+) -> tuple[dict | None, str]:
+    """
+    POST на /check/get с повторами по policy.
+    build_form вызывается на каждую попытку: FormData одноразовая.
+    Возвращает (ответ API, "") для окончательных ответов (code 1, а также 0/2/5 —
+    их разбирает вызывающий) или (None, сообщение для пользователя), если
+    дождаться ответа не удалось. При разомкнутом предохранителе — сразу
+    (None, SERVICE_DEGRADED_MSG), без запроса и пауз.
+    """
+    started = time.monotonic()
+    message = "❌ Не удалось получить данные чека."
+    result = None
+    for attempt in range(1, policy.max_attempts + 1):
+        delay = None
+        failed = None  # Вердикт для предохранителя: True — сбой сервиса, None — запроса не было/отменён
+        try:
+            # Попытка ограничена PROVERKACHEKA_TIMEOUT (см. post) и не может пережить общий дедлайн
+            remaining = policy.deadline - (time.monotonic() - started)
+            async with proverkacheka_client.post(build_form(), timeout=max(remaining, 1)) as response:
+                text = await response.text()
+                logger.info(f"proverkacheka {label}: status={response.status}, attempt={attempt}, text={text[:200]}...")
+                failed = response.status >= 500  # 4xx и code 0-5 — сервис жив, даже если отказывает
+                if response.status == 200:
+                    try:
+                        result = json.loads(text)
+                    except json.JSONDecodeError as e:
+                        failed = True
+                        logger.error(f"Invalid JSON from API: {str(e)}, text={text[:200]}...")
+                        if "<html" in text.lower() or "<!doctype" in text.lower():
+                            return None, "❌ Неверный ответ от API (HTML вместо JSON). Проверьте токен или используйте фото QR."
+                        return None, "❌ Некорректный ответ от API (не JSON)."
+                    code = result.get("code")
+                    if code == 3:
+                        delay = max(policy.rate_limit_delay, policy.backoff(attempt))
+                        message = "❌ Превышено количество запросов (code=3). Подождите 1 мин и попробуйте снова."
+                    elif code == 4:
+                        data = result.get("data") if isinstance(result.get("data"), dict) else {}
+                        delay = _safe_wait(data.get("wait"), policy.backoff(attempt))
+                        message = f"❌ Ожидание перед повторным запросом (code=4, wait={delay:.0f}s)."
+                    elif code == 5 and attempt < policy.max_attempts:
+                        # Бывают временные сбои на стороне ФНС — пробуем ещё раз, последний ответ отдаём как есть.
+                        # code 0 (чек некорректен) не повторяем: ответ не изменится, а попытка платная
+                        delay = policy.backoff(attempt)
+                    else:
+                        return result, ""
+                elif response.status == 429 or response.status >= 500:
+                    retry_after = _safe_wait(response.headers.get("Retry-After"), 0)
+                    delay = max(retry_after, policy.backoff(attempt))
+                    message = (
+                        "❌ Лимит запросов (HTTP 429). Подождите 1 мин." if response.status == 429
+                        else f"❌ Ошибка API: HTTP {response.status}. Попробуйте позже."
+                    )
+                else:
+                    return None, f"❌ HTTP Ошибка: code={response.status}. Проверьте данные."
+        except ProverkachekaUnavailable:
+            logger.warning(f"proverkacheka {label}: предохранитель разомкнут, запрос не отправлен")
+            return None, SERVICE_DEGRADED_MSG
+        except asyncio.TimeoutError:
+            failed = True
+            delay = policy.backoff(attempt)
+            message = "❌ Таймаут запроса к API. Проверьте интернет."
+            logger.warning(f"proverkacheka {label}: таймаут, попытка {attempt}/{policy.max_attempts}")
+        except aiohttp.ClientError as e:
+            failed = True
+            delay = policy.backoff(attempt)
+            message = f"⚠️ Ошибка сети: {str(e)}."
+            logger.error(f"proverkacheka {label}: ошибка сети: {str(e)}")
+        finally:
+            if failed:
+                proverkacheka_breaker.record_failure()
+            elif failed is not None:
+                proverkacheka_breaker.record_success()
+
+        if failed and proverkacheka_breaker.is_open:
+            # Этот сбой разомкнул предохранитель — дальше ждать бессмысленно
+            return None, SERVICE_DEGRADED_MSG
+        if attempt == policy.max_attempts:
+            break
+        elapsed = time.monotonic() - started
+        if elapsed + delay >= policy.deadline:
+            logger.warning(f"proverkacheka {label}: пауза {delay:.0f}s не укладывается в дедлайн {policy.deadline:.0f}s")
+            break
+        logger.warning(f"proverkacheka {label}: повтор {attempt + 1}/{policy.max_attempts} через {delay:.1f}s")
+        await _notify(progress, f"⏳ Сервис проверки чеков занят, повторю запрос через {delay:.0f} с (попытка {attempt + 1}/{policy.max_attempts})...")
+        await asyncio.sleep(delay)
+
+    # Исчерпали попытки на временной ошибке API (code 5) — отдаём последний ответ
+    if result is not None and result.get("code") == 5:
+        return result, ""
+    return None, message
+
+
+def _safe_wait(value, default: float) -> float:
+    """Секунды из подсказки сервера (data.wait / Retry-After) или default."""
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        return default
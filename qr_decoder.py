@@ -0,0 +1,67 @@
+"""
+Локальное распознавание фискального QR-кода на фото чека.
+
+Строка QR (`t=...&s=...&fn=...&i=...&fp=...&n=...`) позволяет до любого сетевого
+запроса проверить чек по индексу фискальных номеров и отправить в proverkacheka
+короткий `qrraw` вместо фото на несколько мегабайт. Декодирование CPU-bound,
+поэтому идёт в пуле процессов — event loop не блокируется.
+
+Декодер — OpenCV (`opencv-python-headless`, есть в requirements.txt) или
+pyzbar + Pillow. Если ни одного нет или код не найден, decode_fiscal_qr
+возвращает None и чек распознаётся старым путём — загрузкой фото в API;
+что локальное распознавание выключено, start_qr_decoder пишет в лог на старте.
+"""
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from config import QR_DECODE_ENABLED, QR_DECODE_WORKERS, QR_DECODE_TIMEOUT
+from qr_worker import QR_DECODE_AVAILABLE, QR_DECODER_NAME, decode_qr_sync, parse_fiscal_qr
+
+logger = logging.getLogger("AccountingBot")
+
+_decode_pool: ProcessPoolExecutor | None = None
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _decode_pool
+    if _decode_pool is None:
+        # spawn, а не fork: в процессе бота уже работают потоки (пул Sheets, aiohttp,
+        # APScheduler), и форк унаследовал бы их захваченные блокировки
+        _decode_pool = ProcessPoolExecutor(max_workers=QR_DECODE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _decode_pool
+
+
+async def decode_fiscal_qr(image_bytes: bytes) -> str | None:
+    """Строка фискального QR с фото или None (нет декодера, код не найден, таймаут)."""
+    if not QR_DECODE_ENABLED or not QR_DECODE_AVAILABLE or not image_bytes:
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        payload = await asyncio.wait_for(loop.run_in_executor(_get_pool(), decode_qr_sync, image_bytes), QR_DECODE_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Локальное распознавание QR не удалось: {type(e).__name__}: {e}")
+        return None
+    if payload:
+        logger.info(f"QR распознан локально: {payload}")
+    else:
+        logger.info("QR на фото не найден локально — отправляем фото в API")
+    return payload
+
+
+def start_qr_decoder() -> None:
+    """Один раз на старте: пишет в лог, работает ли локальное распознавание и чем."""
+    if not QR_DECODE_ENABLED:
+        logger.info("Локальное распознавание QR выключено (QR_DECODE_ENABLED=0) — фото уходят в API")
+    elif not QR_DECODE_AVAILABLE:
+        logger.warning("Локальное распознавание QR недоступно: нет ни opencv-python-headless, ни pyzbar — фото уходят в API")
+    else:
+        logger.info(f"Локальное распознавание QR: {QR_DECODER_NAME}, процессов до {QR_DECODE_WORKERS}")
+
+
+def shutdown_qr_decoder() -> None:
+    global _decode_pool
+    if _decode_pool is not None:
+        _decode_pool.shutdown(wait=False, cancel_futures=True)
+        _decode_pool = None
@@ -0,0 +1,72 @@
+"""
+Декодирование QR в процессе пула (qr_decoder).
+
+Пул запускается методом spawn: рабочий процесс импортирует только этот модуль
+(и заново — main.py, где вся инициализация бота под `if __name__ == "__main__"`).
+Поэтому здесь нет импортов бота: ни config (.env), ни Redis, ни Google-клиентов.
+"""
+from urllib.parse import parse_qs
+
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+
+try:
+    from io import BytesIO
+    from PIL import Image
+    from pyzbar import pyzbar
+except ImportError:
+    pyzbar = None
+
+QR_DECODE_AVAILABLE = cv2 is not None or pyzbar is not None
+QR_DECODER_NAME = "OpenCV" if cv2 is not None else "pyzbar" if pyzbar is not None else None
+MAX_DECODE_SIDE = 1600  # Крупные фото уменьшаем: детектору хватает, а работает быстрее
+
+
+def parse_fiscal_qr(payload: str) -> dict | None:
+    """Поля фискального QR (t, s, fn, i, fp, n) или None, если это не чек."""
+    if not payload:
+        return None
+    fields = {key: values[0].strip() for key, values in parse_qs(payload.strip()).items() if values}
+    if not all(fields.get(key, "").isdigit() for key in ("fn", "i", "fp")):
+        return None
+    return fields
+
+
+def _decode_with_cv2(image_bytes: bytes) -> list[str]:
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return []
+    height, width = image.shape[:2]
+    scale = MAX_DECODE_SIDE / max(height, width)
+    candidates = [cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)] if scale < 1 else []
+    candidates.append(image)
+    detector = cv2.QRCodeDetector()
+    for candidate in candidates:
+        ok, decoded, _, _ = detector.detectAndDecodeMulti(candidate)
+        payloads = [text for text in (decoded if ok else []) if text]
+        if payloads:
+            return payloads
+    return []
+
+
+def _decode_with_pyzbar(image_bytes: bytes) -> list[str]:
+    image = Image.open(BytesIO(image_bytes)).convert("L")
+    image.thumbnail((MAX_DECODE_SIDE, MAX_DECODE_SIDE))
+    return [code.data.decode("utf-8", "ignore") for code in pyzbar.decode(image) if code.type == "QRCODE"]
+
+
+def decode_qr_sync(image_bytes: bytes) -> str | None:
+    """Выполняется в процессе пула: первая строка QR, похожая на фискальную."""
+    for decoder, available in ((_decode_with_cv2, cv2 is not None), (_decode_with_pyzbar, pyzbar is not None)):
+        if not available:
+            continue
+        try:
+            for payload in decoder(image_bytes):
+                if parse_fiscal_qr(payload):
+                    return payload.strip()
+        except Exception:
+            continue
+    return None
@@ -0,0 +1,175 @@
+"""
+Модель чека: один проход по JSON proverkacheka, деньги в целых копейках.
+
+API отдаёт суммы в копейках — так и храним (int), в рубли переводим только
+на выходе (to_dict, свойства sum/price). Исключённые позиции (доставка, сборы)
+определяются одним вызовом is_excluded на позицию. Item/Receipt на __slots__:
+крупные чеки маркетплейсов — сотни позиций, и каждая не тащит за собой __dict__.
+
+to_dict() выдаёт прежний формат parsed_data (рубли float) — его хранят FSM и
+читают хендлеры, save_receipt и send_notification.
+"""
+from exceptions import is_excluded
+
+
+def _int(value) -> int:
+    """Целое из числа/строки API; мусор → 0."""
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(round(value))
+    try:
+        return int(round(float(str(value).replace(",", ".").strip())))
+    except (TypeError, ValueError):
+        return 0
+
+
+def rub_to_kop(value) -> int:
+    """Рубли (float/str с запятой) → копейки без накопления ошибки float."""
+    try:
+        return int(round(float(str(value).replace(",", ".").strip()) * 100))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _quantity(value) -> float | int:
+    if isinstance(value, int) and value > 0:
+        return value
+    try:
+        quantity = float(value)
+    except (TypeError, ValueError):
+        return 1
+    if quantity <= 0:
+        return 1
+    return int(quantity) if quantity.is_integer() else quantity
+
+
+class Item:
+    __slots__ = ("name", "sum_kop", "price_kop", "quantity", "link", "comment", "delivery_date")
+
+    def __init__(self, name: str, sum_kop: int, price_kop: int, quantity: float | int = 1,
+                 link: str = "", comment: str = "", delivery_date: str = ""):
+        self.name = name
+        self.sum_kop = sum_kop
+        self.price_kop = price_kop
+        self.quantity = quantity
+        self.link = link
+        self.comment = comment
+        self.delivery_date = delivery_date
+
+    @classmethod
+    def from_api(cls, raw: dict) -> "Item":
+        """Позиция из data.json.items (суммы уже в копейках)."""
+        return cls(
+            (raw.get("name") or "Неизвестно").strip(),
+            _int(raw.get("sum", 0)),
+            _int(raw.get("price", 0)),
+            _quantity(raw.get("quantity", 1)),
+        )
+
+    @classmethod
+    def from_dict(cls, item: dict) -> "Item":
+        """Позиция из parsed_data/уведомления (рубли); цена по умолчанию — сумма / количество."""
+        quantity = _quantity(item.get("quantity", 1) or 1)
+        sum_kop = rub_to_kop(item.get("sum", 0))
+        price_kop = rub_to_kop(item.get("price", 0)) or int(round(sum_kop / quantity))
+        return cls(
+            item.get("name") or "—",
+            sum_kop,
+            price_kop,
+            quantity,
+            str(item.get("link") or "").strip(),
+            str(item.get("comment") or "").strip(),
+            str(item.get("delivery_date") or "").strip(),
+        )
+
+    @property
+    def sum(self) -> float:
+        return self.sum_kop / 100
+
+    @property
+    def price(self) -> float:
+        return self.price_kop / 100
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "sum": self.sum, "price": self.price, "quantity": self.quantity}
+
+
+class Receipt:
+    __slots__ = (
+        "fiscal_doc", "date", "store", "items", "excluded", "total_kop", "prepaid_kop",
+        "qr_string", "operation_type", "pdf_url", "taxes_kop",
+    )
+
+    TAX_FIELDS = ("nds18", "nds", "nds0", "ndsNo", "cashTotalSum", "ecashTotalSum")
+
+    def __init__(self):
+        self.items: list[Item] = []
+        self.excluded: list[Item] = []
+
+    @classmethod
+    def from_api(
+        cls,
+        result: dict,
+        fallback_fiscal_doc: str = "unknown",
+        fallback_date: str = "",
+        fallback_qrraw: str = "",
+        fallback_operation_type: int = 1,
+        fallback_item_sum_kop: int = 0,
+    ) -> "Receipt | None":
+        """Разбор ответа code=1. None — в ответе нет data.json."""
+        data_block = result.get("data") or {}
+        data_json = data_block.get("json") or {}
+        if not data_json:
+            return None
+
+        receipt = cls()
+        items_sum_kop = 0
+        for raw in data_json.get("items", []):
+            item = Item.from_api(raw)
+            items_sum_kop += item.sum_kop
+            (receipt.excluded if is_excluded(item.name) else receipt.items).append(item)
+
+        if not receipt.items and fallback_item_sum_kop:
+            # Ручной ввод: API не отдал позиции — одна позиция на всю сумму
+            receipt.items.append(Item("Товар из чека", fallback_item_sum_kop, fallback_item_sum_kop, 1))
+
+        # Полная сумма чека; если API не дал totalSum — сумма позиций
+        receipt.total_kop = _int(data_json.get("totalSum", 0)) or items_sum_kop
+        receipt.prepaid_kop = _int(data_json.get("prepaidSum", 0))
+        receipt.fiscal_doc = data_json.get("fiscalDocumentNumber", fallback_fiscal_doc)
+        receipt.date = (data_json.get("dateTime") or data_json.get("ticketDate") or "").split("T")[0].replace("-", ".") or fallback_date
+        receipt.store = data_json.get("user") or data_json.get("retailPlace") or "Неизвестно"
+        receipt.qr_string = (result.get("request") or {}).get("qrraw", "") or fallback_qrraw
+        receipt.operation_type = data_json.get("operationType", fallback_operation_type)
+        receipt.pdf_url = data_block.get("pdfurl", "")
+        receipt.taxes_kop = {field: _int(data_json.get(field, 0)) for field in cls.TAX_FIELDS}
+        return receipt
+
+    @property
+    def excluded_kop(self) -> int:
+        return sum(item.sum_kop for item in self.excluded)
+
+    @property
+    def filtered_total_kop(self) -> int:
+        """Сумма без исключённых позиций (доставка/услуги) — то, что списывается как товары."""
+        return self.total_kop - self.excluded_kop
+
+    def to_dict(self) -> dict:
+        """Прежний формат parsed_data (рубли)."""
+        data = {
+            "fiscal_doc": self.fiscal_doc,
+            "date": self.date,
+            "store": self.store,
+            "items": [item.to_dict() for item in self.items],
+            "qr_string": self.qr_string,
+            "operation_type": self.operation_type,
+            "prepaid_sum": self.prepaid_kop / 100,
+            "total_sum": self.filtered_total_kop / 100,  # Для add.py (без исключённых)
+            "totalSum": self.total_kop / 100,  # Полная — для return_.py
+            "excluded_sum": self.excluded_kop / 100,
+            "excluded_items": [item.name for item in self.excluded],
+            "pdf_url": self.pdf_url,
+        }
+        data.update({field: value / 100 for field, value in self.taxes_kop.items()})
+        return data
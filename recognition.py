@@ -0,0 +1,91 @@
+"""
+Очередь распознавания чеков: фиксированный пул воркеров и лимит на пользователя.
+
+Хендлер кладёт задачу в очередь и сразу возвращается, а воркер сам
+редактирует сообщение «⌛ Обрабатываю фото чека...», когда ответ готов. Медленный
+proverkacheka больше не обрывается жёстким wait_for, а всплеск фото не
+превращается в неограниченное число параллельных запросов к API.
+"""
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+from config import RECOGNITION_WORKERS, RECOGNITION_QUEUE_SIZE, RECOGNITION_PER_USER, RECOGNITION_JOB_TIMEOUT
+
+logger = logging.getLogger("AccountingBot")
+
+
+class RecognitionBusy(Exception):
+    """Задачу не приняли: очередь заполнена или у пользователя слишком много фото в работе."""
+
+
+class RecognitionQueue:
+    def __init__(self, workers: int, maxsize: int, per_user: int, job_timeout: float):
+        self._workers_count = workers
+        self._maxsize = maxsize
+        self._per_user = per_user
+        self._job_timeout = job_timeout
+        self._queue: asyncio.Queue | None = None
+        self._workers: list[asyncio.Task] = []
+        self._active: dict[int, int] = {}  # user_id -> задач в очереди и в работе
+
+    def start(self) -> None:
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self._maxsize)
+        self._workers = [asyncio.create_task(self._worker(n)) for n in range(self._workers_count)]
+        logger.info(f"Очередь распознавания: {self._workers_count} воркеров, до {self._maxsize} задач, {self._per_user} на пользователя")
+
+    async def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def submit(
+        self,
+        user_id: int,
+        run: Callable[[], Awaitable[None]],
+        on_error: Callable[[BaseException], Awaitable[None]] | None = None,
+    ) -> int:
+        """Ставит задачу в очередь; возвращает число задач перед ней. RecognitionBusy — если не влезла."""
+        if not self._workers:
+            self.start()
+        if self._active.get(user_id, 0) >= self._per_user:
+            raise RecognitionBusy(f"⏳ У вас уже обрабатывается {self._per_user} фото. Дождитесь результата.")
+        try:
+            self._queue.put_nowait((user_id, run, on_error))
+        except asyncio.QueueFull:
+            raise RecognitionBusy("⏳ Сейчас слишком много чеков в обработке. Попробуйте через минуту.")
+        self._active[user_id] = self._active.get(user_id, 0) + 1
+        return self._queue.qsize() - 1
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue else 0,
+            "workers": len(self._workers),
+            "users": sum(1 for count in self._active.values() if count),
+        }
+
+    async def _worker(self, n: int) -> None:
+        while True:
+            user_id, run, on_error = await self._queue.get()
+            try:
+                await asyncio.wait_for(run(), self._job_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Распознавание (воркер {n}): {type(e).__name__}: {e}, user_id={user_id}")
+                if on_error is not None:
+                    try:
+                        await on_error(e)
+                    except Exception as notify_error:
+                        logger.error(f"Распознавание: не удалось сообщить об ошибке: {notify_error}")
+            finally:
+                self._active[user_id] = self._active.get(user_id, 1) - 1
+                if self._active[user_id] <= 0:
+                    self._active.pop(user_id, None)
+                self._queue.task_done()
+
+
+recognition_queue = RecognitionQueue(RECOGNITION_WORKERS, RECOGNITION_QUEUE_SIZE, RECOGNITION_PER_USER, RECOGNITION_JOB_TIMEOUT)
@@ -1,16 +1,32 @@
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
+from concurrent.futures import ThreadPoolExecutor
+import httplib2
+import threading
+import contextvars
+import time
 import json
 import logging
 import asyncio
-from config import SHEET_NAME, GOOGLE_CREDENTIALS
+import re
+import math
+import hashlib
+import random
+import copy
+from config import SHEET_NAME, GOOGLE_CREDENTIALS, FISCAL_BLOOM_ENABLED, FISCAL_BLOOM_CAPACITY, FISCAL_BLOOM_ERROR_RATE, SHEETS_APPEND_WINDOW_MS, SHEETS_POOL_SIZE, SHEETS_HTTP_TIMEOUT, SHEETS_BACKEND
+from config import BALANCE_RECONCILE_INTERVAL, BALANCE_RECONCILE_DELAY
+from config import SHEETS_READ_PER_MINUTE, SHEETS_WRITE_PER_MINUTE, SHEETS_RATE_BURST, SHEETS_MAX_RETRIES, SHEETS_BACKOFF_BASE, SHEETS_BACKOFF_MAX
 from datetime import datetime
 from googleapiclient.errors import HttpError
-from utils import redis_client, cache_get, cache_set, safe_float, normalize_date
+from redis.exceptions import WatchError
+from utils import redis_client, redis_key, cache_codec, cache_get, cache_set, cache_set_many, cache_delete, cache_invalidate, on_cache_invalidation, safe_float, normalize_date
+from sheets_aio import aio_client
+from receipt_model import Item
 
 logger = logging.getLogger("AccountingBot")
 # NOVOYE: Ключ для кэша баланса и время жизни (TTL)
-BALANCE_CACHE_KEY = "monthly_balance"  # Имя ключа в Redis
+BALANCE_CACHE_KEY = redis_key("balance", "monthly")  # Имя ключа в Redis
 BALANCE_EXPIRE = 30  # 30 секунд — баланс не меняется часто, но обновляем timely
 
 # Инициализация Google Sheets API
@@ -59,88 +75,890 @@ def get_target_summary_sheet(date_str: str) -> str:
         return "Сводка!A:E"
     return f"{get_archive_sheet_name(date_str)}!A:E"
 
-async def async_sheets_call(method_callable, *args, **kwargs):
-    loop = asyncio.get_event_loop()
+# ---------------------------------------------------------
+# Пул потоков для блокирующих execute() googleapiclient
+# ---------------------------------------------------------
+# httplib2 не потокобезопасен, поэтому у каждого потока пула свой транспорт
+# (AuthorizedHttp + свои credentials). sheets_service используется только для
+# сборки HttpRequest, исполняется он на http текущего потока.
+_sheets_executor = ThreadPoolExecutor(max_workers=SHEETS_POOL_SIZE, thread_name_prefix="sheets")
+_thread_local = threading.local()
+_pool_stats = {
+    "calls": 0, "errors": 0, "retries": 0, "coalesced": 0, "in_flight": 0,
+    "wait_total": 0.0, "wait_max": 0.0, "exec_total": 0.0, "exec_max": 0.0,
+    "throttle_total": 0.0, "throttle_max": 0.0,
+}
+# Тайминги последнего вызова в текущей задаче:
+# {"wait": сек в очереди пула, "exec": сек выполнения, "throttle": сек ожидания квоты/backoff}
+sheets_call_timings: contextvars.ContextVar[dict | None] = contextvars.ContextVar("sheets_call_timings", default=None)
+
+def _thread_http() -> AuthorizedHttp:
+    http = getattr(_thread_local, "http", None)
+    if http is None:
+        thread_creds = service_account.Credentials.from_service_account_info(
+            GOOGLE_CREDENTIALS, scopes=['https://www.googleapis.com/auth/spreadsheets']
+        )
+        http = AuthorizedHttp(thread_creds, http=httplib2.Http(timeout=SHEETS_HTTP_TIMEOUT))
+        _thread_local.http = http
+        logger.debug(f"Sheets: создан клиент для потока {threading.current_thread().name}")
+    return http
+
+def get_sheets_pool_stats() -> dict:
+    """Снимок статистики пула: очередь, ожидание и время выполнения."""
+    stats = dict(_pool_stats)
+    stats["pool_size"] = SHEETS_POOL_SIZE
+    stats["queued"] = max(0, stats["in_flight"] - SHEETS_POOL_SIZE)
+    calls = max(stats["calls"], 1)
+    stats["wait_avg"] = stats["wait_total"] / calls
+    stats["exec_avg"] = stats["exec_total"] / calls
+    stats["throttle_avg"] = stats["throttle_total"] / calls
+    stats["read_rate"] = _read_bucket.rate * 60
+    stats["write_rate"] = _write_bucket.rate * 60
+    return stats
+
+def shutdown_sheets_executor() -> None:
+    _sheets_executor.shutdown(wait=False, cancel_futures=True)
+
+async def start_sheets_backend() -> None:
+    """Открывает keep-alive сессию, если выбран SHEETS_BACKEND=aiohttp."""
+    if SHEETS_BACKEND == "aiohttp":
+        await aio_client.start()
+
+async def close_sheets_backend() -> None:
+    if SHEETS_BACKEND == "aiohttp":
+        await aio_client.close()
+    shutdown_sheets_executor()
+
+# ---------------------------------------------------------
+# Квоты Google Sheets: token bucket на чтение/запись + backoff на 429
+# ---------------------------------------------------------
+# Квота считается на service account в минуту отдельно для чтения и записи.
+# Каждый вызов берёт токен из своего ведра (GET — чтение, остальное — запись).
+# На 429 ведро «замораживается» на Retry-After/backoff для всех вызывающих,
+# а скорость временно снижается вдвое и плавно возвращается после успехов.
+class _TokenBucket:
+    def __init__(self, name: str, per_minute: int, burst: int):
+        self.name = name
+        self.base_rate = per_minute / 60.0
+        self.rate = self.base_rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Ждёт токен (FIFO). Возвращает, сколько секунд пришлось ждать."""
+        started = time.monotonic()
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    break
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+        return time.monotonic() - started
+
+    def penalize(self, delay: float) -> None:
+        """429: пауза для всех и снижение скорости вдвое (не ниже 10% от базовой)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        self.tokens = 0.0
+        self.rate = max(self.rate / 2, self.base_rate * 0.1)
+
+    def recover(self) -> None:
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * 0.05)
+
+_read_bucket = _TokenBucket("read", SHEETS_READ_PER_MINUTE, SHEETS_RATE_BURST)
+_write_bucket = _TokenBucket("write", SHEETS_WRITE_PER_MINUTE, SHEETS_RATE_BURST)
+
+def _retry_delay(error: HttpError, attempt: int, is_write: bool) -> float | None:
+    """Пауза перед повтором или None, если повторять нельзя.
+    Запись повторяем только на 429: на 5xx append мог уже примениться."""
+    status = getattr(error.resp, "status", 0)
+    if attempt > SHEETS_MAX_RETRIES:
+        return None
+    if status != 429 and (is_write or status not in (500, 502, 503, 504)):
+        return None
+    backoff = min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * 2 ** (attempt - 1))
+    delay = random.uniform(backoff / 2, backoff)  # jitter, чтобы повторы не шли залпом
+    try:
+        delay = max(delay, float(error.resp.get("retry-after", 0)))
+    except (TypeError, ValueError):
+        pass
+    return delay
+
+async def _execute_request(request, timings: dict):
+    """Один HTTP-вызов выбранным backend'ом; накапливает wait/exec в timings."""
+    submitted = time.perf_counter()
+    if SHEETS_BACKEND == "aiohttp":
+        try:
+            return await aio_client.execute(request)
+        finally:
+            timings["exec"] += time.perf_counter() - submitted
+
     def make_call():
-        request = method_callable(*args, **kwargs)
-        return request.execute()
+        started = time.perf_counter()
+        timings["wait"] += started - submitted
+        try:
+            return request.execute(http=_thread_http())
+        finally:
+            timings["exec"] += time.perf_counter() - started
+    return await asyncio.get_running_loop().run_in_executor(_sheets_executor, make_call)
+
+async def _sheets_call(request, timings: dict):
+    is_write = request.method.upper() != "GET"
+    bucket = _write_bucket if is_write else _read_bucket
+
+    _pool_stats["in_flight"] += 1
     try:
-        result = await loop.run_in_executor(None, make_call)
-        return result
+        attempt = 0
+        while True:
+            attempt += 1
+            timings["throttle"] += await bucket.acquire()
+            try:
+                result = await _execute_request(request, timings)
+                bucket.recover()
+                return result
+            except HttpError as e:
+                delay = _retry_delay(e, attempt, is_write)
+                if delay is None:
+                    raise
+                _pool_stats["retries"] += 1
+                bucket.penalize(delay)
+                logger.warning(f"Sheets {e.status_code} ({bucket.name}): повтор {attempt}/{SHEETS_MAX_RETRIES} через {delay:.1f}s")
+                await asyncio.sleep(delay)
+                timings["throttle"] += delay
     except Exception as e:
+        _pool_stats["errors"] += 1
         logger.error(f"Async sheets call error: {str(e)}")
         raise
+    finally:
+        _pool_stats["in_flight"] -= 1
+        _pool_stats["calls"] += 1
+        _pool_stats["wait_total"] += timings["wait"]
+        _pool_stats["exec_total"] += timings["exec"]
+        _pool_stats["throttle_total"] += timings["throttle"]
+        _pool_stats["wait_max"] = max(_pool_stats["wait_max"], timings["wait"])
+        _pool_stats["exec_max"] = max(_pool_stats["exec_max"], timings["exec"])
+        _pool_stats["throttle_max"] = max(_pool_stats["throttle_max"], timings["throttle"])
+        if timings["throttle"] > 1.0:
+            logger.warning(f"Sheets quota: вызов ждал {timings['throttle']:.2f}s ({bucket.name}, rate={bucket.rate * 60:.0f}/мин)")
+        if timings["wait"] > 1.0:
+            logger.warning(f"Sheets pool: ожидание в очереди {timings['wait']:.2f}s (in_flight={_pool_stats['in_flight']}, pool={SHEETS_POOL_SIZE})")
+        else:
+            logger.debug(f"Sheets call: wait={timings['wait'] * 1000:.0f}ms exec={timings['exec'] * 1000:.0f}ms throttle={timings['throttle'] * 1000:.0f}ms")
 
-async def is_user_allowed(user_id: int) -> str | None:
-    cache_key = f"user_allowed:{user_id}"
-    cached = await cache_get(cache_key)
-    if cached is not None:
-        logger.debug(f"Cache hit for user_id={user_id}")
-        return cached
+# ---------------------------------------------------------
+# Single-flight для чтений
+# ---------------------------------------------------------
+# Одинаковые GET (тот же spreadsheet, диапазон и параметры — всё это есть в URI),
+# пришедшие, пока первый ещё в полёте, не идут в API, а ждут его результат.
+# Запрос исполняется отдельной задачей: отмена одного из ожидающих не рвёт его
+# для остальных. Если ожидающих было несколько, каждый получает свою копию —
+# вызывающие (например, _pad_row) меняют строки на месте.
+_inflight_reads: dict[str, list] = {}  # uri -> [task, timings, число ожидающих]
+
+async def async_sheets_call(method_callable, *args, **kwargs):
+    # Сборка HttpRequest — без сети, можно прямо в event loop
+    request = method_callable(*args, **kwargs)
+    if request.method.upper() != "GET":
+        timings = {"wait": 0.0, "exec": 0.0, "throttle": 0.0}
+        try:
+            return await _sheets_call(request, timings)
+        finally:
+            sheets_call_timings.set(timings)
 
-    list_key = "allowed_users_list"
-    allowed_list = await cache_get(list_key)
-    if allowed_list is None:
+    key = request.uri
+    entry = _inflight_reads.get(key)
+    if entry is None:
+        timings = {"wait": 0.0, "exec": 0.0, "throttle": 0.0}
+
+        async def run():
+            try:
+                return await _sheets_call(request, timings)
+            finally:
+                # Снимаем до пробуждения ожидающих: после этого число ожидающих окончательное
+                _inflight_reads.pop(key, None)
+
+        entry = [asyncio.create_task(run()), timings, 0]
+        _inflight_reads[key] = entry
+    else:
+        _pool_stats["coalesced"] += 1
+        logger.debug(f"Sheets single-flight: присоединились к чтению {key[:120]}")
+    entry[2] += 1
+    try:
+        result = await asyncio.shield(entry[0])
+    finally:
+        sheets_call_timings.set(entry[1])
+    return copy.deepcopy(result) if entry[2] > 1 else result
+
+# ---------------------------------------------------------
+# Зеркало листа Чеки!A:Q (в памяти процесса)
+# ---------------------------------------------------------
+# _receipts_rows[i] соответствует строке листа i + RECEIPTS_FIRST_ROW.
+# Полная загрузка — один раз на старте (и раз в RECEIPTS_FULL_SYNC_INTERVAL),
+# дальше зеркало обновляется на месте: save_receipt, возврат/доставка и
+# дешёвая периодическая дочитка хвоста (sync_receipts_tail).
+# Ячейки хранятся так, как их отдаёт лист (FORMATTED_VALUE, строки): свои
+# записи кладём в зеркало из updatedData ответа API, а не из отправленных
+# значений (float в C/D/E, формула =HYPERLINK в N).
+RECEIPTS_RANGE = "Чеки!A:Q"
+RECEIPTS_COLUMNS = 17  # A..Q
+RECEIPTS_FIRST_ROW = 2  # Строка 1 — заголовок
+
+_receipts_rows: list[list] = []
+_receipts_loaded = False
+_receipts_lock = asyncio.Lock()
+# Записи в зеркало, сделанные, пока полная загрузка ждёт лист: накатываются на новый снимок
+_mirror_journal: list[tuple[str, int | None, object]] | None = None
+# Первая строка-заглушка: строка легла ниже конца зеркала (чужой или не по порядку
+# пришедший append), промежуток заполнен пустыми строками — их перечитает дочитка хвоста
+_mirror_gap_from: int | None = None
+# (fiscal_doc, item_name) → номера строк листа (одинаковые позиции в чеке — несколько строк)
+_row_index: dict[tuple[str, str], list[int]] = {}
+
+def _pad_row(row: list) -> list:
+    """Копия строки, дополненная пустыми ячейками до A:Q."""
+    row = list(row)
+    if len(row) < RECEIPTS_COLUMNS:
+        row.extend([""] * (RECEIPTS_COLUMNS - len(row)))
+    return row
+
+def _parse_start_row(updated_range: str) -> int | None:
+    """'Чеки'!A120:Q122 → 120."""
+    match = re.search(r"![A-Z]+(\d+)", updated_range or "")
+    return int(match.group(1)) if match else None
+
+def _row_key(row: list) -> tuple[str, str] | None:
+    fiscal_doc = str(row[12] or "").strip()
+    item_name = str(row[10] or "").strip()
+    return (fiscal_doc, item_name) if fiscal_doc and item_name else None
+
+def _index_row(row_number: int, row: list) -> None:
+    key = _row_key(row)
+    if key:
+        numbers = _row_index.setdefault(key, [])
+        if row_number not in numbers:
+            numbers.append(row_number)
+            numbers.sort()
+
+def _unindex_row(row_number: int, row: list) -> None:
+    key = _row_key(row)
+    numbers = _row_index.get(key) if key else None
+    if numbers and row_number in numbers:
+        numbers.remove(row_number)
+        if not numbers:
+            del _row_index[key]
+
+def _rebuild_row_index() -> None:
+    _row_index.clear()
+    for i, row in enumerate(_receipts_rows):
+        _index_row(i + RECEIPTS_FIRST_ROW, row)
+
+def _set_mirror_rows(start_row: int, rows: list[list]) -> None:
+    """Кладёт строки в зеркало по абсолютному номеру (идемпотентно), обновляя индекс строк."""
+    global _mirror_gap_from
+    offset = start_row - RECEIPTS_FIRST_ROW
+    if offset < 0:
+        return
+    if offset > len(_receipts_rows):
+        gap_row = len(_receipts_rows) + RECEIPTS_FIRST_ROW
+        _mirror_gap_from = gap_row if _mirror_gap_from is None else min(_mirror_gap_from, gap_row)
+    needed = offset + len(rows)
+    if len(_receipts_rows) < needed:
+        _receipts_rows.extend([_pad_row([]) for _ in range(needed - len(_receipts_rows))])
+    for i, row in enumerate(rows):
+        row_number = start_row + i
+        _unindex_row(row_number, _receipts_rows[offset + i])
+        _receipts_rows[offset + i] = _pad_row(row)
+        _index_row(row_number, _receipts_rows[offset + i])
+
+def _set_mirror_cells(row_number: int, cells: dict[int, object]) -> None:
+    offset = row_number - RECEIPTS_FIRST_ROW
+    if 0 <= offset < len(_receipts_rows):
+        row = list(_receipts_rows[offset])
+        for col, value in cells.items():
+            row[col] = value
+        _set_mirror_rows(row_number, [row])
+
+def _replay_mirror_journal(journal: list) -> None:
+    # Записи идемпотентны (по номеру строки), поэтому попавшие и в прочитанное не задвоятся
+    for kind, row_number, payload in journal:
+        if kind == "rows":
+            _set_mirror_rows(row_number, payload)
+        else:
+            _set_mirror_cells(row_number, payload)
+
+async def load_receipts_mirror(force: bool = False) -> int:
+    """Полная загрузка Чеки!A:Q в зеркало. Возвращает число строк."""
+    global _receipts_rows, _receipts_loaded, _mirror_journal, _mirror_gap_from
+    async with _receipts_lock:
+        if _receipts_loaded and not force:
+            return len(_receipts_rows)
+        _mirror_journal = []
         try:
             result = await async_sheets_call(
                 sheets_service.spreadsheets().values().get,
-                spreadsheetId=SHEET_NAME, range="AllowedUsers!A:B"
+                spreadsheetId=SHEET_NAME, range=RECEIPTS_RANGE, fields="values"
             )
-            rows = result.get("values", [])[1:]
-            allowed_list = [(int(row[0]), row[1] if len(row) > 1 else f"User_{row[0]}") for row in rows if len(row) > 0 and row[0].isdigit()]
-            await cache_set(list_key, allowed_list, expire=300)
-            logger.info(f"Allowed users list cached: {len(allowed_list)} users")
-        except Exception as e:
-            logger.error(f"Error loading allowed users: {str(e)}")
-            allowed_list = []
+            journal = _mirror_journal
+        finally:
+            _mirror_journal = None
+        _receipts_rows = [_pad_row(row) for row in result.get("values", [])[1:]]
+        _mirror_gap_from = None
+        _rebuild_row_index()
+        _receipts_loaded = True
+        _replay_mirror_journal(journal)
+        if journal:
+            logger.info(f"Зеркало Чеки: накатано {len(journal)} записей, сделанных во время загрузки")
+        logger.info(f"Зеркало Чеки!A:Q загружено: {len(_receipts_rows)} строк")
+        return len(_receipts_rows)
 
-    for uid, user_name in allowed_list:
-        if uid == user_id:
-            await cache_set(cache_key, user_name, expire=86400)
-            logger.info(f"User allowed: user_id={user_id}, name={user_name}")
-            return user_name
+async def get_receipts_rows() -> list[list]:
+    """
+    Строки Чеки!A:Q из зеркала (без заголовка, каждая дополнена до 17 ячеек).
+    Строка с индексом i — это строка листа i + 2. Список общий: не изменять,
+    для записи использовать update_mirror_cells.
+    """
+    if not _receipts_loaded:
+        await load_receipts_mirror()
+    return _receipts_rows
 
-    await cache_set(cache_key, None, expire=86400)
-    logger.debug(f"User not allowed: user_id={user_id}")
+async def sync_receipts_tail() -> int:
+    """
+    Дочитывает строки, появившиеся ниже зеркала (добавлены вручную или другим процессом),
+    начиная с первой строки-заглушки, если такие есть.
+    """
+    global _mirror_journal, _mirror_gap_from
+    if not _receipts_loaded:
+        return await load_receipts_mirror()
+    try:
+        async with _receipts_lock:
+            next_row = len(_receipts_rows) + RECEIPTS_FIRST_ROW
+            gap_from = _mirror_gap_from
+            if gap_from is not None:
+                next_row = min(next_row, gap_from)
+            # Заглушки, появившиеся во время чтения, отметятся заново; свои записи за это время — из журнала
+            _mirror_gap_from = None
+            _mirror_journal = []
+            try:
+                result = await async_sheets_call(
+                    sheets_service.spreadsheets().values().get,
+                    spreadsheetId=SHEET_NAME, range=f"Чеки!A{next_row}:Q", fields="values"
+                )
+                journal = _mirror_journal
+            except Exception:
+                if gap_from is not None:
+                    _mirror_gap_from = gap_from if _mirror_gap_from is None else min(_mirror_gap_from, gap_from)
+                raise
+            finally:
+                _mirror_journal = None
+            new_rows = result.get("values", [])
+            if new_rows:
+                _set_mirror_rows(next_row, new_rows)
+            _replay_mirror_journal(journal)
+            if new_rows:
+                await _index_fiscal_docs(_fiscal_docs_from_rows(new_rows))  # Строки от других процессов/ручного ввода
+                logger.info(f"Зеркало Чеки: дочитано {len(new_rows)} строк с {next_row}")
+            return len(new_rows)
+    except Exception as e:
+        logger.error(f"Ошибка дочитки хвоста Чеки: {str(e)}")
+        return 0
+
+async def refresh_receipts_mirror() -> None:
+    """Периодическая полная перезагрузка (ловит ручные правки существующих строк)."""
+    try:
+        await load_receipts_mirror(force=True)
+        await rebuild_fiscal_index()
+    except Exception as e:
+        logger.error(f"Ошибка полной перезагрузки зеркала Чеки: {str(e)}")
+
+_HYPERLINK_RE = re.compile(r'^=HYPERLINK\("[^"]*";\s*"([^"]*)"\)$')
+
+def _display_cell(value) -> str:
+    """Запасной вариант, если ответ API без updatedData: значение строкой, формула гиперссылки — её текстом."""
+    if isinstance(value, str):
+        match = _HYPERLINK_RE.match(value)
+        return match.group(1) if match else value
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def mirror_append_rows(rows: list[list], result: dict) -> None:
+    """Отражает append в зеркале по ответу append_rows: строки из updatedData, место — по updatedRange."""
+    updates = result.get("updates", {})
+    start_row = _parse_start_row(updates.get("updatedRange", ""))
+    rendered = (updates.get("updatedData") or {}).get("values")
+    if rendered is None or len(rendered) != len(rows):
+        rendered = [[_display_cell(cell) for cell in row] for row in rows]
+    if _mirror_journal is not None and start_row:
+        _mirror_journal.append(("rows", start_row, rendered))
+    if not _receipts_loaded:
+        return  # Зеркало ещё не загружено — первая загрузка увидит эти строки
+    # Без updatedRange — в конец; при полной загрузке такие строки подхватит дочитка хвоста
+    _set_mirror_rows(start_row or len(_receipts_rows) + RECEIPTS_FIRST_ROW, rendered)
+
+def update_mirror_cells(row_number: int, cells: dict[int, object]) -> None:
+    """Обновляет ячейки строки зеркала после записи в лист (значения — как их отдаёт лист)."""
+    if _mirror_journal is not None:
+        _mirror_journal.append(("cells", row_number, cells))
+    if _receipts_loaded:
+        _set_mirror_cells(row_number, cells)
+
+def reset_receipts_mirror() -> None:
+    """Сбрасывает зеркало — следующий читатель загрузит лист заново."""
+    global _receipts_rows, _receipts_loaded, _mirror_gap_from
+    _receipts_rows = []
+    _mirror_gap_from = None
+    _row_index.clear()
+    _receipts_loaded = False
+
+async def find_receipt_row(fiscal_doc: str, item_name: str, skip_status: str | None = "Возвращен") -> int | None:
+    """Номер строки листа для позиции (fiscal_doc, item_name) без чтения листа."""
+    if not _receipts_loaded:
+        await load_receipts_mirror()
+    for row_number in _row_index.get((str(fiscal_doc).strip(), str(item_name).strip()), []):
+        if skip_status and _receipts_rows[row_number - RECEIPTS_FIRST_ROW][8] == skip_status:
+            continue
+        return row_number
     return None
 
+def get_receipt_row(row_number: int) -> list | None:
+    """Строка зеркала по номеру строки листа (копия) или None."""
+    offset = row_number - RECEIPTS_FIRST_ROW
+    if not _receipts_loaded or offset < 0 or offset >= len(_receipts_rows):
+        return None
+    return list(_receipts_rows[offset])
+
+def _column_letter(col: int) -> str:
+    return chr(ord("A") + col)  # Чеки — только A..Q
+
+async def update_receipt_cells(changes: dict[int, dict[int, object]]) -> bool:
+    """
+    Точечная запись ячеек Чеки одним values.batchUpdate, без предварительного чтения.
+    changes: {номер строки: {индекс столбца (0=A): значение}}. Соседние столбцы
+    объединяются в один диапазон. После успешной записи обновляет зеркало и индекс.
+    """
+    data = []
+    runs = []  # (номер строки, столбцы) — в том же порядке, что и data
+    for row_number, cells in changes.items():
+        cols = sorted(cells)
+        run = [cols[0]]
+        for col in cols[1:] + [None]:
+            if col is not None and col == run[-1] + 1:
+                run.append(col)
+                continue
+            data.append({
+                "range": f"Чеки!{_column_letter(run[0])}{row_number}:{_column_letter(run[-1])}{row_number}",
+                "values": [[cells[c] for c in run]]
+            })
+            runs.append((row_number, run))
+            if col is not None:
+                run = [col]
+    responses = await batch_update_sheets(data, response_values=True) if data else False
+    if not responses:
+        return False
+
+    # В зеркало — значения, как их отрисовал лист (формула → текст ссылки)
+    mirrored: dict[int, dict[int, object]] = {}
+    for (row_number, run), response in zip(runs, responses):
+        rendered = (response.get("updatedData") or {}).get("values")
+        values = rendered[0] if rendered else []
+        for i, col in enumerate(run):
+            if rendered is None:
+                value = _display_cell(changes[row_number][col])
+            else:
+                value = values[i] if i < len(values) else ""  # Пустые ячейки в конце лист не отдаёт
+            mirrored.setdefault(row_number, {})[col] = value
+    for row_number, cells in mirrored.items():
+        update_mirror_cells(row_number, cells)
+    return True
+
+# ---------------------------------------------------------
+# Справочник допущенных пользователей (лист AllowedUsers!A:B)
+# ---------------------------------------------------------
+# В памяти — dict user_id → имя; is_user_allowed — просто поиск по словарю.
+# Копия в Redis-хэше users:allowed (поле — user_id, значение — [строка листа, имя]),
+# чтобы другие процессы и перезапуски не читали лист. /add_user и /remove_user
+# пишут одну строку листа, правят хэш и рассылают инвалидацию: остальные
+# процессы перечитывают хэш при следующей проверке.
+ALLOWED_USERS_KEY = redis_key("users", "allowed")
+ALLOWED_USERS_RANGE = "AllowedUsers!A:B"
+_users_dir: dict[int, str] | None = None
+_users_rows: dict[int, int] = {}
+_users_lock = asyncio.Lock()
+
+def _drop_users_directory() -> None:
+    global _users_dir
+    _users_dir = None
+
+on_cache_invalidation(ALLOWED_USERS_KEY, _drop_users_directory)
+
+async def _read_users_sheet() -> tuple[dict[int, str], dict[int, int]]:
+    result = await async_sheets_call(
+        sheets_service.spreadsheets().values().get,
+        spreadsheetId=SHEET_NAME, range=ALLOWED_USERS_RANGE, fields="values"
+    )
+    users, rows = {}, {}
+    for row_number, row in enumerate(result.get("values", [])[1:], start=2):
+        if row and str(row[0]).strip().isdigit():
+            user_id = int(row[0])
+            users[user_id] = row[1] if len(row) > 1 and row[1] else f"User_{user_id}"
+            rows[user_id] = row_number
+    return users, rows
+
+async def _store_users_hash(users: dict[int, str], rows: dict[int, int]) -> None:
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(ALLOWED_USERS_KEY)
+            if users:
+                pipe.hset(ALLOWED_USERS_KEY, mapping={
+                    str(user_id): json.dumps([rows.get(user_id), name], ensure_ascii=False)
+                    for user_id, name in users.items()
+                })
+            await pipe.execute()
+        await cache_invalidate(ALLOWED_USERS_KEY)
+    except Exception as e:
+        logger.error(f"Ошибка записи справочника пользователей в Redis: {str(e)}")
+
+async def load_allowed_users(from_sheet: bool = False) -> int:
+    """Загружает справочник: из Redis-хэша, а если его нет (или from_sheet) — из листа."""
+    global _users_dir, _users_rows
+    async with _users_lock:
+        if _users_dir is not None and not from_sheet:
+            return len(_users_dir)  # Уже загрузил параллельный вызов
+        users, rows = {}, {}
+        if not from_sheet:
+            try:
+                for field, value in (await redis_client.hgetall(ALLOWED_USERS_KEY)).items():
+                    row, name = json.loads(value)
+                    users[int(field)] = name
+                    if row:
+                        rows[int(field)] = row
+            except Exception as e:
+                logger.error(f"Ошибка чтения справочника пользователей из Redis: {str(e)}")
+                users, rows = {}, {}
+        if not users:
+            try:
+                users, rows = await _read_users_sheet()
+            except Exception as e:
+                logger.error(f"Error loading allowed users: {str(e)}")
+                if _users_dir is not None:
+                    return len(_users_dir)  # Оставляем прежний справочник
+                return 0  # Не кэшируем пустой — попробуем на следующей проверке
+            await _store_users_hash(users, rows)
+            logger.info(f"Allowed users loaded from sheet: {len(users)} users")
+        _users_dir, _users_rows = users, rows
+        return len(users)
+
+async def is_user_allowed(user_id: int) -> str | None:
+    if _users_dir is None:
+        await load_allowed_users()
+    user_name = (_users_dir or {}).get(user_id)
+    if user_name is None:
+        logger.debug(f"User not allowed: user_id={user_id}")
+    return user_name
+
+async def add_allowed_user(user_id: int, user_name: str) -> bool:
+    """Добавляет пользователя одной строкой в конец листа. False — уже в списке."""
+    if _users_dir is None:
+        await load_allowed_users()
+    if user_id in (_users_dir or {}):
+        return False
+    result = await async_sheets_call(
+        sheets_service.spreadsheets().values().append,
+        spreadsheetId=SHEET_NAME,
+        range=ALLOWED_USERS_RANGE,
+        valueInputOption="RAW",
+        insertDataOption="INSERT_ROWS",
+        body={"values": [[str(user_id), user_name]]},
+        fields="updates.updatedRange"
+    )
+    row = _parse_start_row((result.get("updates") or {}).get("updatedRange", ""))
+    async with _users_lock:
+        if _users_dir is not None:
+            _users_dir[user_id] = user_name
+        if row:
+            _users_rows[user_id] = row
+    try:
+        await redis_client.hset(ALLOWED_USERS_KEY, str(user_id), json.dumps([row, user_name], ensure_ascii=False))
+    except Exception as e:
+        logger.error(f"Ошибка записи пользователя в Redis: {str(e)}")
+    await cache_invalidate(ALLOWED_USERS_KEY)
+    return True
+
+async def remove_allowed_user(identifier: str) -> tuple[int, str] | None:
+    """
+    Удаляет пользователя по Telegram ID или имени: очищает только его строку листа.
+    Возвращает (user_id, имя) или None, если не найден.
+    """
+    if _users_dir is None:
+        await load_allowed_users()
+    users = _users_dir or {}
+    if identifier.isdigit():
+        user_id = int(identifier) if int(identifier) in users else None
+    else:
+        user_id = next((uid for uid, name in users.items() if name.strip() == identifier), None)
+    if user_id is None:
+        return None
+
+    # Строку проверяем перед очисткой: лист могли править руками
+    row = _users_rows.get(user_id)
+    if row:
+        current = await async_sheets_call(
+            sheets_service.spreadsheets().values().get,
+            spreadsheetId=SHEET_NAME, range=f"AllowedUsers!A{row}:B{row}", fields="values"
+        )
+        values = current.get("values") or [[]]
+        if not values[0] or str(values[0][0]).strip() != str(user_id):
+            row = None
+    if not row:
+        await load_allowed_users(from_sheet=True)
+        row = _users_rows.get(user_id)
+        if not row:
+            return None
+
+    await async_sheets_call(
+        sheets_service.spreadsheets().values().clear,
+        spreadsheetId=SHEET_NAME,
+        range=f"AllowedUsers!A{row}:B{row}"
+    )
+    async with _users_lock:
+        user_name = (_users_dir or {}).pop(user_id, users.get(user_id, ""))
+        _users_rows.pop(user_id, None)
+    try:
+        await redis_client.hdel(ALLOWED_USERS_KEY, str(user_id))
+    except Exception as e:
+        logger.error(f"Ошибка удаления пользователя из Redis: {str(e)}")
+    await cache_invalidate(ALLOWED_USERS_KEY)
+    return user_id, user_name
+
 # NOVOYE: Внутренняя функция — проверяет кэш баланса
 async def _get_cached_balance() -> dict | None:
     """Получает кэшированный баланс или None, если нет."""
-    cached = await cache_get(BALANCE_CACHE_KEY)  # Читаем из Redis по ключу
+    cached = await cache_get(BALANCE_CACHE_KEY, kind=dict)  # Локальный уровень или Redis, один decode
     if cached:  # Если есть данные
         logger.debug("Balance cache hit")  # Лог: "Кэш попал" (для отладки)
-        return json.loads(cached)  # Разбираем JSON-строку обратно в словарь
+        return cached
     return None  # Нет кэша — вернём None
 
-async def is_fiscal_doc_unique(fiscal_doc: str) -> bool:
+# ---------------------------------------------------------
+# Индекс фискальных номеров (столбец Чеки!M)
+# ---------------------------------------------------------
+# Redis set — источник истины для проверки дубликатов; Bloom-фильтр в памяти
+# отвечает «точно новый» без обращения к Redis. Индекс засевается один раз
+# из зеркала Чеки и пополняется save_receipt/доставкой/дочиткой хвоста.
+FISCAL_INDEX_KEY = redis_key("fiscal", "docs")
+FISCAL_INDEX_SENTINEL = "__seeded__"  # Чтобы пустой лист не выглядел как «индекс не засеян»
+
+class _BloomFilter:
+    """Простой Bloom-фильтр (bytearray + double hashing по blake2b)."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        capacity = max(capacity, 1)
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / (math.log(2) ** 2)), 8)
+        self.hashes = max(int(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str) -> None:
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+_fiscal_bloom: _BloomFilter | None = None
+# Номера, проиндексированные во время перестройки: попадут и в новый Bloom, если он пересоздаётся
+_fiscal_rebuild_added: set[str] | None = None
+
+def _fiscal_docs_from_rows(rows: list[list]) -> set[str]:
+    return {
+        str(row[12]).strip()
+        for row in rows
+        if len(row) > 12 and row[12] and str(row[12]).strip().isdigit()
+    }
+
+def _bloom_add_all(docs) -> None:
+    if _fiscal_bloom is not None:
+        for doc in docs:
+            _fiscal_bloom.add(doc)
+
+async def rebuild_fiscal_index(replace: bool = False) -> int:
+    """
+    Досеивает индекс из листа (через зеркало): Redis set атомарно через RENAME + Bloom.
+    Номера, добавленные save_receipt, пока шло чтение, не теряются: живой set
+    объединяется с новым (SUNIONSTORE) перед RENAME, а Bloom пополняется, а не заменяется.
+    replace=True — индекс строго по листу (после очистки листа): без объединения, Bloom заново.
+    """
+    global _fiscal_bloom, _fiscal_rebuild_added
+    _fiscal_rebuild_added = set()
     try:
-        result = await async_sheets_call(
-            sheets_service.spreadsheets().values().get,
-            spreadsheetId=SHEET_NAME, range="Чеки!M:M"
-        )
-        raw_values = result.get("values", [])
-        logger.debug(f"Direct fetch Чеки!M:M: total rows={len(raw_values)}")  # Minimal: no raw
+        docs = _fiscal_docs_from_rows(await get_receipts_rows())
 
-        existing_docs = {
-            str(row[0]).strip() 
-            for row in raw_values 
-            if row and row[0] and str(row[0]).strip().isdigit()
-        }
-        if existing_docs:
-            logger.debug(f"Filtered fiscal docs: {len(existing_docs)} unique")  # Quiet, no sample
-        else:
-            logger.debug(f"Filtered fiscal docs: 0 unique")
+        tmp_key = f"{FISCAL_INDEX_KEY}:rebuild"
+        members = [FISCAL_INDEX_SENTINEL, *docs]
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(tmp_key)
+            for i in range(0, len(members), 1000):
+                pipe.sadd(tmp_key, *members[i:i + 1000])
+            if not replace:
+                pipe.sunionstore(tmp_key, [tmp_key, FISCAL_INDEX_KEY])
+            pipe.rename(tmp_key, FISCAL_INDEX_KEY)
+            await pipe.execute()
+
+        # Дальше без await: параллельный _index_fiscal_docs не вклинится между сборкой и заменой
+        if FISCAL_BLOOM_ENABLED:
+            if not replace and _fiscal_bloom is not None and _fiscal_bloom.capacity >= len(docs) * 2:
+                _bloom_add_all(docs)
+            else:
+                bloom = _BloomFilter(max(FISCAL_BLOOM_CAPACITY, len(docs) * 2), FISCAL_BLOOM_ERROR_RATE)
+                for doc in (*docs, *_fiscal_rebuild_added):
+                    bloom.add(doc)
+                _fiscal_bloom = bloom
+    finally:
+        _fiscal_rebuild_added = None
+    logger.info(f"Индекс фискальных номеров перестроен: {len(docs)} номеров (bloom={'on' if _fiscal_bloom else 'off'})")
+    return len(docs)
+
+async def _index_fiscal_docs(docs) -> None:
+    docs = [doc for doc in docs if doc]
+    if not docs:
+        return
+    _bloom_add_all(docs)
+    if _fiscal_rebuild_added is not None:
+        _fiscal_rebuild_added.update(docs)
+    try:
+        await redis_client.sadd(FISCAL_INDEX_KEY, *docs)
+    except Exception as e:
+        logger.error(f"Ошибка пополнения индекса fiscal docs ({len(docs)} шт.): {str(e)}")
+
+async def add_fiscal_doc(fiscal_doc: str) -> None:
+    """Добавляет номер в индекс после записи в столбец M."""
+    await _index_fiscal_docs([str(fiscal_doc).strip()])
+
+async def is_fiscal_doc_unique(fiscal_doc: str) -> bool:
+    fiscal_doc = str(fiscal_doc).strip()
+
+    # Bloom: нет в фильтре — точно новый, без round trip
+    if _fiscal_bloom is not None and fiscal_doc not in _fiscal_bloom:
+        logger.info(f"is_fiscal_doc_unique '{fiscal_doc}': unique ✅ (bloom)")
+        return True
+
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.sismember(FISCAL_INDEX_KEY, fiscal_doc)
+            pipe.exists(FISCAL_INDEX_KEY)
+            is_member, seeded = await pipe.execute()
+        if not seeded:
+            await rebuild_fiscal_index()
+            is_member = await redis_client.sismember(FISCAL_INDEX_KEY, fiscal_doc)
 
-        is_unique = str(fiscal_doc).strip() not in existing_docs
+        is_unique = not is_member
         status = 'unique ✅' if is_unique else 'exists ❌'
         logger.info(f"is_fiscal_doc_unique '{fiscal_doc}': {status}")
         return is_unique
 
     except Exception as e:
-        logger.error(f"Error fetching fiscal docs M:M: {str(e)}")
-        logger.warning(f"Fallback: assume unique for '{fiscal_doc}' due to error")
-        return True
+        logger.error(f"Ошибка индекса fiscal docs: {str(e)}")
+        try:
+            return fiscal_doc not in _fiscal_docs_from_rows(await get_receipts_rows())
+        except Exception:
+            logger.warning(f"Fallback: assume unique for '{fiscal_doc}' due to error")
+            return True
+
+# ---------------------------------------------------------
+# Write-behind очередь append'ов
+# ---------------------------------------------------------
+# Строки, пришедшие в одно окно SHEETS_APPEND_WINDOW_MS, склеиваются в один
+# values.append на каждый диапазон (Чеки, Сводка, архив). Разные диапазоны
+# сбрасываются параллельно. Каждый вызывающий получает свой кусок updatedRange.
+_UPDATED_RANGE_RE = re.compile(r"^(.*)!([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?$")
+
+class _AppendCoalescer:
+    def __init__(self, window: float):
+        self.window = window
+        self._pending: dict[tuple[str, str], list[tuple[list[list], asyncio.Future]]] = {}
+        self._flush_task: asyncio.Task | None = None
+
+    def submit(self, range_: str, rows: list[list], value_input_option: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.setdefault((range_, value_input_option), []).append((rows, future))
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+        return future
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.window)
+        batches, self._pending = self._pending, {}
+        self._flush_task = None  # Новые строки уже копятся в следующее окно
+        await asyncio.gather(*(
+            self._flush(range_, value_input_option, entries)
+            for (range_, value_input_option), entries in batches.items()
+        ))
+
+    async def _flush(self, range_: str, value_input_option: str, entries: list) -> None:
+        all_rows = [row for rows, _ in entries for row in rows]
+        try:
+            result = await async_sheets_call(
+                sheets_service.spreadsheets().values().append,
+                spreadsheetId=SHEET_NAME,
+                range=range_,
+                valueInputOption=value_input_option,
+                insertDataOption="INSERT_ROWS",
+                body={"values": all_rows},
+                includeValuesInResponse=True,
+                responseValueRenderOption="FORMATTED_VALUE",  # Строки как их прочитает лист — для зеркала
+                fields="updates(updatedRange,updatedRows,updatedData(values))"
+            )
+        except Exception as e:
+            for _, future in entries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if len(entries) > 1:
+            logger.info(f"Append coalesced: {range_} — {len(entries)} вызовов, {len(all_rows)} строк за 1 запрос")
+        match = _UPDATED_RANGE_RE.match(result.get("updates", {}).get("updatedRange", ""))
+        rendered = (result.get("updates", {}).get("updatedData") or {}).get("values")
+        offset = 0
+        for rows, future in entries:
+            part = {}
+            if match:
+                sheet, first_col, start = match.group(1), match.group(2), int(match.group(3))
+                last_col = match.group(4) or first_col
+                part = {
+                    "updatedRange": f"{sheet}!{first_col}{start + offset}:{last_col}{start + offset + len(rows) - 1}",
+                    "updatedRows": len(rows),
+                }
+            if rendered is not None and len(rendered) == len(all_rows):
+                part["updatedData"] = {"values": rendered[offset:offset + len(rows)]}
+            offset += len(rows)
+            if not future.done():
+                future.set_result({"spreadsheetId": SHEET_NAME, "updates": part})
+
+_append_coalescer = _AppendCoalescer(SHEETS_APPEND_WINDOW_MS / 1000)
+
+async def append_rows(range_: str, rows: list[list], value_input_option: str = "RAW") -> dict:
+    """
+    Append через write-behind очередь. Возвращает ответ в форме values.append
+    ({"updates": {"updatedRange": ..., "updatedData": {"values": ...}}}) только
+    для своих строк; ошибка запроса пробрасывается каждому вызывающему.
+    """
+    return await _append_coalescer.submit(range_, rows, value_input_option)
 
 async def save_receipt(
     data_or_parsed=None,
@@ -184,10 +1002,11 @@ async def save_receipt(
 
         items = data.get("items", [])
         for i, item in enumerate(items):
+            parsed_item = Item.from_dict(item)  # Копейки + цена по умолчанию сумма/кол-во
             item_name = item.get("name", "Неизвестно")
-            item_sum = float(safe_float(item.get("sum", 0)))
-            item_qty = float(safe_float(item.get("quantity", 1))) or 1.0
-            item_price = float(safe_float(item.get("price", 0))) or (item_sum / item_qty if item_qty else 0.0)
+            item_sum = parsed_item.sum
+            item_qty = float(parsed_item.quantity)
+            item_price = parsed_item.price
 
             item_link = (links[i] if i < len(links) else "") or item.get("link", "")
             item_comment = (comments[i] if i < len(comments) else "") or item.get("comment", "")
@@ -231,27 +1050,21 @@ async def save_receipt(
                 f"{fiscal_doc} - Исключённые: {', '.join(data.get('excluded_items', []))}"
             ])
 
-        # Чеки всегда в один лист
-        await async_sheets_call(
-            sheets_service.spreadsheets().values().append,
-            spreadsheetId=SHEET_NAME,
-            range="Чеки!A:Q",
-            valueInputOption="USER_ENTERED", # ✅ ИЗМЕНЕНО: Обязательно "USER_ENTERED" вместо "RAW", чтобы сработала формула
-            insertDataOption="INSERT_ROWS",
-            body={"values": rows_checks}
-        )
+        # Сначала Чеки, и только после успеха — Сводка: иначе упавший Чеки оставил бы
+        # расходы в Сводке, а повтор пользователя записал бы их второй раз.
+        # Склейка с append других запросов остаётся — в окне очереди _AppendCoalescer.
+        checks_result = await append_rows("Чеки!A:Q", rows_checks, "USER_ENTERED")  # ✅ "USER_ENTERED", чтобы сработала формула
+        mirror_append_rows(rows_checks, checks_result)
+        await add_fiscal_doc(fiscal_doc)
 
         # Сводка — в текущий или архивный лист
         if rows_summary:
             target_sheet = get_target_summary_sheet(date_for_sheet)
-            await async_sheets_call(
-                sheets_service.spreadsheets().values().append,
-                spreadsheetId=SHEET_NAME,
-                range=target_sheet,
-                valueInputOption="RAW",  # Здесь можно оставить RAW, так как формул нет
-                insertDataOption="INSERT_ROWS",
-                body={"values": rows_summary}
-            )
+            try:
+                await append_rows(target_sheet, rows_summary, "RAW")  # Формул нет — RAW
+            except Exception:
+                logger.error(f"⚠️ Чеки записаны, а Сводка нет: fiscal_doc={fiscal_doc}, {target_sheet}")
+                raise
             logger.debug(f"Appended {len(rows_summary)} summary rows to {target_sheet}")
 
         logger.info(f"✅ Чек сохранён: fiscal_doc={fiscal_doc}, позиций={len(rows_checks)}, user={user_name}")
@@ -284,14 +1097,7 @@ async def save_receipt_summary(date: str, operation_type: str, sum_value: float,
         ]
 
         target_sheet = get_target_summary_sheet(formatted_date)
-        await async_sheets_call(
-            sheets_service.spreadsheets().values().append,
-            spreadsheetId=SHEET_NAME,
-            range=target_sheet,
-            valueInputOption="RAW",
-            insertDataOption="INSERT_ROWS",
-            body={"values": [summary_row]}
-        )
+        await append_rows(target_sheet, [summary_row], "RAW")
 
         logger.debug(f"Summary row appended to {target_sheet}: {summary_row[:2]}...")
         return True
@@ -312,59 +1118,75 @@ def normalize_amount(value: str) -> float:
         logger.error(f"Некорректное число: {value}")
         return 0.0
 
-async def get_monthly_balance(force_refresh: bool = False, use_computed: bool = False) -> dict:
-    """Получает баланс: Кэш или 1 запрос A1:Q2. use_computed=True — fallback расчёт, если mismatch."""
-    if not force_refresh:
-        cached = await _get_cached_balance()
-        if cached:
-            logger.info(f"Balance from cache: {cached['balance']:.2f}")
-            return cached
+async def _read_balance_sheet(use_computed: bool = False) -> dict | None:
+    """1 запрос A1:Q2 (I1 баланс, L1 расходы, O1 возвраты, C2 начальный, A1 дата). None — сводка пуста."""
+    result = await async_sheets_call(
+        sheets_service.spreadsheets().values().get,
+        spreadsheetId=SHEET_NAME, range="Сводка!A1:Q2", fields="values"
+    )
+    values = result.get("values", [])
+    logger.debug("Balance A1:Q2 fetched")
 
-    try:
-        # 1 запрос на A1:Q2 (I1=8 balance, L1=11 spent, O1=14 returned + C2 initial)
-        result = await async_sheets_call(
-            sheets_service.spreadsheets().values().get,
-            spreadsheetId=SHEET_NAME, range="Сводка!A1:Q2"
-        )
-        values = result.get("values", [])
-        logger.debug("Balance A1:Q2 fetched")
+    if len(values) < 2:
+        logger.warning("No data in Сводка!A1:Q2 — defaults")
+        return None
 
-        if len(values) < 2:
-            logger.warning("No data in Сводка!A1:Q2 — defaults")
-            return {"spent": 0.0, "returned": 0.0, "balance": 0.0, "initial_balance": 0.0}
+    row0 = values[0]  # Строка 1: I1=8 (баланс), L1=11 (расходы), O1=14 (возвраты)
+    row1 = values[1]  # Строка 2: C2 initial = row1[2]
 
-        row0 = values[0]  # Строка 1: I1=8 (баланс), L1=11 (расходы), O1=14 (возвраты)
-        row1 = values[1]  # Строка 2: C2 initial = row1[2]
+    # Initial из C2 (row1[2])
+    initial_balance = normalize_amount(str(row1[2]) if len(row1) > 2 else "0")
 
-        # Initial из C2 (row1[2])
-        initial_balance = normalize_amount(str(row1[2]) if len(row1) > 2 else "0")
+    # Фиксированные из row0 (ТВОИ ИНДЕКСЫ!)
+    balance_value = row0[8] if len(row0) > 8 else "0"  # I1=8 (остаток)
+    balance = normalize_amount(str(balance_value).replace("=", "").strip())
 
-        # Фиксированные из row0 (ТВОИ ИНДЕКСЫ!)
-        balance_value = row0[8] if len(row0) > 8 else "0"  # I1=8 (остаток)
-        balance = normalize_amount(str(balance_value).replace("=", "").strip())
+    spent_value = row0[11] if len(row0) > 11 else "0"  # L1=11 (расходы)
+    spent = normalize_amount(str(spent_value).replace("=", "").strip())
 
-        spent_value = row0[11] if len(row0) > 11 else "0"  # L1=11 (расходы)
-        spent = normalize_amount(str(spent_value).replace("=", "").strip())
+    returned_value = row0[14] if len(row0) > 14 else "0"  # O1=14 (возвраты)
+    returned = normalize_amount(str(returned_value).replace("=", "").strip())
 
-        returned_value = row0[14] if len(row0) > 14 else "0"  # O1=14 (возвраты)
-        returned = normalize_amount(str(returned_value).replace("=", "").strip())
+    # Опциональный fallback: Если use_computed=True, проверяем и считаем
+    if use_computed:
+        computed_balance = initial_balance + returned - spent
+        if abs(balance - computed_balance) > 0.01:
+            logger.warning(f"Balance mismatch: formula={balance:.2f} ≠ computed={computed_balance:.2f}; using computed")
+            balance = computed_balance
 
-        # Опциональный fallback: Если use_computed=True, проверяем и считаем
-        if use_computed:
-            computed_balance = initial_balance + returned - spent
-            if abs(balance - computed_balance) > 0.01:
-                logger.warning(f"Balance mismatch: formula={balance:.2f} ≠ computed={computed_balance:.2f}; using computed")
-                balance = computed_balance
-            # Можно добавить spent/returned computed, но по умолчанию — из таблицы
+    # A1 — дата обновления сводки, приходит тем же запросом
+    update_date = str(row0[0]).strip() if row0 and row0[0] else datetime.now().strftime("%d.%m.%Y")
 
-        result_data = {
-            "spent": round(spent, 2),
-            "returned": round(returned, 2),
-            "balance": round(balance, 2),
-            "initial_balance": round(initial_balance, 2),
-        }
-        await cache_set(BALANCE_CACHE_KEY, json.dumps(result_data), expire=BALANCE_EXPIRE)
-        logger.info(f"Balance fetched/cached: {result_data['balance']:.2f} (from I1={balance_value}, L1={spent_value}, O1={returned_value})")
+    logger.info(f"Balance fetched: {balance:.2f} (from I1={balance_value}, L1={spent_value}, O1={returned_value})")
+    return {
+        "update_date": update_date,
+        "spent": round(spent, 2),
+        "returned": round(returned, 2),
+        "balance": round(balance, 2),
+        "initial_balance": round(initial_balance, 2),
+    }
+
+async def get_monthly_balance(force_refresh: bool = False, use_computed: bool = False) -> dict:
+    """Получает баланс: Кэш, оптимистичный баланс из журнала или 1 запрос A1:Q2.
+    use_computed=True — fallback расчёт, если mismatch."""
+    if not force_refresh:
+        cached = await _get_cached_balance()
+        if cached:
+            logger.info(f"Balance from cache: {cached['balance']:.2f}")
+            return cached
+        # Есть несверенные операции — формулы могли ещё не пересчитаться, отдаём проекцию журнала
+        if await _balance_dirty_since() is not None:
+            projection = await _get_balance_projection()
+            if projection:
+                logger.info(f"Balance from ledger projection: {projection['balance']:.2f}")
+                return projection
+
+    try:
+        result_data = await _read_balance_sheet(use_computed)
+        if result_data is None:
+            return {"spent": 0.0, "returned": 0.0, "balance": 0.0, "initial_balance": 0.0}
+        if await _balance_dirty_since() is None:
+            await _store_balance(result_data)
         return result_data
 
     except HttpError as e:
@@ -377,7 +1199,7 @@ async def get_monthly_balance(force_refresh: bool = False, use_computed: bool =
 # NOVOYE: Обновляет кэш баланса (для будущих этапов, после изменений)
 async def update_balance_cache(balance_data: dict):
     """Обновляет кэш новыми данными баланса (после add/return)."""
-    await cache_set(BALANCE_CACHE_KEY, json.dumps(balance_data), expire=BALANCE_EXPIRE)
+    await cache_set(BALANCE_CACHE_KEY, balance_data, expire=BALANCE_EXPIRE)
     logger.debug("Balance cache updated")  # Лог: "Кэш обновлён"
 
 # NOVOYE: Helper для delta-расчёта баланса (для confirm)
@@ -409,6 +1231,9 @@ async def compute_delta_balance(operation_type: str, total_sum: float, old_balan
     elif operation_type == "delivery":  # Подтверждение — no change (status only)
         new_balance = old_balance  # Или + доплата, если есть
         # new_spent/returned unchanged
+    elif operation_type == "initial":  # Изменение начального баланса (C2), total_sum со знаком
+        initial = initial + total_sum
+        new_balance = old_balance + total_sum
     else:
         logger.warning(f"Unknown operation_type: {operation_type}, no delta")
 
@@ -419,6 +1244,7 @@ async def compute_delta_balance(operation_type: str, total_sum: float, old_balan
         new_balance = computed
 
     new_data = {
+        "update_date": old_balance_data.get("update_date") or datetime.now().strftime("%d.%m.%Y"),
         "spent": round(new_spent, 2),
         "returned": round(new_returned, 2),
         "balance": round(new_balance, 2),
@@ -427,29 +1253,240 @@ async def compute_delta_balance(operation_type: str, total_sum: float, old_balan
     logger.info(f"Delta computed: op={operation_type}, sum={total_sum:.2f}, old_balance={old_balance:.2f} → new={new_balance:.2f}")
     return new_data
 
-# NOVOYE: Update cache with new data (after delta)
-async def update_balance_cache_with_delta(new_balance_data: dict):
-    """Обновляет кэш новым балансом после операции."""
-    await cache_set(BALANCE_CACHE_KEY, json.dumps(new_balance_data), expire=BALANCE_EXPIRE)
-    logger.debug("Balance cache updated with delta")
+# ---------------------------------------------------------
+# Журнал операций с балансом (оптимистичный баланс + сверка)
+# ---------------------------------------------------------
+# Каждая операция (spent/returned/initial) пишется в Redis-список balance:ledger
+# и сразу применяется к проекции баланса через compute_delta_balance —
+# подтверждение не ждёт пересчёта формул Сводки. Проекция хранится без TTL и
+# обновляется при каждом чтении листа, пока журнал чист. Пока есть несверенные
+# операции, reconcile_balance раз в BALANCE_RECONCILE_INTERVAL читает I1/L1/O1,
+# пишет расхождение в лог и журнал и заменяет проекцию значениями листа.
+# Процессов бота может быть несколько: проекция меняется через WATCH/MULTI
+# (конкурентная запись — повтор), счётчик операций — INCR в Redis.
+BALANCE_LEDGER_KEY = redis_key("balance", "ledger")
+BALANCE_PROJECTION_KEY = redis_key("balance", "projection")
+BALANCE_DIRTY_KEY = redis_key("balance", "ledger_dirty")  # Время последней несверенной операции
+BALANCE_SEQ_KEY = redis_key("balance", "seq")  # Растёт с каждой операцией: сверка не затирает то, что пришло во время её чтения
+BALANCE_TX_RETRIES = 10
+BALANCE_LEDGER_MAX = 1000
+BALANCE_OPERATIONS = {"spent": "add", "returned": "return", "initial": "initial"}
+_balance_lock = asyncio.Lock()  # Только внутри процесса — меньше повторов транзакции
 
-async def batch_update_sheets(updates: list):
-    """Batch update values в sheets (list of {'range': 'A1:Q1', 'values': [[...]]})."""
+async def _get_balance_projection() -> dict | None:
+    return await cache_get(BALANCE_PROJECTION_KEY, kind=dict)
+
+async def _store_balance(balance_data: dict, expire: int = BALANCE_EXPIRE) -> None:
+    """Проекция (без TTL) + короткий кэш для /balance — одним pipeline."""
+    await cache_set_many(
+        {BALANCE_PROJECTION_KEY: balance_data, BALANCE_CACHE_KEY: balance_data},
+        expire={BALANCE_CACHE_KEY: expire},
+    )
+
+def _decode_balance(raw) -> dict | None:
+    try:
+        value = cache_codec.loads(raw) if raw is not None else None
+    except ValueError:
+        logger.warning("Ledger: проекция баланса в Redis повреждена, будет пересчитана")
+        return None
+    return value if isinstance(value, dict) else None
+
+async def _balance_dirty_since() -> float | None:
+    try:
+        value = await redis_client.get(BALANCE_DIRTY_KEY)
+        return float(value) if value is not None else None
+    except Exception as e:
+        logger.error(f"Ошибка чтения флага сверки баланса: {str(e)}")
+        return None
+
+async def _append_ledger(event: dict) -> None:
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.lpush(BALANCE_LEDGER_KEY, json.dumps(event, ensure_ascii=False))
+            pipe.ltrim(BALANCE_LEDGER_KEY, 0, BALANCE_LEDGER_MAX - 1)
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Ошибка записи в журнал баланса: {str(e)}")
+
+async def _balance_base(applies: bool) -> dict:
+    """Холодный старт: проекции нет, база — лист (запись могла уже попасть в формулы — поправит сверка)."""
+    try:
+        current = await _read_balance_sheet() if applies else None
+    except Exception as e:
+        logger.error(f"Ledger: не удалось прочитать баланс из листа: {str(e)}")
+        current = None
+    logger.warning("Ledger: проекции баланса нет, база взята из листа — результат уточнит сверка")
+    return current or {"spent": 0.0, "returned": 0.0, "balance": 0.0, "initial_balance": 0.0}
+
+async def record_balance_event(kind: str, amount: float, ref: str = "", date: str | None = None) -> dict:
+    """
+    Фиксирует операцию в журнале и возвращает баланс после неё (без чтения листа).
+    kind: 'spent' (покупка/услуга), 'returned' (возврат), 'initial' (изменение C2, со знаком).
+    date: дата строки в Сводке — операции прошлых месяцев уходят в архив и текущий баланс не меняют.
+    """
+    if kind not in BALANCE_OPERATIONS:
+        raise ValueError(f"Unknown balance event kind: {kind}")
+    amount = safe_float(amount) if kind == "initial" else abs(safe_float(amount))
+    applies = date is None or get_target_summary_sheet(normalize_date(date)) == "Сводка!A:E"
+
+    new_data = None
+    async with _balance_lock:
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                for attempt in range(BALANCE_TX_RETRIES):
+                    try:
+                        await pipe.watch(BALANCE_PROJECTION_KEY)
+                        current = _decode_balance(await pipe.get(BALANCE_PROJECTION_KEY))
+                        if current is None:
+                            current = await _balance_base(applies)
+                        new_data = await compute_delta_balance(BALANCE_OPERATIONS[kind], amount, current) if applies else current
+                        encoded = cache_codec.dumps(new_data)
+                        pipe.multi()
+                        pipe.set(BALANCE_PROJECTION_KEY, encoded)
+                        pipe.set(BALANCE_CACHE_KEY, encoded, ex=BALANCE_RECONCILE_INTERVAL * 4)
+                        pipe.set(BALANCE_DIRTY_KEY, str(time.time()))
+                        pipe.incr(BALANCE_SEQ_KEY)
+                        await pipe.execute()
+                        break
+                    except WatchError:
+                        logger.debug(f"Ledger: проекцию одновременно изменил другой процесс, повтор ({attempt + 1})")
+                else:
+                    logger.error(f"Ledger: проекция не обновлена за {BALANCE_TX_RETRIES} попыток — поправит сверка")
+        except Exception as e:
+            logger.error(f"Ошибка обновления проекции баланса: {str(e)}")
+        await cache_invalidate(BALANCE_PROJECTION_KEY, BALANCE_CACHE_KEY)
+
+    if new_data is None:
+        # Redis недоступен: считаем от листа, чтобы подтверждение всё равно показало баланс
+        current = await _balance_base(applies)
+        new_data = await compute_delta_balance(BALANCE_OPERATIONS[kind], amount, current) if applies else current
+
+    await _append_ledger({
+        "ts": datetime.now().isoformat(timespec="seconds"),
+        "kind": kind,
+        "amount": round(amount, 2),
+        "ref": ref,
+        "applied": applies,
+        "balance": new_data["balance"],
+    })
+    logger.info(f"Ledger: {kind} {amount:.2f} ({ref or '—'}) → баланс {new_data['balance']:.2f}{'' if applies else ' (архивный месяц, без изменения)'}")
+    return new_data
+
+async def reconcile_balance(force: bool = False) -> float | None:
+    """
+    Сверяет проекцию журнала с формулами I1/L1/O1 и заменяет её значениями листа.
+    Запускается планировщиком; без несверенных операций ничего не читает.
+    Возвращает расхождение (лист − проекция) или None, если сверка не выполнялась.
+    """
+    dirty_since = await _balance_dirty_since()
+    if dirty_since is None and not force:
+        return None
+    if dirty_since is not None and not force and time.time() - dirty_since < BALANCE_RECONCILE_DELAY:
+        return None  # Даём формулам Сводки пересчитаться
+
+    try:
+        seq_before = await redis_client.get(BALANCE_SEQ_KEY)
+        sheet = await _read_balance_sheet()
+    except Exception as e:
+        logger.error(f"Ошибка сверки баланса: {str(e)}")
+        return None
+    if sheet is None:
+        return None
+
+    async with _balance_lock:
+        try:
+            async with redis_client.pipeline(transaction=True) as pipe:
+                # Операция из любого процесса меняет счётчик — EXEC тогда не пройдёт
+                await pipe.watch(BALANCE_SEQ_KEY)
+                if await pipe.get(BALANCE_SEQ_KEY) != seq_before:
+                    logger.debug("Ledger: во время сверки пришли новые операции, сверка отложена")
+                    return None
+                projection = _decode_balance(await pipe.get(BALANCE_PROJECTION_KEY))
+                encoded = cache_codec.dumps(sheet)
+                pipe.multi()
+                pipe.set(BALANCE_PROJECTION_KEY, encoded)
+                pipe.set(BALANCE_CACHE_KEY, encoded, ex=BALANCE_EXPIRE)
+                pipe.delete(BALANCE_DIRTY_KEY)
+                await pipe.execute()
+        except WatchError:
+            logger.debug("Ledger: во время сверки пришли новые операции, сверка отложена")
+            return None
+        except Exception as e:
+            logger.error(f"Ошибка сверки баланса: {str(e)}")
+            return None
+        await cache_invalidate(BALANCE_PROJECTION_KEY, BALANCE_CACHE_KEY)
+
+    drift = round(sheet["balance"] - projection["balance"], 2) if projection else 0.0
+    if abs(drift) > 0.01:
+        logger.warning(
+            f"⚠️ Расхождение баланса: лист={sheet['balance']:.2f}, журнал={projection['balance']:.2f}, "
+            f"разница={drift:+.2f} (L1={sheet['spent']:.2f}/{projection['spent']:.2f}, "
+            f"O1={sheet['returned']:.2f}/{projection['returned']:.2f})"
+        )
+        await _append_ledger({
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "kind": "drift",
+            "amount": drift,
+            "ref": "reconcile",
+            "applied": True,
+            "balance": sheet["balance"],
+        })
+    else:
+        logger.info(f"✅ Баланс сверен с листом: {sheet['balance']:.2f}")
+    return drift
+
+async def reset_balance_ledger() -> None:
+    """Сбрасывает проекцию и флаг сверки (после очистки Сводки)."""
+    try:
+        await cache_delete(BALANCE_PROJECTION_KEY, BALANCE_CACHE_KEY, BALANCE_DIRTY_KEY)
+    except Exception as e:
+        logger.error(f"Ошибка сброса журнала баланса: {str(e)}")
+
+async def batch_update_sheets(updates: list, response_values: bool = False):
+    """
+    Batch update values в sheets (list of {'range': 'A1:Q1', 'values': [[...]]}).
+    response_values=True — вместо True вернуть responses (по одному на диапазон,
+    с updatedData в FORMATTED_VALUE). Ошибка — False.
+    """
     try:
         body = {
             "valueInputOption": "USER_ENTERED",  # ✅ ИЗМЕНЕНО: Было RAW, теперь USER_ENTERED для работы формул
             "data": updates  # [{'range': ..., 'values': [[row]]}, ...]
         }
+        if response_values:
+            body.update(includeValuesInResponse=True, responseValueRenderOption="FORMATTED_VALUE")
         result = await async_sheets_call(
             sheets_service.spreadsheets().values().batchUpdate,
             spreadsheetId=SHEET_NAME,
-            body=body
+            body=body,
+            fields="totalUpdatedRows,responses(updatedData(values))" if response_values else "totalUpdatedRows"
         )
         logger.debug(f"Batch update: {len(updates)} ranges, updated {result.get('totalUpdatedRows', 0)} rows")
+        if response_values:
+            return result.get("responses") or [{} for _ in updates]
         return True
     except HttpError as e:
         logger.error(f"Batch update error: {e.status_code} - {e.reason}")
         return False
     except Exception as e:
         logger.error(f"Batch update exception: {str(e)}")
-        return False
\ No newline at end of file
+        return False
+
+async def batch_get_values(ranges: list[str], value_render_option: str = "FORMATTED_VALUE") -> list[list[list]]:
+    """Читает несколько диапазонов одним values.batchGet.
+    Возвращает значения в порядке ranges; пустой диапазон — []. Ошибки HttpError пробрасываются."""
+    if not ranges:
+        return []
+    result = await async_sheets_call(
+        sheets_service.spreadsheets().values().batchGet,
+        spreadsheetId=SHEET_NAME,
+        ranges=list(ranges),
+        valueRenderOption=value_render_option,
+        fields="valueRanges.values"
+    )
+    value_ranges = result.get("valueRanges", [])
+    logger.debug(f"Batch get: {len(ranges)} ranges")
+    return [
+        value_ranges[i].get("values", []) if i < len(value_ranges) else []
+        for i in range(len(ranges))
+    ]
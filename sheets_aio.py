@@ -0,0 +1,117 @@
+"""
+Асинхронный backend Google Sheets v4 поверх aiohttp (SHEETS_BACKEND=aiohttp).
+
+Запрос по-прежнему собирает googleapiclient (sheets_service...get(...) без execute —
+это чистая сборка URL/тела без сети), а исполняется он здесь: одна пулированная
+keep-alive сессия, gzip-ответы и асинхронное обновление токена service account.
+Ошибки поднимаются как googleapiclient.errors.HttpError, поэтому существующие
+`except HttpError` в хендлерах работают без изменений.
+"""
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+import httplib2
+from google.auth import crypt, jwt
+from googleapiclient.errors import HttpError
+
+from config import GOOGLE_CREDENTIALS, SHEETS_HTTP_TIMEOUT, SHEETS_AIO_POOL_SIZE
+
+logger = logging.getLogger("AccountingBot")
+
+SCOPE = "https://www.googleapis.com/auth/spreadsheets"
+TOKEN_URI = GOOGLE_CREDENTIALS.get("token_uri", "https://oauth2.googleapis.com/token")
+TOKEN_REFRESH_MARGIN = 300  # Обновляем токен за 5 минут до истечения
+# Google отдаёт gzip, только если в User-Agent есть "gzip"
+USER_AGENT = "AccountingBotORIA/aiohttp (gzip)"
+
+
+def _http_error(status: int, reason: str, headers, content: bytes, uri: str) -> HttpError:
+    info = {key.lower(): value for key, value in headers.items()}
+    info.update({"status": status, "reason": reason or ""})
+    return HttpError(httplib2.Response(info), content, uri=uri)
+
+
+class AioSheetsClient:
+    def __init__(self, credentials_info: dict, pool_size: int, timeout: int):
+        self._signer = crypt.RSASigner.from_service_account_info(credentials_info)
+        self._email = credentials_info["client_email"]
+        self._pool_size = pool_size
+        self._timeout = timeout
+        self._session: aiohttp.ClientSession | None = None
+        self._token: str | None = None
+        self._token_expiry = 0.0
+        self._token_lock = asyncio.Lock()
+
+    async def start(self) -> None:
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=self._pool_size,
+            keepalive_timeout=60,
+            ttl_dns_cache=300,
+        )
+        self._session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self._timeout),
+            headers={"User-Agent": USER_AGENT, "Accept-Encoding": "gzip"},
+        )
+        logger.info(f"Sheets aiohttp backend: сессия открыта (pool={self._pool_size})")
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _access_token(self) -> str:
+        if self._token and time.time() < self._token_expiry - TOKEN_REFRESH_MARGIN:
+            return self._token
+        async with self._token_lock:
+            if self._token and time.time() < self._token_expiry - TOKEN_REFRESH_MARGIN:
+                return self._token
+            now = int(time.time())
+            assertion = jwt.encode(self._signer, {
+                "iss": self._email,
+                "scope": SCOPE,
+                "aud": TOKEN_URI,
+                "iat": now,
+                "exp": now + 3600,
+            })
+            form = {
+                "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+                "assertion": assertion.decode("utf-8"),
+            }
+            async with self._session.post(TOKEN_URI, data=form) as resp:
+                content = await resp.read()
+                if resp.status != 200:
+                    raise _http_error(resp.status, resp.reason, resp.headers, content, TOKEN_URI)
+                payload = json.loads(content)
+            self._token = payload["access_token"]
+            self._token_expiry = now + int(payload.get("expires_in", 3600))
+            logger.debug("Sheets aiohttp backend: токен обновлён")
+            return self._token
+
+    async def execute(self, request) -> dict:
+        """Исполняет собранный googleapiclient HttpRequest (method/uri/body/headers)."""
+        await self.start()
+        body = request.body.encode("utf-8") if isinstance(request.body, str) else request.body
+        headers = {
+            key: value for key, value in (request.headers or {}).items()
+            if key.lower() not in ("content-length", "user-agent", "accept-encoding")
+        }
+        for attempt in (1, 2):
+            headers["Authorization"] = f"Bearer {await self._access_token()}"
+            async with self._session.request(request.method, request.uri, data=body, headers=headers) as resp:
+                content = await resp.read()
+                if resp.status == 401 and attempt == 1:
+                    self._token = None  # Токен отозван/протух раньше срока — один повтор
+                    continue
+                if resp.status >= 300:
+                    raise _http_error(resp.status, resp.reason, resp.headers, content, request.uri)
+                return json.loads(content) if content else {}
+        return {}
+
+
+aio_client = AioSheetsClient(GOOGLE_CREDENTIALS, SHEETS_AIO_POOL_SIZE, SHEETS_HTTP_TIMEOUT)
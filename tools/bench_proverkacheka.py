@@ -0,0 +1,119 @@
+"""
+Нагрузочный прогон parse_qr_from_photo / confirm_manual_api против заглушки proverkacheka.
+
+Запуск из корня репозитория (нужны .env и credentials.json, как для бота, и Redis):
+
+    python tools/proverkacheka_stub.py --port 8080 --codes 1=90,2=5,3=3,4=2 --http429 0.02 --html 0.01 &
+    PROVERKACHEKA_BASE_URL=http://127.0.0.1:8080 PROVERKACHEKA_BACKOFF_BASE=0.2 \\
+        python tools/bench_proverkacheka.py --mode both --requests 500 --concurrency 20
+
+Каждый запрос уникален (свой ФД / свои байты фото), так что кэш чеков не
+срабатывает. Все модули бота работают с отдельной базой Redis (--redis-db:
+REDIS_DB задаётся до их импорта), кэш чеков в ней чистится в конце.
+Против настоящего proverkacheka.com не запускается: тратит платную квоту.
+"""
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+BENCH_FN = "9999078900012345"
+
+
+class BenchBot:
+    """Минимум aiogram.Bot, нужный parse_qr_from_photo: file_id → байты «фото»."""
+    id = 0
+
+    async def get_file(self, file_id: str):
+        return SimpleNamespace(file_path=file_id)
+
+    async def download_file(self, file_path: str):
+        # Не QR — локальное распознавание не сработает, уйдёт qrfile, как с плохим фото
+        return io.BytesIO(f"bench-photo-{file_path}".encode() * 512)
+
+
+async def run_manual(i: int) -> str:
+    data = {"fn": BENCH_FN, "fd": str(500000 + i), "fp": str(1000000000 + i), "s": 2026.0,
+            "date": "080925", "time": "18:34", "op_type": "1"}
+    success, msg, _ = await utils.confirm_manual_api(data, SimpleNamespace(id=0))
+    return "ok" if success else msg
+
+
+async def run_qr(i: int, bot: BenchBot) -> str:
+    parsed = await utils.parse_qr_from_photo(bot, f"{time.time_ns()}-{i}")
+    return "ok" if parsed else "none"
+
+
+async def bench(name: str, make_call, requests: int, concurrency: int) -> None:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies: list[float] = []
+    outcomes = Counter()
+
+    async def one(i: int) -> None:
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                outcomes[await make_call(i)] += 1
+            except Exception as e:
+                outcomes[f"{type(e).__name__}: {e}"] += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    q = statistics.quantiles(latencies, n=100, method="inclusive") if len(latencies) > 1 else latencies * 99
+    print(f"\n{name}: {requests} запросов, параллельно {concurrency}, {elapsed:.1f} с, {requests / elapsed:.1f} запр/с")
+    print(f"  задержка p50/p95/p99/max: {q[49] * 1000:.0f}/{q[94] * 1000:.0f}/{q[98] * 1000:.0f}/{latencies[-1] * 1000:.0f} мс")
+    for outcome, count in outcomes.most_common():
+        print(f"  {count:6d}  {outcome}")
+    print(f"  предохранитель: {proverkacheka_breaker.stats()}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон разбора чеков против заглушки proverkacheka")
+    parser.add_argument("--mode", choices=("manual", "qr", "both"), default="both")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--redis-db", type=int, default=15, help="база Redis для всех модулей бота на время прогона")
+    return parser.parse_args()
+
+
+async def main(args: argparse.Namespace) -> None:
+    if API_URL.startswith("https://proverkacheka.com"):
+        raise SystemExit("PROVERKACHEKA_BASE_URL указывает на proverkacheka.com — запустите заглушку и задайте её адрес")
+    print(f"API: {API_URL}, Redis db={REDIS_DB}")
+
+    # Сессия proverkacheka откроется лениво на первом запросе; закрываем, как on_shutdown бота
+    try:
+        if args.mode in ("manual", "both"):
+            await bench("confirm_manual_api", run_manual, args.requests, args.concurrency)
+        if args.mode in ("qr", "both"):
+            bot = BenchBot()
+            await bench("parse_qr_from_photo", lambda i: run_qr(i, bot), args.requests, args.concurrency)
+    finally:
+        await utils.unlink_namespace("parse-cache")
+        await proverkacheka_client.close()
+        shutdown_qr_decoder()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # База выбирается до импорта модулей бота: пул Redis в utils создаётся при импорте,
+    # и его же используют все, кто сделал `from utils import redis_client`
+    os.environ["REDIS_DB"] = str(args.redis_db)
+
+    import utils  # noqa: E402
+    from config import REDIS_DB  # noqa: E402
+    from proverkacheka import API_URL, proverkacheka_client, proverkacheka_breaker  # noqa: E402
+    from qr_decoder import shutdown_qr_decoder  # noqa: E402
+
+    asyncio.run(main(args))
@@ -0,0 +1,119 @@
+"""
+Микробенчмарк разбора чека: прежний цикл из utils.py против receipt_model.Receipt.
+
+Синтетический чек маркетплейса (по умолчанию 500 позиций, часть — доставка/сборы).
+Запуск из корня репозитория:
+
+    python tools/bench_receipt_parse.py [позиций] [повторов]
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from exceptions import is_excluded  # noqa: E402
+from receipt_model import Receipt  # noqa: E402
+
+
+def safe_float(value, default: float = 0.0) -> float:
+    try:
+        if isinstance(value, (int, float)):
+            return float(value)
+        if isinstance(value, str):
+            return float(value.replace(",", ".").strip())
+    except (ValueError, AttributeError):
+        return default
+    return default
+
+
+def legacy_parse(result: dict) -> dict:
+    """Копия цикла parse_qr_from_photo до receipt_model (float-рубли, два is_excluded на позицию)."""
+    data_block = result.get("data", {})
+    data_json = data_block.get("json", {})
+    items = data_json.get("items", [])
+    filtered_items = []
+    excluded_sum = 0.0
+    total_sum_raw = safe_float(data_json.get("totalSum", 0)) / 100
+    if total_sum_raw == 0:
+        total_sum_raw = sum(safe_float(it.get("sum", 0)) / 100 for it in items)
+    for item in items:
+        name = item.get("name", "Неизвестно").strip()
+        total_sum_item = safe_float(item.get("sum", 0)) / 100
+        unit_price = safe_float(item.get("price", 0)) / 100
+        quantity = item.get("quantity", 1)
+        if is_excluded(name):
+            excluded_sum += total_sum_item
+            continue
+        filtered_items.append({"name": name, "sum": total_sum_item, "price": unit_price, "quantity": quantity})
+    return {
+        "fiscal_doc": data_json.get("fiscalDocumentNumber", "unknown"),
+        "date": data_json.get("dateTime", "").split("T")[0].replace("-", "."),
+        "store": data_json.get("user", "Неизвестно"),
+        "items": filtered_items,
+        "total_sum": total_sum_raw - excluded_sum,
+        "totalSum": total_sum_raw,
+        "excluded_sum": excluded_sum,
+        "excluded_items": [item.get("name") for item in items if is_excluded(item.get("name", "").strip())],
+    }
+
+
+def model_parse(result: dict) -> dict:
+    return Receipt.from_api(result).to_dict()
+
+
+def make_receipt(n_items: int) -> dict:
+    rnd = random.Random(42)
+    items = []
+    for i in range(n_items):
+        if i % 25 == 0:
+            name = rnd.choice(["Доставка", "Сервисный сбор", "Пункт выдачи"])
+        else:
+            name = f"Товар маркетплейса №{i} артикул {rnd.randint(10**7, 10**8)} размер {rnd.choice('SML')}"
+        quantity = rnd.randint(1, 3)
+        price = rnd.randint(1000, 500000)
+        items.append({"name": name, "price": price, "quantity": quantity, "sum": price * quantity})
+    return {
+        "code": 1,
+        "data": {"json": {
+            "fiscalDocumentNumber": 12345,
+            "dateTime": "2025-09-08T18:34:00",
+            "user": "ООО Маркетплейс",
+            "totalSum": sum(item["sum"] for item in items),
+            "items": items,
+        }},
+    }
+
+
+def bench(name: str, func, result: dict, repeats: int) -> None:
+    func(result)  # прогрев кэша исключений
+    started = time.perf_counter()
+    for _ in range(repeats):
+        func(result)
+    per_call = (time.perf_counter() - started) / repeats
+
+    tracemalloc.start()
+    func(result)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<8} {per_call * 1000:8.3f} мс/чек   пик памяти {peak / 1024:8.1f} КиБ")
+
+
+def main() -> None:
+    n_items = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    result = make_receipt(n_items)
+
+    legacy, model = legacy_parse(result), model_parse(result)
+    assert len(legacy["items"]) == len(model["items"])
+    assert abs(legacy["excluded_sum"] - model["excluded_sum"]) < 0.01
+    print(f"Чек: {n_items} позиций, {len(model['excluded_items'])} исключённых, {repeats} повторов")
+    print(f"float-итог legacy: {legacy['total_sum']!r}   копейки model: {model['total_sum']!r}")
+    bench("legacy", legacy_parse, result, repeats)
+    bench("model", model_parse, result, repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Локальная заглушка proverkacheka.com для нагрузочных тестов и проверки повторов.
+
+Отвечает на POST /api/v1/check/get записанными ответами API
+(tools/proverkacheka_responses.json, коды 0–5), добавляет задержку, а с заданной
+вероятностью отдаёт HTTP 429, 5xx и HTML-страницу ошибки вместо JSON. Ответ
+code=1 подстраивается под запрос (fn/fd/fp или qrraw), поэтому кэш чеков не
+склеивает разные запросы.
+
+Запуск из корня репозитория:
+
+    python tools/proverkacheka_stub.py --port 8080 --latency-ms 300 --codes 1=90,2=5,3=3,4=2 --http429 0.02 --html 0.01
+    PROVERKACHEKA_BASE_URL=http://127.0.0.1:8080 python main.py
+
+GET /stats — счётчики ответов, POST /stats/reset — обнулить их.
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import random
+from collections import Counter
+
+from aiohttp import web
+
+DEFAULT_RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "proverkacheka_responses.json")
+
+HTML_ERROR_PAGE = (
+    "<!DOCTYPE html><html><head><title>502 Bad Gateway</title></head>"
+    "<body><center><h1>502 Bad Gateway</h1></center><hr><center>nginx</center></body></html>"
+)
+
+
+def _parse_weights(spec: str) -> tuple[list[int], list[float]]:
+    """'1=90,2=5,3=5' → ([1, 2, 3], [90.0, 5.0, 5.0])"""
+    codes, weights = [], []
+    for part in spec.split(","):
+        code, _, weight = part.partition("=")
+        codes.append(int(code))
+        weights.append(float(weight or 1))
+    return codes, weights
+
+
+class StubState:
+    def __init__(self, args: argparse.Namespace):
+        with open(args.responses, "r", encoding="utf-8") as f:
+            self.responses = {int(code): body for code, body in json.load(f).items()}
+        self.codes, self.weights = _parse_weights(args.codes)
+        missing = set(self.codes) - set(self.responses)
+        if missing:
+            raise SystemExit(f"Нет записанных ответов для кодов: {sorted(missing)}")
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.stats = Counter()
+        self.fd_counter = 0
+
+    def latency(self) -> float:
+        ms = self.args.latency_ms + self.rnd.uniform(-self.args.jitter_ms, self.args.jitter_ms)
+        return max(ms, 0) / 1000
+
+    def receipt(self, form) -> dict:
+        """Записанный code=1, но с реквизитами из запроса и нужным числом позиций."""
+        body = copy.deepcopy(self.responses[1])
+        data_json = body["data"]["json"]
+        self.fd_counter += 1
+
+        qrraw = form.get("qrraw", "")
+        fields = dict(part.split("=", 1) for part in qrraw.split("&") if "=" in part)
+        fn = form.get("fn") or fields.get("fn") or data_json["fiscalDriveNumber"]
+        fd = form.get("fd") or fields.get("i") or str(100000 + self.fd_counter)
+        fp = form.get("fp") or fields.get("fp") or str(self.rnd.randint(10**9, 4 * 10**9))
+        data_json.update(
+            fiscalDriveNumber=fn,
+            fiscalDocumentNumber=int(fd) if str(fd).isdigit() else fd,
+            fiscalSign=int(fp) if str(fp).isdigit() else fp,
+        )
+
+        if self.args.items > len(data_json["items"]):
+            template = data_json["items"]
+            data_json["items"] = [
+                dict(template[i % len(template)], name=f"{template[i % len(template)]['name']} #{i}")
+                for i in range(self.args.items)
+            ]
+            data_json["totalSum"] = data_json["ecashTotalSum"] = sum(item["sum"] for item in data_json["items"])
+
+        body["request"]["qrraw"] = qrraw or f"t=20250908T1834&s={data_json['totalSum'] / 100:.2f}&fn={fn}&i={fd}&fp={fp}&n=1"
+        if "fn" in form:
+            body["request"]["manual"] = {key: form.get(key, "") for key in ("fn", "fd", "fp", "check_time", "type", "sum")}
+        return body
+
+
+async def check_get(request: web.Request) -> web.Response:
+    state: StubState = request.app["state"]
+    form = await request.post()
+    await asyncio.sleep(state.latency())
+
+    roll = state.rnd.random()
+    if roll < state.args.http429:
+        state.stats["http_429"] += 1
+        return web.Response(status=429, text="Too Many Requests", headers={"Retry-After": str(state.args.retry_after)})
+    roll -= state.args.http429
+    if roll < state.args.http5xx:
+        state.stats["http_503"] += 1
+        return web.Response(status=503, text="Service Unavailable")
+    roll -= state.args.http5xx
+    if roll < state.args.html:
+        state.stats["html"] += 1
+        return web.Response(status=200, text=HTML_ERROR_PAGE, content_type="text/html")
+
+    code = state.rnd.choices(state.codes, state.weights)[0]
+    state.stats[f"code_{code}"] += 1
+    body = state.receipt(form) if code == 1 else state.responses[code]
+    return web.json_response(body, dumps=lambda obj: json.dumps(obj, ensure_ascii=False))
+
+
+async def check_ping(request: web.Request) -> web.Response:
+    """GET на адрес API — так /test проверяет доступность."""
+    return web.json_response({"code": 0, "data": "stub"})
+
+
+async def get_stats(request: web.Request) -> web.Response:
+    state: StubState = request.app["state"]
+    return web.json_response({"total": sum(state.stats.values()), **state.stats})
+
+
+async def reset_stats(request: web.Request) -> web.Response:
+    request.app["state"].stats.clear()
+    return web.json_response({"ok": True})
+
+
+def build_app(args: argparse.Namespace) -> web.Application:
+    app = web.Application(client_max_size=20 * 1024 * 1024)  # qrfile — фото до ~20 МБ
+    app["state"] = StubState(args)
+    app.router.add_post("/api/v1/check/get", check_get)
+    app.router.add_get("/api/v1/check/get", check_ping)
+    app.router.add_get("/stats", get_stats)
+    app.router.add_post("/stats/reset", reset_stats)
+    return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Заглушка proverkacheka.com")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--responses", default=DEFAULT_RESPONSES, help="JSON {code: ответ API}")
+    parser.add_argument("--codes", default="1=1", help="веса кодов ответа, например 1=90,2=5,3=3,4=2")
+    parser.add_argument("--latency-ms", type=float, default=200, help="средняя задержка ответа")
+    parser.add_argument("--jitter-ms", type=float, default=100, help="разброс задержки ±")
+    parser.add_argument("--http429", type=float, default=0.0, help="доля ответов HTTP 429")
+    parser.add_argument("--http5xx", type=float, default=0.0, help="доля ответов HTTP 503")
+    parser.add_argument("--html", type=float, default=0.0, help="доля HTML-страниц ошибки вместо JSON")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After для 429, сек")
+    parser.add_argument("--items", type=int, default=0, help="позиций в чеке code=1 (0 — как в записи)")
+    parser.add_argument("--seed", type=int, default=None)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    print(f"proverkacheka stub: http://{args.host}:{args.port}/api/v1/check/get (codes {args.codes})")
+    web.run_app(build_app(args), host=args.host, port=args.port, print=None)
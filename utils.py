@@ -1,43 +1,462 @@
-from exceptions import is_excluded, get_excluded_items
 import logging
 import aiohttp
-from config import PROVERKACHEKA_TOKEN
+from config import PROVERKACHEKA_TOKEN, RECEIPT_CACHE_TTL, CACHE_LOCAL_MAXSIZE, CACHE_LOCAL_TTL, CACHE_CODEC, REDIS_DB, REDIS_KEY_PREFIX, REDIS_UNLINK_BATCH
+from config import REDIS_MAX_CONNECTIONS, REDIS_POOL_TIMEOUT
+from proverkacheka import fetch_check, ProgressCallback, QR_POLICY
+from qr_decoder import decode_fiscal_qr, parse_fiscal_qr
+from receipt_model import Receipt, rub_to_kop
 import redis.asyncio as redis
+from redis.exceptions import ResponseError, WatchError
 import json
+import hashlib
+import asyncio
+import time
+import re
+import uuid
+from collections import OrderedDict
 from datetime import datetime
 import calendar  # Для валидации дат
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton  # Для reset_keyboard
-from typing import Tuple, Dict, Any, Optional
+from typing import Tuple, Dict, Any, Optional, Callable, Awaitable, Iterable, Mapping, TypeVar
 import requests  # Для API запросов (fallback)
-import time  # Для time.sleep в retry
 from io import BytesIO
 
 logger = logging.getLogger("AccountingBot")
 
-# Redis с pool и reconnect
-pool = redis.ConnectionPool(host='localhost', port=6379, db=0, decode_responses=True, max_connections=10, retry_on_timeout=True)
+# Redis с pool и reconnect. Блокирующий пул: при пике (FSM, кэш, очереди и pub/sub
+# на одном пуле) команда ждёт соединение, а не падает с "Too many connections"
+pool = redis.BlockingConnectionPool(
+    host='localhost', port=6379, db=REDIS_DB, decode_responses=True,
+    max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT, retry_on_timeout=True,
+)
 redis_client = redis.Redis(connection_pool=pool)
 
-async def cache_get(key: str) -> any:
+# ---------------------------------------------------------
+# Пространство ключей Redis
+# ---------------------------------------------------------
+# Все ключи бота — "<REDIS_KEY_PREFIX>:<пространство>:<имя>". Чужие ключи на общем
+# Redis не трогаем, а очистка идёт по одному пространству: SCAN по шаблону и UNLINK
+# пачками (не KEYS * + DEL, которые блокируют Redis на большом keyspace).
+KEY_NAMESPACES = {
+    "users": "справочник пользователей",
+    "balance": "баланс и журнал операций",
+    "fiscal": "индекс фискальных номеров",
+    "parse-cache": "кэш ответов proverkacheka",
+    "fsm": "состояния сценариев",
+    "deferred": "отложенные проверки чеков",
+    "notify": "отключённые уведомления",
+}
+CACHE_NAMESPACES = ("users", "balance", "fiscal", "parse-cache")  # Восстанавливаются из таблицы/API
+
+_GLOB_SPECIAL_RE = re.compile(r"([*?\[\]\\])")
+
+def redis_key(namespace: str, *parts) -> str:
+    """redis_key("balance", "ledger") → 'accbot:balance:ledger'."""
+    if namespace not in KEY_NAMESPACES:
+        raise ValueError(f"Неизвестное пространство ключей: {namespace}")
+    return ":".join((REDIS_KEY_PREFIX, namespace, *map(str, parts)))
+
+async def unlink_namespace(namespace: str, batch: int = REDIS_UNLINK_BATCH) -> int:
+    """Удаляет все ключи пространства: SCAN + UNLINK пачками по batch. Локальные копии не трогает."""
+    pattern = _GLOB_SPECIAL_RE.sub(r"\\\1", redis_key(namespace)) + ":*"
+    deleted = 0
+    keys: list[str] = []
+    async for key in redis_client.scan_iter(match=pattern, count=batch):
+        keys.append(key)
+        if len(keys) >= batch:
+            deleted += await redis_client.unlink(*keys)
+            keys = []
+    if keys:
+        deleted += await redis_client.unlink(*keys)
+    return deleted
+
+async def flush_namespaces(namespaces: Iterable[str]) -> dict[str, int]:
+    """Очищает пространства и сбрасывает локальные копии кэша во всех процессах. → {пространство: удалено}"""
+    deleted = {namespace: await unlink_namespace(namespace) for namespace in namespaces}
+    await cache_delete("*")
+    logger.info(f"Redis: очищены пространства ключей {deleted}")
+    return deleted
+
+# Ключи с данными (не кэшем) до введения пространств → новые имена. Кэш (баланс
+# для /balance, справочник пользователей, индекс чеков, ответы API) не переносим —
+# он пересобирается из таблицы. FSM ("fsm:*") тоже: это префикс aiogram по
+# умолчанию, на общем Redis под ним могут быть чужие ключи, а сценарии истекают за часы.
+LEGACY_KEYS = {
+    "notified_items": redis_key("notify", "items"),
+    "deferred_checks": redis_key("deferred", "queue"),
+    "balance_ledger": redis_key("balance", "ledger"),
+    "balance_projection": redis_key("balance", "projection"),
+    "balance_ledger_dirty": redis_key("balance", "ledger_dirty"),
+}
+LEGACY_PREFIXES = {
+    "deferred_check:": redis_key("deferred", "check") + ":",
+}
+
+async def _migrate_key(old: str, new: str) -> bool:
+    """RENAMENX old → new; если new уже есть (его успел создать новый код) — слить по типу и удалить old."""
     try:
-        data = await redis_client.get(key)
-        if data is not None:
-            return json.loads(data)
-        return None
+        if await redis_client.renamenx(old, new):
+            return True
+    except ResponseError:
+        return False  # old нет (уже перенесён или не было) — RENAMENX отвечает "no such key"
+    async with redis_client.pipeline(transaction=True) as pipe:
+        try:
+            await pipe.watch(old)  # Другой процесс, мигрирующий одновременно, удалит old — EXEC не пройдёт
+            kind = await pipe.type(old)
+            if kind == "none":
+                return False
+            values = await pipe.lrange(old, 0, -1) if kind == "list" else None
+            pipe.multi()
+            if kind == "set":
+                pipe.sunionstore(new, [new, old])
+            elif kind == "zset":
+                pipe.zunionstore(new, [new, old], aggregate="MIN")
+            elif kind == "list" and values:
+                pipe.rpush(new, *values)  # Журналы пишутся LPUSH — старые записи в хвост
+            # Строки и хэши: новое значение новее старого, старое отбрасываем
+            pipe.unlink(old)
+            await pipe.execute()
+            return True
+        except WatchError:
+            return False
+
+async def migrate_legacy_keys() -> int:
+    """Однократный перенос данных со старых имён ключей (идемпотентно, на каждом старте). → перенесено ключей."""
+    moved = 0
+    try:
+        for old, new in LEGACY_KEYS.items():
+            if await _migrate_key(old, new):
+                logger.info(f"Redis: ключ {old} перенесён в {new}")
+                moved += 1
+        for old_prefix, new_prefix in LEGACY_PREFIXES.items():
+            pattern = _GLOB_SPECIAL_RE.sub(r"\\\1", old_prefix) + "*"
+            count = 0
+            async for key in redis_client.scan_iter(match=pattern, count=REDIS_UNLINK_BATCH):
+                count += await _migrate_key(key, new_prefix + key[len(old_prefix):])
+            if count:
+                logger.info(f"Redis: {count} ключей {old_prefix}* перенесено в {new_prefix}*")
+            moved += count
+    except Exception as e:
+        logger.error(f"Ошибка переноса старых ключей Redis: {str(e)}")
+    return moved
+
+# ---------------------------------------------------------
+# Кодек значений кэша
+# ---------------------------------------------------------
+# orjson, если установлен (в разы быстрее json на dumps/loads), иначе json.
+# Пул Redis с decode_responses=True, поэтому кодек обязан давать UTF-8 текст —
+# бинарные форматы (msgpack) сюда не подходят. CACHE_CODEC=json — принудительно json.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class JsonCodec:
+    name = "json"
+
+    @staticmethod
+    def dumps(value: Any) -> str:
+        return json.dumps(value, ensure_ascii=False)
+
+    @staticmethod
+    def loads(data: str | bytes) -> Any:
+        return json.loads(data)
+
+class OrjsonCodec:
+    name = "orjson"
+
+    @staticmethod
+    def dumps(value: Any) -> bytes:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+
+    @staticmethod
+    def loads(data: str | bytes) -> Any:
+        return orjson.loads(data)
+
+cache_codec = OrjsonCodec() if orjson is not None and CACHE_CODEC != "json" else JsonCodec()
+
+# ---------------------------------------------------------
+# Локальный уровень кэша (TTL + LRU в памяти процесса)
+# ---------------------------------------------------------
+# cache_get сначала смотрит сюда и идёт в Redis только на промахе — is_user_allowed
+# и баланс на каждом апдейте обходятся без сети. cache_set/cache_delete публикуют
+# изменённые ключи в CACHE_INVALIDATION_CHANNEL, и другие процессы бота выбрасывают
+# свои копии. Пока подписка не активна (до старта или после обрыва), уровень
+# выключен: без инвалидаций он мог бы отдать чужое устаревшее значение.
+# Значения отдаются без копирования — вызывающий не должен их изменять.
+CACHE_INVALIDATION_CHANNEL = f"{REDIS_KEY_PREFIX}:cache_invalidate"
+_CACHE_MISS = object()
+
+class _LocalCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.active = False  # Включается listen_cache_invalidations после подписки
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: str) -> Any:
+        if not self.active:
+            return _CACHE_MISS
+        entry = self._data.get(key)
+        if entry is None:
+            return _CACHE_MISS
+        expires, value = entry
+        if expires <= time.monotonic():
+            del self._data[key]
+            return _CACHE_MISS
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        """ttl — оставшийся срок ключа в Redis; локальная копия не живёт дольше него."""
+        if not self.active or self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0:
+            return
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def discard(self, keys) -> None:
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+_local_cache = _LocalCache(CACHE_LOCAL_MAXSIZE, CACHE_LOCAL_TTL)
+_cache_origin = uuid.uuid4().hex  # Свои сообщения об инвалидации пропускаем
+_cache_stats = {
+    "local_hits": 0, "local_misses": 0, "redis_hits": 0, "redis_misses": 0,
+    "invalidations_sent": 0, "invalidations_received": 0,
+}
+_invalidation_task: asyncio.Task | None = None
+# key -> функции без аргументов, вызываемые, когда ключ изменил другой процесс
+# (структуры в памяти вне локального уровня — например, справочник пользователей)
+_invalidation_hooks: dict[str, list[Callable[[], None]]] = {}
+
+def on_cache_invalidation(key: str, hook: Callable[[], None]) -> None:
+    _invalidation_hooks.setdefault(key, []).append(hook)
+
+def _run_invalidation_hooks(keys: list[str]) -> None:
+    targets = _invalidation_hooks if "*" in keys else {key: _invalidation_hooks[key] for key in keys if key in _invalidation_hooks}
+    for key, hooks in targets.items():
+        for hook in hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error(f"Кэш: ошибка обработчика инвалидации {key}: {str(e)}")
+
+def get_cache_stats() -> dict:
+    """Попадания/промахи по уровням (для /debug)."""
+    return {**_cache_stats, "local_size": len(_local_cache), "local_active": _local_cache.active, "codec": cache_codec.name}
+
+def _publish(pipe, keys: list[str]) -> None:
+    """PUBLISH инвалидации в тот же pipeline — без отдельного запроса."""
+    pipe.publish(CACHE_INVALIDATION_CHANNEL, json.dumps({"origin": _cache_origin, "keys": keys}))
+    _cache_stats["invalidations_sent"] += 1
+
+T = TypeVar("T")
+
+def _typed(key: str, value: Any, kind: type | tuple | None, default: T) -> Any | T:
+    if kind is None or isinstance(value, kind):
+        return value
+    # Например, баланс, записанный старым кодом как JSON-строка внутри JSON
+    logger.debug(f"Кэш: {key} — значение не {kind}, считаем промахом")
+    return default
+
+async def cache_get(key: str, kind: type | tuple | None = None, default: T = None) -> Any | T:
+    """
+    Значение по ключу: локальный уровень, затем Redis (GET + PTTL одним запросом).
+    kind — ожидаемый тип (dict, list, str...): значение другого типа считается промахом.
+    """
+    value = _local_cache.get(key)
+    if value is not _CACHE_MISS:
+        _cache_stats["local_hits"] += 1
+        return _typed(key, value, kind, default)
+    _cache_stats["local_misses"] += 1
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(key)
+            pipe.pttl(key)
+            data, pttl = await pipe.execute()
+        if data is None:
+            _cache_stats["redis_misses"] += 1
+            return default
+        _cache_stats["redis_hits"] += 1
+        value = cache_codec.loads(data)
+        _local_cache.set(key, value, pttl / 1000 if pttl and pttl > 0 else None)
+        return _typed(key, value, kind, default)
     except Exception as e:
         logger.error(f"Ошибка чтения из Redis: {str(e)}")
-        return None
+        return default
 
-async def cache_set(key: str, value: any, expire: int = None) -> bool:
+async def cache_get_many(keys: Iterable[str], kind: type | tuple | None = None, local: bool = True) -> dict[str, Any]:
+    """
+    Найденные значения {ключ: значение} одним MGET (промахи локального уровня).
+    local=False — крупные значения (ответы API): мимо локального уровня.
+    """
+    keys = list(dict.fromkeys(keys))
+    found: dict[str, Any] = {}
+    missing = []
+    for key in keys:
+        value = _local_cache.get(key) if local else _CACHE_MISS
+        if value is _CACHE_MISS:
+            missing.append(key)
+        else:
+            _cache_stats["local_hits"] += 1
+            found[key] = value
+    if missing:
+        _cache_stats["local_misses"] += len(missing) if local else 0
+        try:
+            async with redis_client.pipeline(transaction=False) as pipe:
+                pipe.mget(missing)
+                if local:
+                    for key in missing:
+                        pipe.pttl(key)
+                values, *pttls = await pipe.execute()
+            for i, (key, data) in enumerate(zip(missing, values)):
+                if data is None:
+                    _cache_stats["redis_misses"] += 1
+                    continue
+                _cache_stats["redis_hits"] += 1
+                found[key] = cache_codec.loads(data)
+                if local:
+                    _local_cache.set(key, found[key], pttls[i] / 1000 if pttls[i] and pttls[i] > 0 else None)
+        except Exception as e:
+            logger.error(f"Ошибка чтения из Redis: {str(e)}")
+    if kind is not None:
+        found = {key: value for key, value in found.items() if isinstance(value, kind)}
+    return found
+
+def _ttl(expire: int | Mapping[str, int | None] | None, key: str) -> int | None:
+    ttl = expire.get(key) if isinstance(expire, Mapping) else expire
+    return ttl or None
+
+async def cache_set(key: str, value: Any, expire: int | None = None, local: bool = True) -> bool:
+    """SET EX (атомарно, вместе с PUBLISH инвалидации — один запрос)."""
+    return await cache_set_many({key: value}, expire=expire, local=local)
+
+async def cache_set_many(items: Mapping[str, Any], expire: int | Mapping[str, int | None] | None = None, local: bool = True) -> bool:
+    """
+    Несколько SET EX и одна инвалидация одним pipeline. expire — общий TTL или {ключ: TTL}.
+    local=False — без локального уровня и инвалидации.
+    """
+    if not items:
+        return True
     try:
-        await redis_client.set(key, json.dumps(value))
-        if expire:
-            await redis_client.expire(key, expire)
+        encoded: dict[int, Any] = {}  # Одно значение под несколькими ключами кодируем один раз
+        payloads = {}
+        for key, value in items.items():
+            if id(value) not in encoded:
+                encoded[id(value)] = cache_codec.dumps(value)
+            payloads[key] = encoded[id(value)]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for key, payload in payloads.items():
+                pipe.set(key, payload, ex=_ttl(expire, key))
+            if local:
+                _publish(pipe, list(payloads))
+            await pipe.execute()
+        if local:
+            for key, payload in payloads.items():
+                # Те же типы, что вернёт Redis (кортежи → списки)
+                _local_cache.set(key, cache_codec.loads(payload), _ttl(expire, key))
         return True
     except Exception as e:
         logger.error(f"Ошибка записи в Redis: {str(e)}")
+        _local_cache.discard(items.keys())
         return False
 
+async def cache_invalidate(*keys: str) -> None:
+    """Сообщает другим процессам, что ключи изменены в обход cache_set (HSET и т.п.)."""
+    _local_cache.discard(keys)
+    try:
+        async with redis_client.pipeline(transaction=False) as pipe:
+            _publish(pipe, list(keys))
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f"Ошибка публикации инвалидации кэша: {str(e)}")
+
+async def cache_delete(*keys: str) -> int:
+    """DELETE ключей в Redis + сброс локальных копий во всех процессах. keys=("*",) — сбросить всё локально."""
+    if "*" in keys:
+        _local_cache.clear()
+    else:
+        _local_cache.discard(keys)
+    try:
+        redis_keys = [key for key in keys if key != "*"]
+        async with redis_client.pipeline(transaction=False) as pipe:
+            if redis_keys:
+                pipe.delete(*redis_keys)
+            _publish(pipe, list(keys))
+            results = await pipe.execute()
+        return results[0] if redis_keys else 0
+    except Exception as e:
+        logger.error(f"Ошибка удаления из Redis: {str(e)}")
+        return 0
+
+async def listen_cache_invalidations() -> None:
+    """Фоновая подписка на CACHE_INVALIDATION_CHANNEL; пока подписана — локальный уровень включён."""
+    reconnect = False
+    while True:
+        pubsub = redis_client.pubsub()
+        try:
+            await pubsub.subscribe(CACHE_INVALIDATION_CHANNEL)
+            _local_cache.clear()  # Пока не были подписаны, могли пропустить инвалидации
+            if reconnect:
+                _run_invalidation_hooks(["*"])
+            reconnect = True
+            _local_cache.active = True
+            logger.info(f"Кэш: локальный уровень включён (до {_local_cache.maxsize} ключей, TTL {_local_cache.ttl:.0f}s)")
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                try:
+                    event = json.loads(message["data"])
+                except (TypeError, ValueError):
+                    continue
+                if event.get("origin") == _cache_origin:
+                    continue
+                keys = event.get("keys") or []
+                _cache_stats["invalidations_received"] += 1
+                if "*" in keys:
+                    _local_cache.clear()
+                else:
+                    _local_cache.discard(keys)
+                _run_invalidation_hooks(keys)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Кэш: подписка на инвалидации оборвалась: {str(e)}")
+        finally:
+            _local_cache.active = False
+            _local_cache.clear()
+            try:
+                await pubsub.reset()
+            except Exception:
+                pass
+        await asyncio.sleep(5)
+
+def start_cache_invalidation() -> None:
+    global _invalidation_task
+    if CACHE_LOCAL_MAXSIZE > 0 and (_invalidation_task is None or _invalidation_task.done()):
+        _invalidation_task = asyncio.create_task(listen_cache_invalidations())
+
+async def stop_cache_invalidation() -> None:
+    global _invalidation_task
+    if _invalidation_task is not None:
+        _invalidation_task.cancel()
+        try:
+            await _invalidation_task
+        except asyncio.CancelledError:
+            pass
+        _invalidation_task = None
+
 def normalize_date(date_str: str) -> str:
     """
     Нормализует дату: YYYY.MM.DD или DD.MM.YYYY → DD.MM.YYYY.
@@ -68,98 +487,138 @@ def safe_float(value: str | float | int, default: float = 0.0) -> float:
         return default
     return default
 
-async def parse_qr_from_photo(bot, file_id) -> dict | None:
+# ---------------------------------------------------------
+# Кэш ответов proverkacheka (code=1) в Redis
+# ---------------------------------------------------------
+# Один и тот же чек приходит повторно (то же фото, повтор ручного ввода после
+# ошибки) — каждый запрос тратит платную квоту и секунды. Храним сырой ответ
+# API (фильтр исключений применяется заново при каждом разборе) под всеми
+# ключами, которые можно вывести: qrraw, fn-fd-fp и sha256 скачанного фото.
+RECEIPT_CACHE_PREFIX = redis_key("parse-cache")
+
+def _norm_fiscal_part(value) -> str:
+    """'0001234' и 1234 — один и тот же ФД/ФП."""
+    value = str(value or "").strip()
+    return str(int(value)) if value.isdigit() else value
+
+def receipt_cache_keys(qrraw: str = "", fn="", fd="", fp="", image_hash: str = "") -> list[str]:
+    keys = []
+    if qrraw:
+        keys.append(f"{RECEIPT_CACHE_PREFIX}:qr:{hashlib.sha1(qrraw.strip().encode('utf-8')).hexdigest()}")
+    if fn and fd and fp:
+        keys.append(f"{RECEIPT_CACHE_PREFIX}:fnfdfp:{_norm_fiscal_part(fn)}-{_norm_fiscal_part(fd)}-{_norm_fiscal_part(fp)}")
+    if image_hash:
+        keys.append(f"{RECEIPT_CACHE_PREFIX}:img:{image_hash}")
+    return keys
+
+async def get_cached_check(keys: list[str]) -> dict | None:
+    """Первый найденный ответ API по любому из ключей (один MGET)."""
+    if not keys:
+        return None
+    found = await cache_get_many(keys, kind=dict, local=False)
+    return next((found[key] for key in keys if key in found), None)
+
+async def store_cached_check(result: dict, extra_keys: list[str] | None = None) -> None:
+    """Сохраняет успешный ответ API под qrraw, fn-fd-fp из самого чека и extra_keys."""
+    if not result or result.get("code") != 1:
+        return
+    data_json = (result.get("data") or {}).get("json") or {}
+    keys = receipt_cache_keys(
+        qrraw=(result.get("request") or {}).get("qrraw", ""),
+        fn=data_json.get("fiscalDriveNumber", ""),
+        fd=data_json.get("fiscalDocumentNumber", ""),
+        fp=data_json.get("fiscalSign", ""),
+    ) + list(extra_keys or [])
+    if not keys:
+        return
+    # Ответы API крупные и нужны редко — только Redis, без локального уровня
+    if await cache_set_many(dict.fromkeys(keys, result), expire=RECEIPT_CACHE_TTL, local=False):
+        logger.debug(f"Кэш чеков: сохранено под {len(set(keys))} ключами")
+
+async def parse_qr_from_photo(
+    bot,
+    file_id,
+    progress: Optional[ProgressCallback] = None,
+    is_unique: Optional[Callable[[str], Awaitable[bool]]] = None,
+) -> dict | None:
+    """
+    Распознаёт чек по фото: локально читает QR и запрашивает proverkacheka по qrraw,
+    если QR не прочитан — отправляет фото целиком.
+    is_unique: проверка фискального номера (is_fiscal_doc_unique). Если QR прочитан
+    локально и чек уже есть в таблице, API не вызывается: возвращается
+    {"fiscal_doc", "qr_string", "duplicate": True, "items": []}.
+    """
     file = await bot.get_file(file_id)
     file_path = file.file_path
     photo = await bot.download_file(file_path)
     
-    timeout = aiohttp.ClientTimeout(total=30)
-    async with aiohttp.ClientSession(timeout=timeout) as session:
+    photo_bytes = photo.getvalue() if hasattr(photo, "getvalue") else photo.read()
+
+    # Повторно присланное фото — ответ из кэша, без запроса к API
+    image_keys = receipt_cache_keys(image_hash=hashlib.sha256(photo_bytes).hexdigest())
+    result = await get_cached_check(image_keys)
+    qrraw, fiscal = "", None
+    if result is not None:
+        logger.info("Кэш чеков: фото уже распознавалось, ответ API из Redis")
+    else:
+        # QR читаем сами (в пуле процессов); не вышло — fiscal=None и фото уйдёт в API
+        qrraw = await decode_fiscal_qr(photo_bytes) or ""
+        fiscal = parse_fiscal_qr(qrraw)
+        if fiscal:
+            fiscal_doc = str(int(fiscal["i"]))
+            if is_unique is not None and not await is_unique(fiscal_doc):
+                logger.info(f"QR: чек {fiscal_doc} уже в таблице — запрос к API не нужен")
+                return {"fiscal_doc": fiscal_doc, "qr_string": qrraw, "duplicate": True, "items": []}
+            result = await get_cached_check(receipt_cache_keys(qrraw=qrraw, fn=fiscal["fn"], fd=fiscal["i"], fp=fiscal["fp"]))
+            if result is not None:
+                logger.info(f"Кэш чеков: QR {fiscal_doc} уже запрашивался, ответ API из Redis")
+                await store_cached_check(result, image_keys)
+
+    # FormData одноразовая — на каждую попытку собираем заново
+    def build_form() -> aiohttp.FormData:
         form = aiohttp.FormData()
-        form.add_field("qrfile", photo, filename="check.jpg", content_type="image/jpeg")
+        if fiscal:
+            form.add_field("qrraw", qrraw)  # Пара сотен байт вместо фото
+        else:
+            form.add_field("qrfile", photo_bytes, filename="check.jpg", content_type="image/jpeg")
         form.add_field("token", PROVERKACHEKA_TOKEN)
-        async with session.post("https://proverkacheka.com/api/v1/check/get", data=form) as response:
-            if response.status == 200:
-                result = await response.json()
-                if result.get("code") == 1:
-                    data_block = result.get("data", {})
-                    data_json = data_block.get("json", {})
-                    # ✅ НОВЫЕ ЛОГИ: Смотрим всю структуру, которую вернул API
-                    logger.info(f"--- DEBUG API ---")
-                    logger.info(f"Ключи внутри 'data': {list(data_block.keys())}")
-                    logger.info(f"Значение 'pdfurl' напрямую: '{data_block.get('pdfurl', 'НЕТ КЛЮЧА')}'")
-                    logger.info(f"-----------------")
-                    # ✅ НОВОЕ: Извлекаем ссылку на PDF
-                    pdf_url = data_block.get("pdfurl", "") 
-                    
-                    if data_json:
-                        items = data_json.get("items", [])
-                        excluded_items = get_excluded_items()  # Твоя функция? (или DEFAULT)
-                        filtered_items = []
-                        excluded_sum = 0.0
-
-                        # ✅ Raw totalSum (полная, до фильтра)
-                        total_sum_raw = safe_float(data_json.get("totalSum", 0)) / 100  # 2019.00
-                        if total_sum_raw == 0:
-                            # Fallback: sum всех items (если API не дал totalSum)
-                            total_sum_raw = sum(safe_float(it.get("sum", 0)) / 100 for it in items)
-                            logger.warning(f"Fallback total_sum_raw: {total_sum_raw:.2f} (totalSum был 0 в API)")
-
-                        for item in items:
-                            name = item.get("name", "Неизвестно").strip()
-                            total_sum_item = safe_float(item.get("sum", 0)) / 100  # RUB
-                            unit_price = safe_float(item.get("price", 0)) / 100
-                            quantity = item.get("quantity", 1)
-
-                            if is_excluded(name):
-                                logger.info(f"Найден исключённый товар: '{name}' (сумма: {total_sum_item})")
-                                excluded_sum += total_sum_item
-                                continue
-
-                            filtered_items.append({
-                                "name": name,
-                                "sum": total_sum_item,
-                                "price": unit_price,
-                                "quantity": quantity
-                            })
-
-                        filtered_total = total_sum_raw - excluded_sum  # Для add.py (1922.85)
-
-                        # ✅ ЛОГ RAW/PARSED ДЛЯ DEBUG
-                        logger.info(f"QR parsed (API): totalSum_raw={total_sum_raw:.2f} (full), filtered_total={filtered_total:.2f}, excluded_sum={excluded_sum:.2f}, items_count={len(filtered_items)}, user_id={bot.id if bot else 'unknown'}")
-
-                        return {
-                            "fiscal_doc": data_json.get("fiscalDocumentNumber", "unknown"),
-                            "date": data_json.get("dateTime", "").split("T")[0].replace("-", "."),
-                            "store": data_json.get("user", "Неизвестно"),
-                            "items": filtered_items,
-                            "qr_string": result.get("request", {}).get("qrraw", ""),
-                            "operation_type": data_json.get("operationType", 1),
-                            "prepaid_sum": safe_float(data_json.get("prepaidSum", 0)) / 100,
-                            "total_sum": filtered_total,  # Для add.py (filtered, как раньше)
-                            "totalSum": total_sum_raw,  # ✅ НОВОЕ: Полная для return.py (full, 2019.00)
-                            "excluded_sum": excluded_sum,
-                            "pdf_url": pdf_url, # ✅ НОВОЕ: Передаем ссылку на PDF
-                            "excluded_items": [
-                                item.get("name") for item in items if is_excluded(item.get("name", "").strip())
-                            ]
-                        }
-                    else:
-                        logger.error("Нет данных JSON в ответе от proverkacheka.com")
-                        return None
-                else:
-                    logger.error(
-                        f"Ошибка обработки на proverkacheka.com: code={result.get('code')}, message={result.get('data')}"
-                    )
-                    return None
-            else:
-                logger.error(f"Ошибка отправки на proverkacheka.com: status={response.status}")
-                return None
-
-async def confirm_manual_api(data: Dict[str, Any], user: Any) -> Tuple[bool, str, Optional[Dict]]:
+        return form
+
+    if result is None:
+        # Общая сессия + асинхронные повторы (code 3/4, 429/5xx, таймауты)
+        result, error_msg = await fetch_check(build_form, policy=QR_POLICY, progress=progress, label="qr")
+        if result is None:
+            logger.error(f"Ошибка отправки на proverkacheka.com: {error_msg}")
+            return None
+        await store_cached_check(result, image_keys)
+    if result.get("code") != 1:
+        logger.error(
+            f"Ошибка обработки на proverkacheka.com: code={result.get('code')}, message={result.get('data')}"
+        )
+        return None
+
+    receipt = Receipt.from_api(result, fallback_qrraw=qrraw)
+    if receipt is None:
+        logger.error("Нет данных JSON в ответе от proverkacheka.com")
+        return None
+    for item in receipt.excluded:
+        logger.info(f"Найден исключённый товар: '{item.name}' (сумма: {item.sum})")
+    logger.info(
+        f"QR parsed (API): totalSum_raw={receipt.total_kop / 100:.2f} (full), filtered_total={receipt.filtered_total_kop / 100:.2f}, "
+        f"excluded_sum={receipt.excluded_kop / 100:.2f}, items_count={len(receipt.items)}, pdf_url={'есть' if receipt.pdf_url else 'нет'}, "
+        f"user_id={bot.id if bot else 'unknown'}"
+    )
+    return receipt.to_dict()
+
+# code=2: ФНС ещё не отдала чек. Вызывающий сравнивает сообщение с константой,
+# чтобы поставить чек на отложенную проверку (deferred.py)
+CHECK_NOT_READY_MSG = "⏳ Данные чека пока не готовы. Попробуйте позже."
+
+async def confirm_manual_api(data: Dict[str, Any], user: Any, progress: Optional[ProgressCallback] = None) -> Tuple[bool, str, Optional[Dict]]:
     """
     Запрос к proverkacheka.com API для manual чека (Формат 1 из спецификации).
     POST form-data: token, fn, fd, fp, t=YYYYMMDDTHHMM, n=op_type (1-4), s=RUB (str, e.g., '27.20'), qr=0.
+    progress: async-колбэк, получает текст о паузах перед повторами (для сообщения пользователю).
     Возвращает: (success: bool, message: str, parsed_data: dict or None)
     """
     try:
@@ -203,165 +662,58 @@ async def confirm_manual_api(data: Dict[str, Any], user: Any) -> Tuple[bool, str
         # n = op_type (1=приход, 2=возврат прихода, 3=расход, 4=возврат расхода)
         n_type = str(op_type)
 
-        # FormData по спецификации (multipart/form-data)
-        form_data = aiohttp.FormData()
-        form_data.add_field("token", PROVERKACHEKA_TOKEN)
-        form_data.add_field("fn", fn)
-        form_data.add_field("fd", fd)
-        form_data.add_field("fp", fp)
-        form_data.add_field("t", t_combined)  # YYYYMMDDTHHMM
-        form_data.add_field("n", n_type)
-        form_data.add_field("s", sum_rub)  # RUB str
-        form_data.add_field("qr", "0")  # Manual, не QR
+        # FormData по спецификации (multipart/form-data); собирается заново на каждую попытку
+        def build_form() -> aiohttp.FormData:
+            form_data = aiohttp.FormData()
+            form_data.add_field("token", PROVERKACHEKA_TOKEN)
+            form_data.add_field("fn", fn)
+            form_data.add_field("fd", fd)
+            form_data.add_field("fp", fp)
+            form_data.add_field("t", t_combined)  # YYYYMMDDTHHMM
+            form_data.add_field("n", n_type)
+            form_data.add_field("s", sum_rub)  # RUB str
+            form_data.add_field("qr", "0")  # Manual, не QR
+            return form_data
 
         logger.info(f"confirm_manual_api: Запрос к proverkacheka API с fn={fn}, fd={fd}, fp={fp}, t={t_combined}, n={n_type}, s={sum_rub}, qr=0, user_id={user.id}")
 
-        url = "https://proverkacheka.com/api/v1/check/get"
-        timeout = aiohttp.ClientTimeout(total=30)
-
-        max_retries = 3
-        for attempt in range(1, max_retries + 1):
-            try:
-                async with aiohttp.ClientSession(timeout=timeout) as session:
-                    async with session.post(url, data=form_data) as response:
-                        response_text = await response.text()
-                        logger.info(f"API response: status={response.status}, text={response_text[:200]}...")
-
-                        if response.status == 200:
-                            try:
-                                result = json.loads(response_text)
-                                code = result.get("code")
-                                if code == 1:
-                                    # Успех: data.json
-                                    data_block = result.get("data", {})
-                                    data_json = data_block.get("json", {})
-                                    
-                                    # ✅ НОВЫЕ ЛОГИ: Смотрим всю структуру, которую вернул API
-                                    logger.info(f"--- DEBUG API ---")
-                                    logger.info(f"Ключи внутри 'data': {list(data_block.keys())}")
-                                    logger.info(f"Значение 'pdfurl' напрямую: '{data_block.get('pdfurl', 'НЕТ КЛЮЧА')}'")
-                                    logger.info(f"-----------------")
-
-                                    # ✅ НОВОЕ: Извлекаем ссылку на PDF
-                                    pdf_url = data_block.get("pdfurl", "")
-
-                                    if data_json:
-                                        # Парсинг по спецификации
-                                        items_raw = data_json.get("items", [])
-                                        items = []
-                                        excluded_sum = 0.0
-                                        excluded_items_list = []
-
-                                        for item in items_raw:
-                                            name = item.get("name", "Неизвестно").strip()
-                                            total_sum_item = safe_float(item.get("sum", 0)) / 100.0  # копейки → RUB
-                                            unit_price = safe_float(item.get("price", 0)) / 100.0
-                                            quantity = item.get("quantity", 1)
-
-                                            if is_excluded(name):
-                                                logger.info(f"Найден исключённый товар: '{name}' (сумма: {total_sum_item})")
-                                                excluded_sum += total_sum_item
-                                                excluded_items_list.append(name)
-                                                continue
-
-                                            items.append({
-                                                "name": name,
-                                                "sum": total_sum_item,
-                                                "price": unit_price,
-                                                "quantity": quantity
-                                            })
-
-                                        total_sum_raw = safe_float(data_json.get("totalSum", 0)) / 100.0
-                                        filtered_total = total_sum_raw - excluded_sum
-
-                                        parsed_data = {
-                                            "fiscal_doc": data_json.get("fiscalDocumentNumber", f"{fn}-{fd}-{fp}"),
-                                            "qr_string": result.get("request", {}).get("qrraw", f"t={t_combined}&s={sum_rub}&fn={fn}&i={fd}&fp={fp}&n={n_type}"),
-                                            "date": data_json.get("ticketDate", full_date).replace("-", "."),
-                                            "store": data_json.get("user", data_json.get("retailPlace", "Неизвестно")),
-                                            "items": items if items else [{"name": "Товар из чека", "sum": s, "price": s, "quantity": 1}],  # Fallback
-                                            "operation_type": data_json.get("operationType", op_type),
-                                            "total_sum": filtered_total,
-                                            "excluded_sum": excluded_sum,
-                                            "excluded_items": excluded_items_list,
-                                            "pdf_url": pdf_url, # ✅ НОВОЕ: Передаем ссылку на PDF
-                                            "nds18": data_json.get("nds18", 0) / 100.0,
-                                            "nds": data_json.get("nds", 0) / 100.0,
-                                            "nds0": data_json.get("nds0", 0) / 100.0,
-                                            "ndsNo": data_json.get("ndsNo", 0) / 100.0,
-                                            "cashTotalSum": data_json.get("cashTotalSum", 0) / 100.0,
-                                            "ecashTotalSum": data_json.get("ecashTotalSum", 0) / 100.0
-                                        }
-                                        logger.info(f"API success: code=1, parsed_data keys={list(parsed_data.keys())}, items_count={len(items)}")
-                                        return True, "✅ Данные чека получены из API.", parsed_data
-                                    else:
-                                        logger.error("Нет data.json в ответе")
-                                        return False, "❌ Нет данных чека в ответе API.", None
-                                elif code == 2:
-                                    return False, "⏳ Данные чека пока не готовы. Попробуйте позже.", None
-                                elif code == 3:
-                                    if attempt < max_retries:
-                                        logger.warning("Rate limit (code=3). Retry через 60s.")
-                                        time.sleep(60)  # code=3: превышено кол-во запросов, подождать 1 мин
-                                        continue
-                                    return False, "❌ Превышено количество запросов (code=3). Подождите 1 мин и попробуйте снова.", None
-                                elif code == 4:
-                                    delay = result.get("data", {}).get("wait", 5)
-                                    if attempt < max_retries:
-                                        logger.warning(f"Ожидание (code=4, wait={delay}s). Retry через {delay}s.")
-                                        time.sleep(delay)
-                                        continue
-                                    return False, f"❌ Ожидание перед повторным запросом (code=4, wait={delay}s).", None
-                                else:  # code=0,5 или другие
-                                    error_msg = result.get("data", {}).get("message", f"Неизвестная ошибка (code={code})")
-                                    if attempt < max_retries:
-                                        logger.warning(f"API error code={code}: {error_msg}. Retry {attempt}/{max_retries} через 5s.")
-                                        time.sleep(5)
-                                        continue
-                                    return False, f"❌ Ошибка API (code={code}: {error_msg}). Проверьте FN/FD/FP.", None
-                            except json.JSONDecodeError as e:
-                                logger.error(f"Invalid JSON from API: {str(e)}, text={response_text[:200]}...")
-                                if "<html" in response_text.lower() or "<!doctype" in response_text.lower():
-                                    return False, "❌ Неверный ответ от API (HTML вместо JSON). Проверьте токен или используйте фото QR.", None
-                                return False, "❌ Некорректный ответ от API (не JSON).", None
-
-                        elif response.status in [401, 404, 429]:
-                            if response.status == 429:
-                                if attempt < max_retries:
-                                    logger.warning("HTTP Rate limit 429. Retry через 10s.")
-                                    time.sleep(10)
-                                    continue
-                                return False, "❌ Лимит запросов (HTTP 429). Подождите 1 мин.", None
-                            else:
-                                if attempt < max_retries:
-                                    logger.warning(f"HTTP error {response.status}. Retry {attempt}/{max_retries} через 5s.")
-                                    time.sleep(5)
-                                    continue
-                                return False, f"❌ HTTP Ошибка: code={response.status}. Проверьте данные.", None
-
-                        else:
-                            return False, f"❌ Ошибка API: HTTP {response.status}, {response_text[:100]}...", None
-
-            except aiohttp.ClientTimeout:
-                if attempt < max_retries:
-                    logger.warning(f"Timeout. Retry {attempt}/{max_retries}.")
-                    time.sleep(5)
-                    continue
-                return False, "❌ Таймаут запроса к API. Проверьте интернет.", None
-            except aiohttp.ClientError as e:
-                logger.error(f"Request error: {str(e)}")
-                if attempt < max_retries:
-                    time.sleep(5)
-                    continue
-                return False, f"⚠️ Ошибка сети: {str(e)}.", None
-            except Exception as e:
-                logger.error(f"Unexpected error in API request: {str(e)}")
-                if attempt < max_retries:
-                    time.sleep(5)
-                    continue
-                return False, f"⚠️ Неожиданная ошибка: {str(e)}.", None
-
-        return False, "❌ Не удалось получить данные чека после 3 попыток.", None
+        # Тот же чек уже получали (фото или ручной ввод) — ответ из кэша
+        result = await get_cached_check(receipt_cache_keys(fn=fn, fd=fd, fp=fp))
+        if result is not None:
+            logger.info(f"Кэш чеков: fn={fn}, fd={fd}, fp={fp} — ответ API из Redis")
+        else:
+            # Повторы (code 3/4, 429/5xx, таймауты) — асинхронно, с jitter и общим дедлайном
+            result, error_msg = await fetch_check(build_form, progress=progress, label=f"manual fn={fn} fd={fd}")
+            if result is None:
+                return False, error_msg, None
+            await store_cached_check(result, receipt_cache_keys(fn=fn, fd=fd, fp=fp))
+
+        code = result.get("code")
+        if code == 2:
+            return False, CHECK_NOT_READY_MSG, None
+        if code != 1:
+            data_block = result.get("data") if isinstance(result.get("data"), dict) else {}
+            api_msg = data_block.get("message", f"Неизвестная ошибка (code={code})")
+            return False, f"❌ Ошибка API (code={code}: {api_msg}). Проверьте FN/FD/FP.", None
+
+        # Успех: data.json — один проход, деньги в копейках (receipt_model)
+        receipt = Receipt.from_api(
+            result,
+            fallback_fiscal_doc=f"{fn}-{fd}-{fp}",
+            fallback_date=f"{full_date[:4]}.{full_date[4:6]}.{full_date[6:]}",
+            fallback_qrraw=f"t={t_combined}&s={sum_rub}&fn={fn}&i={fd}&fp={fp}&n={n_type}",
+            fallback_operation_type=op_type,
+            fallback_item_sum_kop=rub_to_kop(s),
+        )
+        if receipt is None:
+            logger.error("Нет data.json в ответе")
+            return False, "❌ Нет данных чека в ответе API.", None
+        for item in receipt.excluded:
+            logger.info(f"Найден исключённый товар: '{item.name}' (сумма: {item.sum})")
+
+        parsed_data = receipt.to_dict()
+        logger.info(f"API success: code=1, parsed_data keys={list(parsed_data.keys())}, items_count={len(receipt.items)}")
+        return True, "✅ Данные чека получены из API.", parsed_data
 
     except Exception as e:
         logger.error(f"Ошибка в confirm_manual_api: {str(e)}, data={data}")